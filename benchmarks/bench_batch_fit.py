@@ -0,0 +1,60 @@
+"""
+Fits of expo to a stack of region series with per series fit ranges:
+scipy curve_fit one series at a time (what fit_functions_ic.fit does),
+against the batch engines of fit_functions_ic.fit_batch: the closed form
+weighted least squares of the logs and the Levenberg-Marquardt iterated
+over all the series at once. Reports wall time and the median relative
+difference of the parameters to curve_fit.
+
+Run from the repository root:
+    PYTHONPATH=covid_server python benchmarks/bench_batch_fit.py
+"""
+import time
+import numpy as np
+from scipy.optimize import curve_fit
+
+from c19.batch_fit import fit_mask, loglinear_batch, lm_batch
+
+
+def expo(x, const, mean):
+    return const * np.exp(x / mean)
+
+
+def one_by_one(x, ys, mask, sigma):
+    with np.errstate(over='ignore'):
+        return np.array([curve_fit(expo, x[m], y[m], (10., 10.), s[m], absolute_sigma=True)[0]
+                         for y, m, s in zip(ys, mask, sigma)])
+
+
+def loglinear(x, ys, mask, sigma):
+    pars, _ = loglinear_batch(x, ys, mask, sigma)
+    return np.stack([np.exp(pars[:, 0]), 1 / pars[:, 1]], -1)
+
+
+def levenberg_marquardt(x, ys, mask, sigma):
+    return lm_batch(expo, x, ys, (10., 10.), mask, sigma)[0]
+
+
+def main(n_series=2000, days=60):
+    rng    = np.random.default_rng(1)
+    x      = np.arange(days, dtype=float)
+    const  = rng.uniform(5, 50, n_series)[:, None]
+    mean   = rng.uniform(5, 20, n_series)[:, None]
+    ys     = rng.poisson(expo(x, const, mean)).astype(float)
+    sigma  = np.sqrt(np.maximum(ys, 1))
+    ranges = np.stack([rng.integers(0, 10, n_series), rng.integers(40, days + 1, n_series)], -1)
+    mask   = fit_mask(x, ys, ranges)
+
+    print(f'{"engine":20} {"time (s)":>9} {"median rel diff":>13}')
+    reference = None
+    for name, fun in (('curve_fit', one_by_one), ('loglinear', loglinear),
+                      ('levenberg-marquardt', levenberg_marquardt)):
+        t0   = time.perf_counter()
+        pars = fun(x, ys, mask, sigma)
+        dt   = time.perf_counter() - t0
+        reference = pars if reference is None else reference
+        print(f'{name:20} {dt:9.3f} {np.median(np.abs(pars / reference - 1)):16.2e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+Compare odeint with and without the analytic Jacobians of c19.basic_models:
+number of RHS evaluations (nfe), Jacobian evaluations (nje) and wall time.
+
+Run from the repository root:
+    PYTHONPATH=covid_server python benchmarks/bench_jacobians.py
+"""
+import time
+import numpy as np
+from scipy.integrate import odeint
+
+import c19.basic_models as cbm
+
+
+def run(deriv, jac, y0, t_range, args, repeat=20):
+    out = {}
+    for name, Dfun in (('finite diff', None), ('analytic', jac)):
+        t0 = time.perf_counter()
+        for i in range(repeat):
+            _, info = odeint(deriv, y0, t_range, args=args, Dfun=Dfun, full_output=True)
+        dt = (time.perf_counter() - t0) / repeat
+        out[name] = info['nfe'][-1], info['nje'][-1], dt
+    return out
+
+
+def main(days=365):
+    t_range = np.arange(0, days + 1, 1.)
+    R0, T, Ti = 3., 7., 5.
+    Gamma, Sigma = 1 / T, 1 / Ti
+    Beta = R0 * Gamma
+    M = cbm.mitigation_function(t_range, [(0, 20), (20, days)], [1, 0.35])
+
+    cases = {
+        'SIR'  : (cbm.sir_deriv, cbm.sir_jac, (1 - 1e-5, 1e-5, 0),
+                  (M, Beta, Gamma)),
+        'SEIR' : (cbm.seir_deriv_time, cbm.seir_jac_time, (1 - 2e-4, 1e-4, 1e-4),
+                  (M, Beta, Gamma, Sigma)),
+        'SEIR2': (cbm.seir2_deriv_time, cbm.seir2_jac_time, (1 - 2e-4, 1e-4, 1e-4, 0, 0, 0),
+                  (M, Beta, Gamma, Sigma, 0.01, 1 / 10, 1 / 30)),
+        # fast death and risk-perception scales make LSODA switch to BDF
+        'SEIR2 stiff': (cbm.seir2_deriv_time, cbm.seir2_jac_time, (1 - 2e-4, 1e-4, 1e-4, 0, 0, 0),
+                        (M, Beta, Gamma, Sigma, 0.01, 1e3, 1e4)),
+    }
+
+    print(f'{"model":12} {"jacobian":12} {"nfe":>6} {"nje":>5} {"time (ms)":>10}')
+    for model, (deriv, jac, y0, args) in cases.items():
+        for name, (nfe, nje, dt) in run(deriv, jac, y0, t_range, args).items():
+            print(f'{model:12} {name:12} {nfe:6d} {nje:5d} {dt * 1e3:10.2f}')
+
+
+if __name__ == '__main__':
+    main()
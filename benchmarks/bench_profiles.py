@@ -0,0 +1,55 @@
+"""
+Binned mean and error of the mean of profileX: the pandas groupby of
+fit_functions_ic before, against c19.stats.binned_stats (np.bincount of
+sums and sums of squares). Reports wall time and peak memory allocated.
+
+Run from the repository root:
+    PYTHONPATH=covid_server python benchmarks/bench_profiles.py
+"""
+import time
+import tracemalloc
+import numpy  as np
+import pandas as pd
+
+from c19.stats import binned_stats
+
+
+def groupby(bins, y, nbins):
+    gb = pd.DataFrame(dict(bin=bins, y=y)).groupby("bin").y
+    return gb.mean().values, (gb.std() / gb.size()**0.5).values
+
+
+def bincount(bins, y, nbins):
+    size, mean, dev = binned_stats(bins, y, nbins)
+    return mean[size > 0], dev[size > 0]
+
+
+def measure(fun, *args):
+    tracemalloc.start()
+    t0  = time.perf_counter()
+    out = fun(*args)
+    dt  = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return out, dt, peak
+
+
+def main(size=10**7, nbins=100):
+    rng   = np.random.default_rng(1)
+    x     = rng.uniform(0, 10, size)
+    y     = rng.normal(x, 1)
+    edges = np.linspace(0, 10, nbins + 1)
+    bins  = np.digitize(x, edges) - 1
+
+    print(f'{"engine":10} {"time (s)":>9} {"peak (MB)":>10}')
+    results = {}
+    for name, fun in (('groupby', groupby), ('bincount', bincount)):
+        results[name], dt, peak = measure(fun, bins, y, nbins)
+        print(f'{name:10} {dt:9.3f} {peak / 2**20:10.1f}')
+
+    for a, b in zip(results['groupby'], results['bincount']):
+        np.testing.assert_allclose(a, b, rtol=1e-9)
+
+
+if __name__ == '__main__':
+    main()
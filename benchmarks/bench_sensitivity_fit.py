@@ -0,0 +1,36 @@
+"""
+Fits of SIR and SEIR to the same data with cfitsir.fit_series:
+Nelder-Mead on the likelihood (the cfit.mle default) against L-BFGS-B with
+the exact gradient of the forward sensitivity equations.
+Reports the model solves per fit, the wall time and the best parameters.
+
+Run from the repository root:
+    PYTHONPATH=covid_server python benchmarks/bench_sensitivity_fit.py
+"""
+import time
+import numpy as np
+
+import c19.cfitsir as cfitsir
+
+
+def main(days=100, N=1e6, start=1.3):
+    t = np.arange(days, dtype=float)
+    cases = {
+        'SIR' : (cfitsir.sir , (0.35, 1/8)      , (N - 10, 10, 0)),
+        'SEIR': (cfitsir.seir, (0.5 , 1/8, 1/5) , (N - 20, 10, 10)),
+    }
+
+    print(f'{"model":6} {"method":12} {"solves":>7} {"time (ms)":>10}  parameters (true)')
+    for kind, (model, pars, y0) in cases.items():
+        I    = np.round(model(N, *pars, y0, t).I)
+        par0 = start * np.array(pars)
+        for name, gradient in (('Nelder-Mead', False), ('L-BFGS-B', True)):
+            t0 = time.perf_counter()
+            pbest, nsolves = cfitsir.fit_series(t, I, N, par0, kind, gradient=gradient)
+            dt = time.perf_counter() - t0
+            print(f'{kind:6} {name:12} {nsolves:7d} {dt * 1e3:10.1f}  '
+                  f'{np.round(pbest, 4)} ({np.round(pars, 4)})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Cost of one evaluation of the SIR log-likelihood of c19.cfitsir:
+sir_llike (solve and rv_histogram on every call) against SIRLikelihood,
+on a cache miss (new parameters, one solve) and on a cache hit, and the
+cost of a full cfit.mle fit with each.
+
+Run from the repository root:
+    PYTHONPATH=covid_server python benchmarks/bench_sir_likelihood.py
+"""
+import time
+import numpy as np
+
+import c19.cfitsir as cfitsir
+import c19.cfit    as cfit
+
+
+def timeit(fun, repeat):
+    t0 = time.perf_counter()
+    for i in range(repeat):
+        fun(i)
+    return (time.perf_counter() - t0) / repeat
+
+
+def main(size=10000, repeat=200):
+    N, beta, gamma = cfitsir.N0, cfitsir.beta0, cfitsir.gamma0
+    rng   = np.random.default_rng(1)
+    irv   = cfitsir.sir_rv(cfitsir.sir(N, beta, gamma))
+    times = irv.rvs(size=size, random_state=rng)
+
+    llike = cfitsir.SIRLikelihood()
+    betas = beta * (1 + 1e-3 * np.arange(repeat))
+    cases = {
+        'sir_llike'           : lambda i: cfitsir.sir_llike(times, N, betas[i], gamma),
+        'SIRLikelihood (miss)': lambda i: llike(times, N, betas[i], gamma),
+        'SIRLikelihood (hit)' : lambda i: llike(times, N, beta, gamma),
+    }
+    print(f'{"evaluation":22} {"time (ms)":>10}')
+    for name, fun in cases.items():
+        print(f'{name:22} {timeit(fun, repeat) * 1e3:10.3f}')
+
+    par = (N, 0.9 * beta, gamma)
+    mask = (False, True, True)
+    print(f'\n{"mle":22} {"time (ms)":>10}')
+    for name, fun in (('sir_llike', cfitsir.sir_llike), ('SIRLikelihood', cfitsir.SIRLikelihood())):
+        dt = timeit(lambda i: cfit.mle(times, fun, par, mask), 1)
+        print(f'{name:22} {dt * 1e3:10.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,210 @@
+import os
+import glob
 import json
+import time
+import hashlib
+import threading
 import numpy as np
+from collections import OrderedDict
 
 import c19.basic_models as cbm
-from scipy.integrate import odeint
-from scipy.interpolate import interp1d
-from c19.types import SIR, SEIR
+import c19.cfitsir      as cfitsir
+from c19.types import Compartments
+
+
+LAMBDA_TIMEOUT_MS = 3000  # Globals.Function.Timeout in template.yaml
+RESERVE_MS        = 500   # time kept for serialization and the response
+POINTS_PER_MS     = 20    # output points we can afford per remaining ms
+MIN_POINTS        = 101   # never coarsen below this number of points
+
+CACHE_CONTROL     = 'public, max-age=86400'
+UNCACHEABLE       = {'fit'}   # models whose response depends on the process history
+
+SUMMARY_T_MAX     = 3650  # longest run (days) for solver based summaries
+
+SCENARIO_CACHE_SIZE = 64  # dense solutions kept by the warm container
+scenario_cache      = OrderedDict()
+scenario_lock       = threading.Lock()
+
+FIT_CACHE_SIZE    = 256   # best fits kept by (model, region, data version)
+WARM_SIMPLEX      = 0.02  # relative size of the simplex around a warm start
+FIT_RATE_MIN      = 1e-6  # lower bound of the fitted rates (1/day)
+fit_cache         = OrderedDict()
+fit_latest        = {}    # last best fit of each (model, region)
+fit_lock          = threading.Lock()
+
+
+class BadRequest(ValueError):
+    """Invalid request parameters, answered with a 400"""
+
+
+class LocalContext:
+    """Stand-in for the Lambda context when running locally or in tests"""
+    def __init__(self, timeout_ms=LAMBDA_TIMEOUT_MS):
+        self.deadline = time.monotonic() + timeout_ms / 1000
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.monotonic()) * 1000))
+
+
+def get_context(context):
+    """Return context if it is a Lambda context, a LocalContext otherwise"""
+    if hasattr(context, 'get_remaining_time_in_millis'):
+        return context
+    return LocalContext()
+
+
+def time_increment(days, context):
+    """Output time step (in days) that keeps the number of points within
+    what can be serialized before the deadline. 1 means daily resolution"""
+    if context is None:
+        return 1
+    budget = context.get_remaining_time_in_millis() - RESERVE_MS
+    max_points = max(MIN_POINTS, int(budget * POINTS_PER_MS))
+    return max(1, int(np.ceil(days / (max_points - 1))))
+
+
+def time_range(days, t_inc):
+    """Output times from 0 to days with step t_inc. The last step is
+    shortened so that the range ends at days, where the mitigation ends"""
+    return np.append(np.arange(0.0, days, t_inc), float(days))
+
+
+def time_grid(params, days, context=None):
+    """Output times of a request: the t_eval list if given, otherwise
+    a regular grid from 0 to days with step resolution (1 day by default).
+    Grids with more points than can be serialized before the deadline are
+    thinned. Returns the grid and whether it was thinned"""
+    max_points = None
+    if context is not None:
+        budget     = context.get_remaining_time_in_millis() - RESERVE_MS
+        max_points = max(MIN_POINTS, int(budget * POINTS_PER_MS))
+
+    if 't_eval' in params:
+        try:
+            t = np.array(params['t_eval'], dtype=float)
+        except (TypeError, ValueError):
+            raise BadRequest('t_eval must be a list of numbers')
+        if t.ndim != 1:
+            raise BadRequest('t_eval must be a list of numbers')
+        t = t[(t >= 0) & (t <= days)]
+        n = len(t)
+        if n == 0:
+            raise BadRequest('t_eval has no times in [0, {}]'.format(days))
+    else:
+        try:
+            step = float(params.get('resolution', 1))
+        except (TypeError, ValueError):
+            raise BadRequest('resolution must be a number')
+        if not step > 0:
+            raise BadRequest('resolution must be positive')
+        n = int(np.floor(days / step + 1e-9)) + 1
+
+    # the stride is known before the regular grid is allocated
+    stride = 1 if max_points is None else int(np.ceil(n / max_points))
+    if 't_eval' in params:
+        return t[::stride], stride > 1
+    return np.arange(0, n, stride) * step, stride > 1
+
+
+def scenario_solution(key, solve):
+    """Dense solution of a scenario from the LRU cache, or from solve().
+    Solutions stopped early by the deadline are not cached. The cache is
+    shared by the threads of the local server: it is only accessed with
+    scenario_lock held (solve runs without it)"""
+    with scenario_lock:
+        if key in scenario_cache:
+            scenario_cache.move_to_end(key)
+            return scenario_cache[key]
+
+    sol = solve()
+    if sol.t_max >= key[-1]:
+        with scenario_lock:
+            scenario_cache[key] = sol
+            scenario_cache.move_to_end(key)
+            if len(scenario_cache) > SCENARIO_CACHE_SIZE:
+                scenario_cache.popitem(last=False)
+    return sol
+
+
+def canonical_key(data):
+    """Canonical string identifying a request: the model plus its params
+    with numbers normalized, so that "3", 3 and 3.0 give the same key"""
+    def _norm(v):
+        if isinstance(v, bool) or v is None:
+            return v
+        if isinstance(v, (list, tuple)):
+            return [_norm(x) for x in v]
+        if isinstance(v, dict):
+            return {k: _norm(x) for k, x in v.items()}
+        try:
+            return float(v)
+        except (TypeError, ValueError):
+            return v
+
+    return json.dumps({'model' : data.get('model'),
+                       'params': _norm(data.get('params', {}))},
+                      sort_keys=True, separators=(',', ':'))
+
+
+def code_version():
+    """Hash of the model source code, so that ETags change with each deploy"""
+    here  = os.path.dirname(os.path.abspath(__file__))
+    files = [os.path.join(here, 'app.py')] + sorted(glob.glob(os.path.join(here, 'c19', '*.py')))
+    sha   = hashlib.sha1()
+    for name in files:
+        with open(name, 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()[:12]
+
+
+CODE_VERSION = code_version()
+
+
+def etag(data):
+    """Strong ETag of a request: the outputs of the models (but those in
+    UNCACHEABLE) are a pure function of the canonical params and the code
+    version"""
+    key = canonical_key(data) + CODE_VERSION
+    return '"' + hashlib.sha256(key.encode('utf-8')).hexdigest()[:32] + '"'
+
+
+def get_header(event, name):
+    """Case insensitive lookup of a request header"""
+    headers = event.get('headers') or {}
+    for key, value in headers.items():
+        if key.lower() == name.lower():
+            return value
+    return None
+
+
+def etag_matches(if_none_match, tag):
+    """True if the If-None-Match header value matches the ETag"""
+    if if_none_match is None:
+        return False
+    tags = [t.strip() for t in if_none_match.split(',')]
+    tags = [t[2:] if t.startswith('W/') else t for t in tags]
+    return '*' in tags or tag in tags
+
+
+def is_partial(t, days):
+    """True if the time axis is coarser than daily or stops before days"""
+    return len(t) < days + 1
+
+
+def deadline_events(context):
+    """Solver events that stop an integration when the time is running out
+    (none without a context). The event must be a function of t for the
+    solver root finding: it crosses zero at the first t evaluated after
+    the clock ran out"""
+    if context is None:
+        return ()
+    t_stop = [np.inf]
+    def deadline(t, y):
+        if t_stop[0] == np.inf and context.get_remaining_time_in_millis() < RESERVE_MS:
+            t_stop[0] = t
+        return t_stop[0] - t
+    return (deadline,)
 
 
 def lambda_handler(event, context):
@@ -31,25 +231,61 @@ def lambda_handler(event, context):
     data = json.loads(event['body'])
     #data = event
 
-    model = data['model']
+    model   = data['model']
+    context = get_context(context)
+
+    wrappers = {'SIR'    : wrapper_sir,
+                'SEIR'   : wrapper_seir,
+                'beds'   : wrapper_beds,
+                'metapop': wrapper_metapop,
+                'fit'    : wrapper_fit}
+
+    headers = {
+        'Content-Type': 'application/json',
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'ETag',
+        }
+
+    if model not in wrappers:
+        return bad_request(headers, 'unknown model {}'.format(model))
+
+    if model in UNCACHEABLE:
+        headers['Cache-Control'] = 'no-store'
+    else:
+        tag = etag(data)
+        headers.update({'ETag': tag, 'Cache-Control': CACHE_CONTROL})
+
+        if etag_matches(get_header(event, 'If-None-Match'), tag):
+            return {
+                'statusCode': 304,
+                'headers': headers,
+                'body': ''
+            }
+
+    try:
+        results = wrappers[model](data['params'], context)
+    except BadRequest as e:
+        return bad_request(headers, str(e))
+
+    # partial results depend on the time left, they must not be cached
+    if results.get('partial'):
+        headers.pop('ETag', None)
+        headers['Cache-Control'] = 'no-store'
 
-    result = ''
-
-    if model == 'SIR':
-        result = wrapper_sir(data['params'])
-    if model == 'SEIR':
-        result = wrapper_seir(data['params'])
-    if model == 'beds':
-        result = wrapper_beds(data['params'])
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': json.dumps(results, cls=NpEncoder)
+    }
 
 
+def bad_request(headers, message):
+    """400 response, without ETag nor cache headers"""
+    headers = {k: v for k, v in headers.items() if k not in ('ETag', 'Cache-Control')}
     return {
-        'statusCode': 200,
-        'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*'
-            },
-        'body': result
+        'statusCode': 400,
+        'headers': headers,
+        'body': json.dumps({'error': message})
     }
 
 
@@ -65,7 +301,7 @@ class NpEncoder(json.JSONEncoder):
             return super(NpEncoder, self).default(obj)
 
 
-def wrapper_sir(params):
+def wrapper_sir(params, context=None):
     R0   = float(params['R0'  ])
     T    = float(params['T'   ])
     Tm   = int  (params['Tm'  ])
@@ -74,22 +310,21 @@ def wrapper_sir(params):
     N    = int  (params['N'  ])
     absolute = bool(params['absolute'])
 
-    sir_result = compute_basic_sir_model(R0, T, Tm, Q, days, N, absolute)
+    if params.get('summary_only'):
+        return compute_sir_summary(R0, T, Tm, Q, days, N, absolute, context)
 
-    t = sir_result.t.tolist()
-    S = sir_result.S.tolist()
-    I = sir_result.I.tolist()
-    R = sir_result.R.tolist()
+    t_eval, thinned = time_grid(params, days, context)
+    sir_result = compute_basic_sir_model(R0, T, Tm, Q, days, N, absolute,
+                                         t_eval=t_eval, context=context)
 
-    result = json.dumps({'t':  t,
-                         'S' : S,
-                         'I' : I,
-                         'R' : R}, cls=NpEncoder)
+    results = sir_result.as_dict()
+    if thinned or len(sir_result.t) < len(t_eval):
+        results['partial'] = True
 
-    return result
+    return results
 
 
-def wrapper_seir(params):
+def wrapper_seir(params, context=None):
     R0   = float(params['R0'  ])
     T    = float(params['T'   ])
     Ti = float(params['Ti' ])
@@ -99,24 +334,21 @@ def wrapper_seir(params):
     N    = int  (params['N'  ])
     absolute = bool(params['absolute'])
 
-    seir_result = compute_basic_seir_model(R0, T, Ti, Tm, Q, days, N, absolute)
+    if params.get('summary_only'):
+        return compute_seir_summary(R0, T, Ti, Tm, Q, days, N, absolute, context)
 
-    t = seir_result.t.tolist()
-    S = seir_result.S.tolist()
-    E = seir_result.E.tolist()
-    I = seir_result.I.tolist()
-    R = seir_result.R.tolist()
+    t_eval, thinned = time_grid(params, days, context)
+    seir_result = compute_basic_seir_model(R0, T, Ti, Tm, Q, days, N, absolute,
+                                           t_eval=t_eval, context=context)
 
-    result = json.dumps({'t':  t,
-                         'S' : S,
-                         'E' : E,
-                         'I' : I,
-                         'R' : R}, cls=NpEncoder)
+    results = seir_result.as_dict()
+    if thinned or len(seir_result.t) < len(t_eval):
+        results['partial'] = True
 
-    return result
+    return results
 
 
-def wrapper_beds(params):
+def wrapper_beds(params, context=None):
     R0 = float(params['R0'])
     T  = float(params['T' ])
     Ti = float(params['Ti' ])
@@ -124,8 +356,115 @@ def wrapper_beds(params):
     Tm = int(params['Tm'])
     M = float(params['M'])
 
-    seir_result = compute_beds_seir_model(R0, T, Ti, days, tm=Tm, mitigation=M)
-    IC, RC = get_I_and_R_CAA(poblacion[1], seir_result.N, seir_result.I, seir_result.R, norm=False)
+    t_inc = time_increment(days, context)
+    ub = uci_beds(poblacion[1])
+    if 'contacts' in params:
+        # age structured model: the same age distribution in all regions
+        # camas cross the capacity when (f_uci age_dist) @ I reaches capacity / population
+        contacts, age_dist, f_uci = age_params(params)
+        thresholds = [b / p for b, p in zip(ub, poblacion[1])]
+        seir_result, events = compute_beds_age_seir_model(R0, T, Ti, days, tm=Tm, mitigation=M,
+                                                          contacts=contacts, age_dist=age_dist,
+                                                          weights=f_uci * age_dist,
+                                                          thresholds=thresholds,
+                                                          t_inc=t_inc, context=context)
+        I = seir_result.I * age_dist[:, np.newaxis]
+        R = seir_result.R * age_dist[:, np.newaxis]
+    else:
+        # camas cross the capacity when I reaches capacity / (population f_uci)
+        f_uci = 0.05
+        thresholds = [b / (p * f_uci) for b, p in zip(ub, poblacion[1])]
+        seir_result, events = compute_beds_seir_model(R0, T, Ti, days, tm=Tm, mitigation=M,
+                                                      thresholds=thresholds,
+                                                      t_inc=t_inc, context=context)
+        I, R = seir_result.I, seir_result.R
+    IC, RC = get_I_and_R_CAA(poblacion[1], np.sum(seir_result.N), I, R, norm=False)
+    Iur06 = uci_cases(IC, f_uci = f_uci)
+
+    t = seir_result.t.tolist()
+    results = {'t' : t}
+
+    for i, comunidad in enumerate(poblacion[0]):
+        results[comunidad] = {'capacity'     : ub[i],
+                              'camas'        : Iur06[i].tolist(),
+                              'capacity_day' : events['thresholds'][i]}
+    results['events'] = {'peak'      : events['peak'],
+                         'extinction': events['extinction']}
+    # runs stopped by the extinction event are complete
+    extinct = events['extinction'] is not None
+    if t_inc > 1 or (is_partial(seir_result.t, days) and not extinct):
+        results['partial'] = True
+
+    return results
+
+
+def age_params(params):
+    """Contact matrix (n_age, n_age), age distribution normalized to 1 and
+    ICU fractions (n_age,) of an age structured beds request"""
+    for name in ('contacts', 'age_dist', 'f_uci'):
+        if name not in params:
+            raise BadRequest('age structured beds need {}'.format(name))
+    try:
+        contacts = np.array(params['contacts'], dtype=float)
+        age_dist = np.array(params['age_dist'], dtype=float)
+        f_uci    = np.array(params['f_uci'   ], dtype=float)
+    except (TypeError, ValueError):
+        raise BadRequest('contacts, age_dist and f_uci must be numeric arrays')
+
+    n_age = len(age_dist)
+    if age_dist.shape != (n_age,) or n_age == 0 or contacts.shape != (n_age, n_age):
+        raise BadRequest('contacts must be a square matrix of the size of age_dist')
+    if f_uci.shape != (n_age,):
+        raise BadRequest('f_uci must have one fraction per age group')
+    if np.any(age_dist < 0) or age_dist.sum() <= 0 or np.any(contacts < 0) or not contacts.any():
+        raise BadRequest('age_dist and contacts must be non negative and not all zero')
+    return contacts, age_dist / age_dist.sum(), f_uci
+
+
+def mobility_params(params):
+    """Non zero elements {'rows': ..., 'cols': ..., 'vals': ...} of the
+    mobility matrix of a metapop request between the CCAA, None if not given"""
+    mobility = params.get('mobility')
+    if mobility is None:
+        return None
+    if not isinstance(mobility, dict) or any(k not in mobility for k in ('rows', 'cols', 'vals')):
+        raise BadRequest('mobility needs rows, cols and vals')
+    try:
+        rows = np.array(mobility['rows'], dtype=float)
+        cols = np.array(mobility['cols'], dtype=float)
+        vals = np.array(mobility['vals'], dtype=float)
+    except (TypeError, ValueError):
+        raise BadRequest('mobility rows, cols and vals must be numeric arrays')
+
+    n = len(poblacion[0])
+    if rows.ndim != 1 or rows.shape != cols.shape or rows.shape != vals.shape:
+        raise BadRequest('mobility rows, cols and vals must have the same length')
+    for index in (rows, cols):
+        if np.any(index != np.round(index)) or np.any(index < 0) or np.any(index >= n):
+            raise BadRequest('mobility indices must be integers in [0, {})'.format(n))
+    if not np.all(np.isfinite(vals)) or np.any(vals < 0):
+        raise BadRequest('mobility vals must be non negative')
+    return {'rows': rows.astype(int), 'cols': cols.astype(int), 'vals': vals}
+
+
+def wrapper_metapop(params, context=None):
+    R0 = float(params['R0'])
+    T  = float(params['T' ])
+    Ti = float(params['Ti' ])
+    days = int(params['days'])
+    Tm = int(params['Tm'])
+    M = float(params['M'])
+    p = float(params.get('p', 0.01))
+    seed = params.get('seed')
+    mobility = mobility_params(params)
+    if seed is not None and seed not in poblacion[0]:
+        raise BadRequest('unknown seed region {}'.format(seed))
+
+    t_inc = time_increment(days, context)
+    seir_result = compute_metapop_seir_model(R0, T, Ti, days, tm=Tm, mitigation=M,
+                                             p=p, seed=seed, mobility=mobility,
+                                             t_inc=t_inc, context=context)
+    IC = seir_result.I * seir_result.N[:, np.newaxis]
     Iur06 = uci_cases(IC, f_uci = 0.05)
     ub = uci_beds(poblacion[1])
 
@@ -135,13 +474,112 @@ def wrapper_beds(params):
     for i, comunidad in enumerate(poblacion[0]):
         results[comunidad] = {'capacity' : ub[i],
                               'camas' : Iur06[i].tolist()}
-
-    result = json.dumps(results, cls=NpEncoder)
-
-    return result
-
-
-def compute_basic_sir_model(R0, T, tm, Q, days, N, absolute):
+    if t_inc > 1 or is_partial(seir_result.t, days):
+        results['partial'] = True
+
+    return results
+
+
+def fit_params(params):
+    """Model, population, daily infected I and their days t of a fit request"""
+    kind = params.get('kind', 'SIR')
+    if kind not in ('SIR', 'SEIR'):
+        raise BadRequest('fits are of SIR or SEIR, not {}'.format(kind))
+    try:
+        N = float(params['N'])
+        I = np.array(params['I'], dtype=float)
+        t = np.array(params.get('t', np.arange(np.size(I))), dtype=float)
+    except (TypeError, ValueError):
+        raise BadRequest('N, I and t must be numeric')
+
+    if not N > 0:
+        raise BadRequest('N must be positive')
+    if I.ndim != 1 or len(I) < 2:
+        raise BadRequest('I must be a list of at least two days')
+    if t.shape != I.shape:
+        raise BadRequest('t must have one day per value of I')
+    return kind, N, I, t
+
+
+def wrapper_fit(params, context=None):
+    kind, N, I, t = fit_params(params)
+    region  = params['region']
+    version = params.get('data_version')
+    if not version:
+        data    = hashlib.sha1(I.tobytes())
+        data.update(t.tobytes())
+        data.update(np.float64(N).tobytes())
+        version = data.hexdigest()[:12]
+
+    key = (kind, region, N, version)
+    with fit_lock:
+        if key in fit_cache:
+            fit_cache.move_to_end(key)
+            return dict(fit_cache[key], cached=True)
+        warm = fit_latest.get((kind, region))
+
+    if warm is None:
+        R0 = float(params.get('R0', 3))
+        T  = float(params.get('T', 7))
+        Ti = float(params.get('Ti', 5))
+        par0 = (R0/T, 1/T) if kind == 'SIR' else (R0/T, 1/T, 1/Ti)
+    else:
+        par0 = warm
+
+    pars, nsolves, stopped = compute_fit(kind, t, I, N, par0, warm=warm is not None,
+                                         context=context)
+    names = ('beta', 'gamma') if kind == 'SIR' else ('beta', 'gamma', 'sigma')
+
+    results = dict(zip(names, pars))
+    results.update({'region': region, 'kind': kind, 'data_version': version,
+                    'R0': pars[0] / pars[1], 'warm_start': warm is not None,
+                    'nsolves': nsolves})
+    # a fit stopped by the deadline is not an optimum: neither kept nor reused
+    if stopped:
+        return dict(results, cached=False, partial=True)
+    # rates pushed to their bound are not determined by the series
+    if np.any(pars <= FIT_RATE_MIN * (1 + 1e-6)):
+        raise BadRequest('I does not determine the rates of {}'.format(kind))
+
+    with fit_lock:
+        fit_latest[(kind, region)] = tuple(pars)
+        fit_cache [key] = results
+        if len(fit_cache) > FIT_CACHE_SIZE:
+            fit_cache.popitem(last=False)
+
+    return dict(results, cached=False)
+
+
+def compute_fit(kind, t, I, N, par0, warm=False, context=None):
+    """Maximum likelihood fit of (beta, gamma) for SIR or (beta, gamma, sigma)
+    for SEIR to the daily infected I at days t, for a population N.
+    A warm start from a previous optimum uses a small initial simplex, so
+    that the fit converges in a few iterations. With a context the fit
+    stops at the deadline with the best parameters found so far.
+    The rates are bounded below by FIT_RATE_MIN.
+    Returns the best parameters, the number of model solves and whether
+    the deadline stopped the fit"""
+    options = {}
+    if warm:
+        x0 = np.asarray(par0, dtype=float)
+        options['initial_simplex'] = np.vstack((x0, x0 * (1 + WARM_SIMPLEX * np.identity(len(x0)))))
+
+    stopped = [False]
+    def deadline(intermediate_result):
+        if context is not None and context.get_remaining_time_in_millis() < RESERVE_MS:
+            stopped[0] = True
+            raise StopIteration
+
+    bounds = [(FIT_RATE_MIN, None)] * len(par0)
+    pars, nsolves = cfitsir.fit_series(t, I, N, par0, kind, options=options, bounds=bounds,
+                                       callback=deadline)
+    return pars, nsolves, stopped[0]
+
+
+def compute_basic_sir_model(R0, T, tm, Q, days, N, absolute, t_eval=None, context=None,
+                            dtype=np.float64):
+    """SIR model evaluated at times t_eval (daily by default), from the
+    dense solution of the scenario, which is cached"""
     i0 = 1e-5
     s0 = 1 - i0
     r0 = 0
@@ -149,8 +587,8 @@ def compute_basic_sir_model(R0, T, tm, Q, days, N, absolute):
 
     t_start = 0.0
     t_end   = days
-    t_inc   = 1
-    t_range = np.arange(t_start, t_end+t_inc, t_inc)
+    t_days  = np.arange(t_start, t_end+1, 1)
+    t_range = t_days if t_eval is None else np.asarray(t_eval, dtype=float)
 
     Gamma = 1/T
     Beta  = Gamma * R0
@@ -158,22 +596,28 @@ def compute_basic_sir_model(R0, T, tm, Q, days, N, absolute):
     ts = [(0, tm), (tm, days)]
     ms = [1, 1 - Q/100]
 
-    M = cbm.mitigation_function(t_range, ts, ms)
-    ret = odeint(cbm.sir_deriv, y0, t_range, args=(M, Beta, Gamma))
-    S, I, R = ret.T
+    def solve():
+        M = cbm.mitigation_function(t_days, ts, ms)
+        return cbm.dense_solution(cbm.sir_deriv, y0, (t_start, t_end), (M, Beta, Gamma),
+                                  jac=cbm.sir_jac, extra_events=deadline_events(context))
 
-    if absolute:
-        S = S * N
-        I = I * N
-        R = R * N
+    sol     = scenario_solution(('SIR', R0, T, tm, Q, days), solve)
+    t_range = t_range[t_range <= sol.t_max]
+
+    sir = Compartments(('S', 'I', 'R'), t_range, N, dtype=dtype,
+                       beta=Beta, R0=R0, gamma=Gamma)
+    sir.data[:] = sol(t_range)
 
-    sir = SIR(N = N, S=S, I=I,  R=R,
-              beta=Beta, R0=R0, gamma=Gamma, t=t_range)
+    if absolute:
+        sir.to_absolute()
 
     return sir
 
 
-def compute_basic_seir_model(R0, T, Ti, Tm, Q, days, N, absolute):
+def compute_basic_seir_model(R0, T, Ti, Tm, Q, days, N, absolute, t_eval=None, context=None,
+                             dtype=np.float64):
+    """SEIR model evaluated at times t_eval (daily by default), from the
+    dense solution of the scenario, which is cached"""
     # Initial number of infected and recovered individuals, I0 and R0.
     i0 = 1e-4
     e0 = 1e-4
@@ -182,8 +626,8 @@ def compute_basic_seir_model(R0, T, Ti, Tm, Q, days, N, absolute):
 
     t_start = 0.0
     t_end   = days
-    t_inc   = 1
-    t_range = np.arange(t_start, t_end+t_inc, t_inc)
+    t_days  = np.arange(t_start, t_end+1, 1)
+    t_range = t_days if t_eval is None else np.asarray(t_eval, dtype=float)
 
     Gamma = 1./T
     Sigma = 1./Ti
@@ -191,54 +635,183 @@ def compute_basic_seir_model(R0, T, Ti, Tm, Q, days, N, absolute):
     ts = [(0, Tm), (Tm, days)]
     ms = [1, 1 - Q/100]
 
-    M = cbm.mitigation_function(t_range, ts, ms)
-    ret = odeint(cbm.seir_deriv_time, y0, t_range, args=(M, Beta, Gamma, Sigma))
-    S, E, I = ret.T
-    R = 1 - S - E - I
+    def solve():
+        M = cbm.mitigation_function(t_days, ts, ms)
+        return cbm.dense_solution(cbm.seir_deriv_time, y0, (t_start, t_end),
+                                  (M, Beta, Gamma, Sigma), jac=cbm.seir_jac_time,
+                                  extra_events=deadline_events(context))
 
-    if absolute:
-        S = S * N
-        E = E * N
-        I = I * N
-        R = R * N
+    sol     = scenario_solution(('SEIR', R0, T, Ti, Tm, Q, days), solve)
+    t_range = t_range[t_range <= sol.t_max]
 
-    seir = SEIR(N=N, S=S, I=I, E=E, R=R,
-                beta=Beta, R0=R0, gamma=Gamma, sigma = Sigma, t= t_range)
+    seir = cbm.seir_compartments(sol(t_range), t_range, N, dtype=dtype,
+                                 beta=Beta, R0=R0, gamma=Gamma, sigma = Sigma)
+
+    if absolute:
+        seir.to_absolute()
 
     return seir
 
 
+def compute_sir_summary(R0, T, tm, Q, days, N, absolute, context=None):
+    """Peak of infected, day of the peak and attack rate (final size) of the
+    SIR model. Closed forms are used for the unmitigated model, otherwise
+    the model is integrated until the epidemic dies out, or until the
+    deadline, in which case the summary is partial"""
+    i0 = 1e-5
+    s0 = 1 - i0
+
+    Gamma = 1/T
+    Beta  = Gamma * R0
+
+    stopped = False
+    if Q == 0:
+        method    = 'analytic'
+        peak_I, _ = cbm.sir_peak(R0, s0, i0)
+        peak_day  = cbm.sir_peak_time(Beta, Gamma, s0, i0)
+        attack    = cbm.sir_final_size(R0, s0)
+    else:
+        method   = 'solver'
+        t_days   = np.arange(0, days+1, 1)
+        M        = cbm.mitigation_function(t_days, [(0, tm), (tm, days)], [1, 1 - Q/100])
+        peak_I, peak_day, y, _, stopped = cbm.epidemic_summary_ivp(
+            cbm.sir_deriv, (s0, i0, 0), (M, Beta, Gamma), 1, t_max=SUMMARY_T_MAX,
+            extra_events=deadline_events(context))
+        attack   = 1 - y[0]
+
+    if absolute:
+        peak_I = peak_I * N
+
+    summary = {'peak_I'     : peak_I,
+               'peak_day'   : peak_day,
+               'attack_rate': attack,
+               'method'     : method}
+    if stopped:
+        summary['partial'] = True
+    return summary
+
+
+def compute_seir_summary(R0, T, Ti, Tm, Q, days, N, absolute, context=None):
+    """Peak of infected, day of the peak and attack rate (final size) of the
+    SEIR model. The peak is located with a solver event; for the unmitigated
+    model the run stops at the peak and the final size is analytic.
+    A run stopped by the deadline gives a partial summary"""
+    i0 = 1e-4
+    e0 = 1e-4
+    s0 = 1 - i0 - e0
+
+    Gamma = 1./T
+    Sigma = 1./Ti
+    Beta  = Gamma * R0
+
+    t_days = np.arange(0, days+1, 1)
+    M      = cbm.mitigation_function(t_days, [(0, Tm), (Tm, days)], [1, 1 - Q/100])
+    peak_I, peak_day, y, _, stopped = cbm.epidemic_summary_ivp(
+        cbm.seir_deriv_time, (s0, e0, i0), (M, Beta, Gamma, Sigma), 2, t_max=SUMMARY_T_MAX,
+        stop_at_peak=(Q == 0), extra_events=deadline_events(context))
+    if Q == 0:
+        method = 'semi-analytic'
+        attack = cbm.sir_final_size(R0, s0)
+    else:
+        method = 'solver'
+        attack = 1 - y[0]
+
+    if absolute:
+        peak_I = peak_I * N
+
+    summary = {'peak_I'     : peak_I,
+               'peak_day'   : peak_day,
+               'attack_rate': attack,
+               'method'     : method}
+    if stopped:
+        summary['partial'] = True
+    return summary
+
+
 poblacion = (
     ['Andalucía', 'Aragón', 'Asturias', 'Baleares', 'Canarias', 'Cantabria', 'Cas-León', 'Cas-Mancha', 'Cataluña', 'Valencia', 'Extremadura', 'Galicia', 'Madrid', 'Murcia', 'Navarra', 'Euskadi', 'Rioja', 'Ceuta', 'Melilla'],
     [8414240,1319291,1022800,1149460,2153389,581078,2399548,2032863,7675217,5003769,1067710,2699499,6663394,1493898,654214,2207776,316798,84777,86487]
 )
 
 
-def compute_beds_seir_model(R0, T, Ti, days, tm, mitigation, n=1000):
+def compute_beds_seir_model(R0, T, Ti, days, tm, mitigation, n=1000, thresholds=(),
+                            t_inc=1, context=None):
+    """SEIR run of the beds model. Returns the SEIR result and the times
+    of the peak, of I crossing each of the thresholds and of extinction,
+    which ends the run early (see c19.basic_models.compute_seir_events)"""
     # Initial number of infected and recovered individuals, I0 and R0.
     t_start = 0.0
     t_end   = days
-    t_inc   = 1
 
-    t_range = np.arange(t_start, t_end+t_inc, t_inc)
+    t_range = time_range(t_end, t_inc)
     Gamma   = 1. / T
     Sigma   = 1. / Ti
-    Beta    = Gamma * R0
     I0, E0  = 1E-4, 1E-4
     S0      = 1 - I0 - E0
     Y0      = (S0, E0, I0)
 
     ts = [(0, tm), (tm, days)]
     ms = [1, mitigation]
-    M = cbm.mitigation_function(t_range, ts, ms)
 
-    RES = odeint(cbm.seir_deriv_time, Y0, t_range, args=(M, Beta, Gamma, Sigma))
-    S, E, I = RES.T
-    R = 1 - S - E - I
-    #seir_result = SEIR(N=n, S=S, I=I, E=E, R=R, beta=Beta, R0=R0, gamma=Gamma, sigma = Sigma, t= t_range)
-    seir_result = SEIR(N=n, S=S, I=I, E=E, R=R, beta=Beta, R0=R0, gamma=Gamma, sigma = Sigma, t= t_range)
+    seir_result, events = cbm.compute_seir_events(n, Y0, R0, Gamma, Sigma, t_range, ts, ms,
+                                                  thresholds=thresholds,
+                                                  extra_events=deadline_events(context))
+    return seir_result, events
+
+def compute_metapop_seir_model(R0, T, Ti, days, tm, mitigation, p=0.01, seed=None,
+                               mobility=None, t_inc=1, context=None):
+    """SEIR of the CCAA coupled through a mobility matrix.
+    mobility holds the non zero elements of the matrix as lists
+    {'rows': ..., 'cols': ..., 'vals': ...}. By default a fraction p of
+    the contacts of each region happen with the rest of Spain, in
+    proportion to the population of the other regions.
+    seed is the name of the region where the epidemic starts, by default
+    it starts everywhere"""
+    N = np.array(poblacion[1], dtype=float)
+    n = len(N)
+
+    if mobility is None:
+        rows, cols = map(np.ravel, np.indices((n, n)))
+        vals       = p * N[cols] / N.sum() + (1 - p) * (rows == cols)
+    else:
+        rows, cols, vals = mobility['rows'], mobility['cols'], mobility['vals']
+    C = cbm.mobility_matrix(n, rows, cols, vals)
+
+    I0 = np.full(n, 1E-4)
+    if seed is not None:
+        I0 = np.where(np.array(poblacion[0]) == seed, 1E-4, 0.)
+    E0 = I0
+    S0 = 1 - I0 - E0
+
+    t_range = time_range(days, t_inc)
+    Gamma   = 1. / T
+    Sigma   = 1. / Ti
+    ts = [(0, tm), (tm, days)]
+    ms = [1, mitigation]
+
+    return cbm.compute_metapop_seir(N, (S0, E0, I0), R0, Gamma, Sigma, C, t_range, ts, ms,
+                                    extra_events=deadline_events(context))
+
+
+def compute_beds_age_seir_model(R0, T, Ti, days, tm, mitigation, contacts, age_dist,
+                                n=1000, weights=None, thresholds=(), t_inc=1, context=None):
+    """Age structured version of compute_beds_seir_model. I, R of the
+    result are fractions of each age group, shape (n_age, n_t). The peak
+    and the threshold crossings are those of weights @ I
+    (see c19.basic_models.compute_age_seir_events)"""
+    t_range = time_range(days, t_inc)
+    Gamma   = 1. / T
+    Sigma   = 1. / Ti
+    I0, E0  = 1E-4, 1E-4
+    S0      = 1 - I0 - E0
+
+    ts = [(0, tm), (tm, days)]
+    ms = [1, mitigation]
+    return cbm.compute_age_seir_events(n * age_dist, (S0, E0, I0), R0, Gamma, Sigma,
+                                       contacts, t_range, ts, ms,
+                                       weights=weights, thresholds=thresholds,
+                                       extra_events=deadline_events(context))
 
-    return seir_result
 
 def get_I_and_R_CAA(dca, N, I, R, norm=True):
     """Get the I and R vectors from the DF of CCAA"""
@@ -253,8 +826,11 @@ def get_I_and_R_CAA(dca, N, I, R, norm=True):
 
 
 def uci_cases(IC, f_uci = 0.05):
-    """Fraction of infected in UCI"""
-    return [I * f_uci for I in IC]
+    """Fraction of infected in UCI. With one fraction per age group,
+    each element of IC holds the infected by age group (n_age, n_t)"""
+    if np.ndim(f_uci) == 0:
+        return [I * f_uci for I in IC]
+    return [f_uci @ I for I in IC]
 
 
 def uci_beds(dca, t_beds = 4404):
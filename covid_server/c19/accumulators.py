@@ -0,0 +1,191 @@
+"""
+Mergeable accumulators of binned statistics, for data that are read in chunks
+(e.g. pd.read_csv(..., chunksize=...)) or split across processes.
+
+Each accumulator holds per bin counts, sums and sums of squares and supports
+    update(chunk)  adds a chunk of data,
+    merge(other)   adds the content of another accumulator with the same bins,
+    finalize()     returns the result of the equivalent one shot function.
+Results are exact: they do not depend on how the data were chunked.
+"""
+import abc
+import numpy as np
+
+from . core_functions import in_range
+from . stats          import binned_mean_std
+
+
+class BinnedAccumulator(abc.ABC):
+    """Per bin size, number of non NaN values, sum and sum of squares of the
+    values - shift, on a regular grid with nbins and ranges per axis"""
+
+    def __init__(self, nbins, ranges):
+        self.nbins  = tuple(np.atleast_1d(nbins).astype(int))
+        self.ranges = tuple(tuple(r) for r in ranges)
+        self.edges  = tuple(np.linspace(*r, n + 1) for n, r in zip(self.nbins, self.ranges))
+        size        = int(np.prod(self.nbins))
+        self.size   = np.zeros(size, dtype=np.int64)
+        self.count  = np.zeros(size, dtype=np.int64)
+        self.sums   = np.zeros(size)
+        self.sums2  = np.zeros(size)
+        self.shift  = None
+
+    @abc.abstractmethod
+    def _bins(self, coords):
+        """flat bin index and selection of the points in the grid"""
+
+    def _add(self, coords, values):
+        coords = [np.asarray(c, dtype=float) for c in coords]
+        values = np.asarray(values, dtype=float)
+        index, sel = self._bins(coords)
+        index, values = index[sel], values[sel]
+
+        ok = ~np.isnan(values)
+        if self.shift is None and ok.any():
+            self.shift = values[ok][0]
+        shift = self.shift if self.shift is not None else 0.
+
+        n  = len(self.size)
+        dv = values[ok] - shift
+        self.size  += np.bincount(index    , minlength=n)
+        self.count += np.bincount(index[ok], minlength=n)
+        self.sums  += np.bincount(index[ok], weights=dv     , minlength=n)
+        self.sums2 += np.bincount(index[ok], weights=dv * dv, minlength=n)
+        return self
+
+    def merge(self, other):
+        """adds the content of other (same bins and ranges)"""
+        if self.nbins != other.nbins or self.ranges != other.ranges:
+            raise ValueError("accumulators with different bins can not be merged")
+        sums, sums2 = other.sums, other.sums2
+        if other.shift is not None and self.shift is not None:
+            # move the sums of other to the shift of self
+            d     = other.shift - self.shift
+            sums2 = sums2 + 2 * d * sums + other.count * d * d
+            sums  = sums  + other.count * d
+        elif self.shift is None:
+            self.shift = other.shift
+        self.size  += other.size
+        self.count += other.count
+        self.sums  += sums
+        self.sums2 += sums2
+        return self
+
+    def _mean_std(self, std):
+        shift = self.shift if self.shift is not None else 0.
+        return binned_mean_std(self.size, self.count, self.sums, self.sums2, shift, std)
+
+    def _centers(self):
+        return tuple(e[:-1] + np.diff(e) / 2 for e in self.edges)
+
+
+class ProfileAccumulator(BinnedAccumulator):
+    """profileX (one axis) or profileXY (two axes) over chunks.
+    The ranges of the axes must be given. value_range selects the values
+    as yrange (zrange) of the profiles"""
+
+    def __init__(self, nbins, ranges, value_range=None, std=False):
+        super().__init__(nbins, ranges)
+        self.value_range = value_range
+        self.std         = std
+
+    def _bins(self, coords):
+        sel   = np.ones(len(coords[0]), dtype=bool)
+        index = np.zeros(len(coords[0]), dtype=np.int64)
+        for c, e, n, r in zip(coords, self.edges, self.nbins, self.ranges):
+            sel  &= in_range(c, *r)
+            index = index * n + np.clip(np.digitize(c, e, right=False) - 1, 0, n - 1)
+        return index, sel
+
+    def update(self, *data):
+        """adds the points (x, y) or (x, y, z) of a chunk"""
+        *coords, values = data
+        values = np.asarray(values, dtype=float)
+        if self.value_range is not None:
+            sel    = in_range(values, *self.value_range)
+            coords = [np.asarray(c)[sel] for c in coords]
+            values = values[sel]
+        return self._add(coords, values)
+
+    def finalize(self, drop_nan=True):
+        """(bin centers, mean, error) as profileX, or (x centers, y centers,
+        mean, error) as profileXY"""
+        mean, dev = self._mean_std(self.std)
+        if len(self.nbins) == 1:
+            centers, = self._centers()
+            if drop_nan:
+                filled = self.size > 0
+                return centers[filled], mean[filled], dev[filled]
+            mean[self.size == 0] = np.nan
+            dev [self.size == 0] = np.nan
+            return centers, mean, dev
+
+        mean[self.size == 0] = 0
+        dev [np.isnan(dev)]  = 0
+        return self._centers() + (mean.reshape(self.nbins), dev.reshape(self.nbins))
+
+
+class HistogramAccumulator(BinnedAccumulator):
+    """histograms h1 (one axis) or h2 (two axes) over chunks, with the binning
+    of np.histogram (the last bin includes its upper edge). Per bin it holds
+    the entries, the sum of weights and the sum of squared weights.
+    For one axis, the mean and std shown by h1 (stats.mean_and_std) are
+    kept: those of the values in the range, or of all the non nan values
+    if the data contain nans or no value is in the range"""
+
+    def __init__(self, nbins, ranges):
+        super().__init__(nbins, ranges)
+        self.shift   = 0.
+        self.moments = np.zeros((2, 3))   # entries, sum and sum of squares of x, in range and all
+        self.x0      = None               # shift of the moments
+        self.has_nan = False
+
+    def _bins(self, coords):
+        sel   = np.ones(len(coords[0]), dtype=bool)
+        index = np.zeros(len(coords[0]), dtype=np.int64)
+        for c, e, n, r in zip(coords, self.edges, self.nbins, self.ranges):
+            sel  &= (c >= r[0]) & (c <= r[1])
+            index = index * n + np.clip(np.searchsorted(e, c, side='right') - 1, 0, n - 1)
+        return index, sel
+
+    def update(self, *coords, weights=None):
+        """adds the points x or (x, y) of a chunk"""
+        weights = np.ones(len(coords[0])) if weights is None else weights
+        if len(coords) == 1:
+            x    = np.asarray(coords[0], dtype=float)
+            nan  = np.isnan(x)
+            x    = x[~nan]
+            self.has_nan |= bool(nan.any())
+            if self.x0 is None and len(x):
+                self.x0 = x[0]
+            dx = x - (self.x0 if self.x0 is not None else 0.)
+            for k, d in enumerate((dx[(x >= self.ranges[0][0]) & (x <= self.ranges[0][1])], dx)):
+                self.moments[k] += len(d), d.sum(), (d * d).sum()
+        return self._add(coords, weights)
+
+    def merge(self, other):
+        super().merge(other)
+        n, s, s2 = other.moments.T
+        if other.x0 is not None and self.x0 is not None:
+            d  = other.x0 - self.x0
+            s2 = s2 + 2 * d * s + n * d * d
+            s  = s  + n * d
+        elif self.x0 is None:
+            self.x0 = other.x0
+        self.moments += np.stack([n, s, s2], axis=1)
+        self.has_nan |= other.has_nan
+        return self
+
+    def finalize(self):
+        """(counts, edges, mean, std) as h1, or (counts, x edges, y edges) for two axes.
+        The errors of the counts are np.sqrt(self.sums2)"""
+        counts = self.sums.reshape(self.nbins)
+        if len(self.nbins) > 1:
+            return (counts,) + self.edges
+        in_range, every = self.moments
+        n, s, s2 = every if self.has_nan or in_range[0] == 0 else in_range
+        x0   = self.x0 if self.x0 is not None else 0.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = x0 + s / n
+            std  = np.sqrt(np.maximum(s2 / n - (s / n)**2, 0))
+        return counts, self.edges[0], mean, std
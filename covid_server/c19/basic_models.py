@@ -6,10 +6,15 @@ NN = np.nan
 from . types  import Number, Array, Str, Range
 
 from scipy.integrate import odeint
+from scipy.integrate import quad
+from scipy.integrate import solve_ivp
 import scipy.integrate as spi
 from scipy.interpolate import interp1d
+from scipy.special import lambertw
+import scipy.sparse as sps
 
 from . types import SIR, SEIR, SEIR2
+from . types import Compartments
 
 def sir_deriv(y, t, M, beta, gamma):
     """Prepares the SIR system of equations"""
@@ -20,6 +25,15 @@ def sir_deriv(y, t, M, beta, gamma):
     return dSdt, dIdt, dRdt
 
 
+def sir_jac(y, t, M, beta, gamma):
+    """Jacobian of sir_deriv with respect to (S, I, R), for odeint Dfun"""
+    S, I, R = y
+    b = beta * M(t)
+    return np.array([[-b * I, -b * S        , 0.],
+                     [ b * I,  b * S - gamma, 0.],
+                     [ 0.   ,  gamma        , 0.]])
+
+
 def set_sir_initial_conditions(N, i0=1, r0=0):
     """Set initial conditions vector where
     N  is the total population
@@ -31,16 +45,22 @@ def set_sir_initial_conditions(N, i0=1, r0=0):
     return y0
 
 
-def compute_sir(N, Y0, R0, Gamma, t_range, ts = [(0, 400)], ms=[1.0]):
-    """Full SIR run"""
+def is_absolute(Y0):
+    """True if the initial conditions Y0 are numbers of individuals (as
+    given by set_sir_initial_conditions), False if they are fractions of N"""
+    return np.sum(Y0) > 1 + 1e-9
+
+
+def compute_sir(N, Y0, R0, Gamma, t_range, ts = [(0, 400)], ms=[1.0], dtype=np.float64):
+    """Full SIR run, absolute or normalized as the initial conditions Y0"""
 
     Beta      = Gamma * R0
     M = mitigation_function(t_range, ts, ms)
-    ret = odeint(sir_deriv, Y0, t_range, args=(M, Beta, Gamma))
-    S, I, R = ret.T
+    ret = odeint(sir_deriv, Y0, t_range, args=(M, Beta, Gamma), Dfun=sir_jac)
 
-    sir = SIR(N = N, S=S, I=I,  R=R,
-              beta=Beta, R0=R0, gamma=Gamma,  t= t_range)
+    sir = Compartments(('S', 'I', 'R'), t_range, N, dtype=dtype, absolute=is_absolute(Y0),
+                       beta=Beta, R0=R0, gamma=Gamma)
+    sir.data[:] = ret.T
 
     return sir
 
@@ -97,20 +117,120 @@ def seir_deriv_time(y, t, M, beta, gamma, sigma):
     return dSdt, dEdt, dIdt
 
 
-def compute_seir(N, Y0, R0, Gamma, Sigma, t_range, ts = [(0, 400)], ms=[1.0]):
-    """Full SEIR run"""
+def seir_jac_time(y, t, M, beta, gamma, sigma):
+    """Jacobian of seir_deriv_time with respect to (S, E, I), for odeint Dfun"""
+    S, E, I = y
+    b = beta * M(t)
+    return np.array([[-b * I,  0.   , -b * S],
+                     [ b * I, -sigma,  b * S],
+                     [ 0.   ,  sigma, -gamma]])
+
+
+def seir_compartments(RES, t_range, N, dtype=np.float64, absolute=False, **params):
+    """SEIR result from the (S, E, I) solution of shape (3, n_t),
+    computing R = 1 - S - E - I (N - S - E - I if absolute) in place"""
+    seir = Compartments(('S', 'E', 'I', 'R'), t_range, N, dtype=dtype, absolute=absolute,
+                        **params)
+    seir.data[:3] = RES
+    S, E, I, R = seir.data
+    np.subtract(N if absolute else 1, S, out=R)
+    R -= E
+    R -= I
+    return seir
+
+
+def compute_seir(N, Y0, R0, Gamma, Sigma, t_range, ts = [(0, 400)], ms=[1.0],
+                 dtype=np.float64):
+    """Full SEIR run, absolute or normalized as the initial conditions Y0"""
 
     Beta      = Gamma * R0
     M = mitigation_function(t_range, ts, ms)
-    RES       = odeint(seir_deriv_time, Y0, t_range, args=(M, Beta, Gamma, Sigma))
-    S, E, I   = RES.T
-    R         = 1 - S - E - I
+    RES       = odeint(seir_deriv_time, Y0, t_range, args=(M, Beta, Gamma, Sigma),
+                       Dfun=seir_jac_time)
 
-    seir      = SEIR(N = N, S=S, I=I, E=E, R=R,
-                     beta=Beta, R0=R0, gamma=Gamma, sigma = Sigma, t= t_range)
+    seir      = seir_compartments(RES.T, t_range, N, dtype=dtype, absolute=is_absolute(Y0),
+                                  beta=Beta, R0=R0, gamma=Gamma, sigma = Sigma)
     return seir
 
 
+def dense_solution(deriv, y0, t_span, args, jac=None, extra_events=()):
+    """Integrates a model (deriv and jac with the odeint signature) keeping
+    the dense output: an OdeSolution that evaluates the state, shape
+    (n_states, n_t), at any time between sol.t_min and sol.t_max.
+    extra_events are terminal events fun(t, y) that stop the run early,
+    in which case sol.t_max < t_span[1].
+    """
+    def fun(t, y):
+        return deriv(y, t, *args)
+
+    opts = {}
+    if jac is not None:
+        opts['jac'] = lambda t, y: jac(y, t, *args)
+    for event in extra_events:
+        event.terminal = True
+
+    RES = solve_ivp(fun, t_span, y0, method='LSODA', dense_output=True,
+                    events=list(extra_events) or None,
+                    rtol=1.49012e-8, atol=1.49012e-8, **opts)
+    return RES.sol
+
+
+def compute_seir_events(N, Y0, R0, Gamma, Sigma, t_range, ts = [(0, 400)], ms=[1.0],
+                        thresholds=(), i_min=1e-8, extra_events=()):
+    """Full SEIR run locating events with the solver root finding:
+    - 'peak'       : maximum of I
+    - 'thresholds' : first upwards crossing of I through each threshold
+                     (None if it does not happen)
+    - 'extinction' : I falling below i_min, which stops the run early
+    extra_events are additional terminal events fun(t, y) that stop the run.
+    The returned SEIR is truncated at the time the run stops.
+    """
+    def fun(t, y):
+        return seir_deriv_time(y, t, M, Beta, Gamma, Sigma)
+
+    def jac(t, y):
+        return seir_jac_time(y, t, M, Beta, Gamma, Sigma)
+
+    def peak(t, y):
+        return fun(t, y)[2]
+    peak.direction = -1
+
+    def extinction(t, y):
+        return y[2] - i_min
+    extinction.terminal  = True
+    extinction.direction = -1
+
+    def crossing(threshold):
+        def _crossing(t, y):
+            return y[2] - threshold
+        _crossing.direction = 1
+        return _crossing
+
+    for event in extra_events:
+        event.terminal = True
+
+    Beta   = Gamma * R0
+    M      = mitigation_function(np.arange(t_range[0], t_range[-1] + 1), ts, ms)
+    levels, index = np.unique(thresholds, return_inverse=True)
+    events = [peak, extinction] + [crossing(l) for l in levels] + list(extra_events)
+    RES    = solve_ivp(fun, (t_range[0], t_range[-1]), Y0, method='LSODA',
+                       t_eval=t_range, events=events, jac=jac,
+                       rtol=1.49012e-8, atol=1.49012e-8)
+
+    def _first(times):
+        return times[0] if len(times) > 0 else None
+
+    t_peaks  = RES.t_events[0]
+    i_peaks  = RES.y_events[0][:, 2] if len(t_peaks) > 0 else []
+    crossed  = [_first(times) for times in RES.t_events[2:2 + len(levels)]]
+    times    = {'peak'       : t_peaks[np.argmax(i_peaks)] if len(t_peaks) > 0 else None,
+                'extinction' : _first(RES.t_events[1]),
+                'thresholds' : [crossed[i] for i in np.ravel(index)]}
+
+    seir = seir_compartments(RES.y, RES.t, N, beta=Beta, R0=R0, gamma=Gamma, sigma = Sigma)
+    return seir, times
+
+
 def seir2_deriv_time(y, t, M, beta, gamma, sigma, phi, g, lamda):
     """
     Prepare differential equations for SEIR
@@ -127,21 +247,290 @@ def seir2_deriv_time(y, t, M, beta, gamma, sigma, phi, g, lamda):
     return dSdt, dEdt, dIdt, dRdt, dDdt, dPdt
 
 
+def seir2_jac_time(y, t, M, beta, gamma, sigma, phi, g, lamda):
+    """Jacobian of seir2_deriv_time with respect to (S, E, I, R, D, P),
+    for odeint Dfun"""
+    S, E, I, R, D, P = y
+    b = beta * M(t)
+    return np.array([[-b * I,  0.   , -b * S            , 0.,  0., 0.    ],
+                     [ b * I, -sigma,  b * S            , 0.,  0., 0.    ],
+                     [ 0.   ,  sigma, -gamma            , 0.,  0., 0.    ],
+                     [ 0.   ,  0.   , (1 - phi) * gamma , 0.,  0., 0.    ],
+                     [ 0.   ,  0.   ,  phi * gamma      , 0., -g , 0.    ],
+                     [ 0.   ,  0.   ,  0.               , 0.,  g , -lamda]])
+
+
 def compute_seir2(N, Y0, R0, Gamma, Sigma, Phi, G, Lamda, k,
-                  t_range, ts = [(0, 400)], ms=[1.0]):
-    """Full SEIR run"""
+                  t_range, ts = [(0, 400)], ms=[1.0], dtype=np.float64):
+    """Full SEIR2 run, absolute or normalized as the initial conditions Y0"""
 
     #Beta           = Gamma * R0 * (1 - P)**k
     Beta           = Gamma * R0
     M              = mitigation_function(t_range, ts, ms)
     RES            = odeint(seir2_deriv_time, Y0, t_range,
-                            args=(M, Beta, Gamma, Sigma, Phi, G, Lamda))
-    S, E, I, R, D, P  = RES.T
-    M              = 1 - S - E - I - R - D
+                            args=(M, Beta, Gamma, Sigma, Phi, G, Lamda),
+                            Dfun=seir2_jac_time)
+
+    absolute  = is_absolute(Y0)
+    seir      = Compartments(('S', 'E', 'I', 'R', 'D', 'P', 'M'), t_range, N, dtype=dtype,
+                             absolute=absolute, beta=Beta, R0=R0, gamma=Gamma, sigma = Sigma,
+                             phi=Phi, g=G, lamda=Lamda, k=k)
+    seir.data[:6] = RES.T
+    M              = seir.M
+    np.subtract(N if absolute else 1, seir.data[:5].sum(axis=0), out=M)
+
+    return seir
+
+
+def mobility_matrix(n, rows, cols, vals):
+    """CSR mobility matrix of n patches from its non zero elements:
+    C[i, j] is the weight of the contacts of people living in patch i with
+    people of patch j. Rows are normalized to 1."""
+    C    = sps.csr_matrix((vals, (rows, cols)), shape=(n, n), dtype=float)
+    norm = np.asarray(C.sum(axis=1)).ravel()
+    norm[norm == 0] = 1
+    return sps.diags(1 / norm) @ C
+
+
+def metapop_seir_deriv(t, y, M, beta, gamma, sigma, C):
+    """
+    Prepare differential equations for a metapopulation SEIR
+    (solve_ivp signature). y = (S, E, I) stacks the fractions of each of
+    the n patches and the force of infection on patch i is
+    beta M(t) sum_j C[i, j] I[j], with C a CSR mobility matrix
+    """
+    n = C.shape[0]
+    S, E, I = y[:n], y[n:2*n], y[2*n:]
+    infections = beta * M(t) * S * (C @ I)
+    dy = np.empty_like(y)
+    dy[:n]    = -infections
+    dy[n:2*n] = infections - sigma * E
+    dy[2*n:]  = sigma * E - gamma * I
+    return dy
+
+
+def metapop_seir_sparsity(C):
+    """Sparsity pattern of the Jacobian of metapop_seir_deriv"""
+    n  = C.shape[0]
+    Id = sps.identity(n, format='csr')
+    Cp = (C != 0).astype(float) + Id
+    return sps.bmat([[Id  , None, Cp],
+                     [Id  , Id  , Cp],
+                     [None, Id  , Id]], format='csr')
+
+
+def compute_metapop_seir(N, Y0, R0, Gamma, Sigma, C, t_range,
+                         ts = [(0, 400)], ms=[1.0], method='RK45',
+                         rtol=1e-6, atol=1e-9, extra_events=()):
+    """Full metapopulation SEIR run.
+    N are the populations of the patches, Y0 = (S0, E0, I0) the initial
+    fractions in each patch and C the mobility matrix. S, E, I, R of the
+    result are arrays of shape (n_patches, n_t).
+    extra_events are terminal events fun(t, y) that stop the run early,
+    the result is then truncated.
+    The epidemic is not stiff and the explicit RK45 is the fastest choice;
+    the implicit methods ('BDF', 'Radau') get the Jacobian sparsity pattern
+    """
+    Beta = Gamma * R0
+    M    = mitigation_function(np.arange(t_range[0], t_range[-1] + 1), ts, ms)
+    y0   = np.concatenate([np.broadcast_to(y, np.shape(N)) for y in Y0]).astype(float)
+    n    = len(N)
+    opts = {}
+    if method in ('BDF', 'Radau'):
+        opts['jac_sparsity'] = metapop_seir_sparsity(C)
+    for event in extra_events:
+        event.terminal = True
+    # the arguments are bound here: solve_ivp would pass args to the events too
+    def fun(t, y):
+        return metapop_seir_deriv(t, y, M, Beta, Gamma, Sigma, C)
+    RES  = solve_ivp(fun, (t_range[0], t_range[-1]), y0,
+                     method=method, t_eval=t_range, rtol=rtol, atol=atol,
+                     events=list(extra_events) or None, **opts)
+    S, E, I = RES.y[:n], RES.y[n:2*n], RES.y[2*n:]
+    R       = 1 - S - E - I
+
+    seir    = SEIR(N = np.asarray(N), S=S, I=I, E=E, R=R,
+                   beta=Beta, R0=R0, gamma=Gamma, sigma = Sigma, t= RES.t)
+    return seir
 
-    seir      = SEIR2(N = N, S=S, I=I, E=E, R=R, D=D, M=M, P=P,
-                     beta=Beta, R0=R0, gamma=Gamma, sigma = Sigma,
-                     phi=Phi, g=G, lamda=Lamda, k=k,
-                     t= t_range)
 
+def age_seir_deriv(y, t, M, beta, gamma, sigma, K):
+    """
+    Prepare differential equations for an age structured SEIR.
+    y = (S, E, I) stacks the fractions of each of the n_age groups and
+    the force of infection on group a is beta M(t) sum_b K[a, b] I[b],
+    with K the (n_age, n_age) contact matrix
+    """
+    S, E, I = y.reshape(3, -1)
+    infections = beta * M(t) * S * (K @ I)
+    dSdt = -infections
+    dEdt = infections - sigma * E
+    dIdt = sigma * E - gamma * I
+    return np.concatenate((dSdt, dEdt, dIdt))
+
+
+def compute_age_seir(N, Y0, R0, Gamma, Sigma, K, t_range, ts = [(0, 400)], ms=[1.0],
+                     extra_events=()):
+    """Full age structured SEIR run.
+    N are the populations of the age groups, Y0 = (S0, E0, I0) the initial
+    fractions in each group and K the contact matrix, scaled so that its
+    dominant eigenvalue is 1 and R0 keeps its meaning. S, E, I, R of the
+    result are arrays of shape (n_age, n_t).
+    extra_events are terminal events fun(t, y) that stop the run early,
+    the result is then truncated.
+    """
+    K       = np.asarray(K, dtype=float)
+    K       = K / np.max(np.abs(np.linalg.eigvals(K)))
+    Beta    = Gamma * R0
+    M       = mitigation_function(np.arange(t_range[0], t_range[-1] + 1), ts, ms)
+    y0      = np.concatenate([np.broadcast_to(y, np.shape(N)) for y in Y0]).astype(float)
+
+    def fun(t, y):
+        return age_seir_deriv(y, t, M, Beta, Gamma, Sigma, K)
+
+    for event in extra_events:
+        event.terminal = True
+    RES     = solve_ivp(fun, (t_range[0], t_range[-1]), y0, method='LSODA',
+                        t_eval=t_range, events=list(extra_events) or None,
+                        rtol=1.49012e-8, atol=1.49012e-8)
+    S, E, I = RES.y.reshape(3, len(N), -1)
+    R       = 1 - S - E - I
+
+    seir    = SEIR(N = np.asarray(N), S=S, I=I, E=E, R=R,
+                   beta=Beta, R0=R0, gamma=Gamma, sigma = Sigma, t= RES.t)
     return seir
+
+
+def compute_age_seir_events(N, Y0, R0, Gamma, Sigma, K, t_range, ts = [(0, 400)], ms=[1.0],
+                            weights=None, thresholds=(), i_min=1e-8, extra_events=()):
+    """Age structured version of compute_seir_events (see compute_age_seir).
+    The peak and the threshold crossings are located on weights @ I, the
+    infected fractions of the age groups weighted, by default, with the
+    fraction of the population in each group. The run stops at the
+    extinction, when the infected fraction of the whole population falls
+    below i_min.
+    Returns the age structured SEIR and the times of the events.
+    """
+    K       = np.asarray(K, dtype=float)
+    K       = K / np.max(np.abs(np.linalg.eigvals(K)))
+    N       = np.asarray(N, dtype=float)
+    n_age   = len(N)
+    Beta    = Gamma * R0
+    M       = mitigation_function(np.arange(t_range[0], t_range[-1] + 1), ts, ms)
+    y0      = np.concatenate([np.broadcast_to(y, np.shape(N)) for y in Y0]).astype(float)
+    shares  = N / N.sum()
+    weights = shares if weights is None else np.asarray(weights, dtype=float)
+
+    def fun(t, y):
+        return age_seir_deriv(y, t, M, Beta, Gamma, Sigma, K)
+
+    def peak(t, y):
+        return weights @ fun(t, y)[2 * n_age:]
+    peak.direction = -1
+
+    def extinction(t, y):
+        return shares @ y[2 * n_age:] - i_min
+    extinction.terminal  = True
+    extinction.direction = -1
+
+    def crossing(threshold):
+        def _crossing(t, y):
+            return weights @ y[2 * n_age:] - threshold
+        _crossing.direction = 1
+        return _crossing
+
+    for event in extra_events:
+        event.terminal = True
+
+    levels, index = np.unique(thresholds, return_inverse=True)
+    events = [peak, extinction] + [crossing(l) for l in levels] + list(extra_events)
+    RES     = solve_ivp(fun, (t_range[0], t_range[-1]), y0, method='LSODA',
+                        t_eval=t_range, events=events,
+                        rtol=1.49012e-8, atol=1.49012e-8)
+
+    def _first(times):
+        return times[0] if len(times) > 0 else None
+
+    t_peaks  = RES.t_events[0]
+    i_peaks  = RES.y_events[0][:, 2 * n_age:] @ weights if len(t_peaks) > 0 else []
+    crossed  = [_first(times) for times in RES.t_events[2:2 + len(levels)]]
+    times    = {'peak'       : t_peaks[np.argmax(i_peaks)] if len(t_peaks) > 0 else None,
+                'extinction' : _first(RES.t_events[1]),
+                'thresholds' : [crossed[i] for i in np.ravel(index)]}
+
+    S, E, I = RES.y.reshape(3, n_age, -1)
+    R       = 1 - S - E - I
+    seir    = SEIR(N = N, S=S, I=I, E=E, R=R,
+                   beta=Beta, R0=R0, gamma=Gamma, sigma = Sigma, t= RES.t)
+    return seir, times
+
+
+def sir_final_size(R0, s0=1.):
+    """Fraction of the population infected by the end of an unmitigated
+    SIR/SEIR epidemic (recovered at t -> inf, with r0 = 0).
+    It solves log(s_inf/s0) = -R0 (1 - s_inf), which reduces to
+    z = 1 - exp(-R0 z) for s0 -> 1, using the Lambert W function.
+    """
+    s_inf = -lambertw(-R0 * s0 * np.exp(-R0)).real / R0
+    return 1 - s_inf
+
+
+def sir_peak(R0, s0, i0):
+    """Peak fraction of infected of an unmitigated SIR, reached when S = 1/R0.
+    Uses the invariant I + S - log(S)/R0 = const.
+    Returns the peak of I and S at the peak.
+    """
+    if R0 * s0 <= 1:
+        return i0, s0
+    return i0 + s0 - (1 + np.log(R0 * s0)) / R0, 1 / R0
+
+
+def sir_peak_time(beta, gamma, s0, i0):
+    """Day of the peak of an unmitigated SIR, integrating dt = -dS/(beta S I)
+    along the orbit I(S) = i0 + s0 - S + log(S/s0) gamma/beta."""
+    R0 = beta / gamma
+    if R0 * s0 <= 1:
+        return 0.
+    def _dt(S):
+        I = i0 + s0 - S + np.log(S / s0) / R0
+        return 1 / (beta * S * I)
+    t, _ = quad(_dt, 1 / R0, s0)
+    return t
+
+
+def epidemic_summary_ivp(deriv, y0, args, i_index, t_max=3650, i_min=1e-8,
+                         stop_at_peak=False, extra_events=()):
+    """Integrates a model (deriv with the odeint signature) locating the
+    peak of infected with an event and stopping when I falls below i_min
+    (or at the peak if stop_at_peak).
+    extra_events are additional terminal events fun(t, y) that stop the run.
+    Returns the peak of I, the time of the peak, the final state and time,
+    and whether one of the extra events stopped the run.
+    """
+    def fun(t, y):
+        return deriv(y, t, *args)
+
+    def peak(t, y):
+        return fun(t, y)[i_index]
+    peak.terminal  = stop_at_peak
+    peak.direction = -1
+
+    def extinction(t, y):
+        return y[i_index] - i_min
+    extinction.terminal  = True
+    extinction.direction = -1
+
+    for event in extra_events:
+        event.terminal = True
+
+    sol = solve_ivp(fun, (0, t_max), y0, method='LSODA',
+                    events=[peak, extinction] + list(extra_events), rtol=1e-8, atol=1e-12)
+
+    if len(sol.t_events[0]) > 0:
+        k      = np.argmax(sol.y_events[0][:, i_index])
+        tp, Ip = sol.t_events[0][k], sol.y_events[0][k, i_index]
+    else:
+        tp, Ip = 0., y0[i_index]
+
+    stopped = any(len(times) > 0 for times in sol.t_events[2:])
+    return Ip, tp, sol.y[:, -1], sol.t[-1], stopped
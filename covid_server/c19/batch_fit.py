@@ -0,0 +1,142 @@
+"""
+Fits of a stack of series, shape (n_series, n_x), with one set of parameters
+per series. Linearizable models are solved in closed form by weighted least
+squares on the logs; the rest by a Levenberg-Marquardt that iterates all the
+series at once (the normal equations are a stack of n_par x n_par systems).
+Points outside the fit range of a series, or with nan data, have weight 0.
+"""
+import numpy as np
+import scipy.stats
+
+from . core_functions import in_range
+
+
+def fit_mask(xs, ys, fit_range=None):
+    """points used in the fit: finite data in fit_range, a common (lo, hi)
+    or one per series, shape (n_series, 2). Ranges are [lo, hi)"""
+    mask = np.isfinite(ys)
+    if fit_range is None:
+        return mask
+    lo, hi = np.asarray(fit_range, dtype=float).T
+    return mask & in_range(xs, np.asarray(lo)[..., np.newaxis], np.asarray(hi)[..., np.newaxis])
+
+
+def _weights(ys, mask, sigma):
+    """1/sigma**2 where mask, 0 elsewhere"""
+    sigma = np.ones_like(ys) if sigma is None else np.broadcast_to(sigma, ys.shape)
+    if np.any(sigma[mask] <= 0):
+        raise ValueError("Zero or negative value found in argument sigma. "
+                         "Errors must be greater than 0.")
+    return np.where(mask, 1 / np.where(mask, sigma, 1)**2, 0.)
+
+
+def chi2_batch(ys, yfit, mask, npar, sigma=None):
+    """reduced chi2 and p-value of each series (nan with no degrees of freedom)"""
+    w    = _weights(ys, mask, sigma)
+    chi2 = np.sum(w * np.where(mask, ys - yfit, 0)**2, axis=-1)
+    ndof = mask.sum(axis=-1) - npar
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (np.where(ndof > 0, chi2 / ndof, np.nan),
+                np.where(ndof > 0, scipy.stats.chi2.sf(chi2, ndof), np.nan))
+
+
+def loglinear_batch(us, ys, mask, sigma=None):
+    """closed form fit of log(y) = a + b u for each series.
+    The weights of the logs are (y / sigma)**2 and points with y <= 0 are
+    dropped. Without sigma the covariance is scaled by the residual
+    variance, as curve_fit with absolute_sigma=False.
+    Returns the parameters (n_series, 2) and their covariance (n_series, 2, 2)"""
+    mask = mask & (ys > 0)
+    w    = _weights(ys, mask, sigma) * np.where(mask, ys, 0)**2
+    us   = np.where(mask, np.broadcast_to(us, ys.shape), 0)
+    vs   = np.log(np.where(mask, ys, 1))
+
+    s0, su, sv   = w.sum(-1), (w * us).sum(-1), (w * vs).sum(-1)
+    suu, suv     = (w * us * us).sum(-1), (w * us * vs).sum(-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        det  = s0 * suu - su * su
+        b    = (s0 * suv - su * sv) / det
+        a    = (suu * sv - su * suv) / det
+        cov  = np.stack([np.stack([suu, -su], -1), np.stack([-su, s0], -1)], -2) / det[:, None, None]
+        if sigma is None:
+            res2  = np.sum(w * (vs - a[:, None] - b[:, None] * us)**2, axis=-1)
+            cov  *= (res2 / (mask.sum(-1) - 2))[:, None, None]
+    return np.stack([a, b], -1), cov
+
+
+def _jacobian(func, xs, pars, mask):
+    """forward differences of func in the points of mask, shape (n_series, n_x, n_par)"""
+    f0  = func(xs, *pars.T[..., np.newaxis])
+    jac = np.empty(xs.shape + (pars.shape[-1],))
+    for k in range(pars.shape[-1]):
+        h            = 1.49e-8 * np.where(pars[:, k] != 0, np.abs(pars[:, k]), 1)
+        dpars        = pars.copy()
+        dpars[:, k] += h
+        jac[..., k]  = (func(xs, *dpars.T[..., np.newaxis]) - f0) / h[:, np.newaxis]
+    return np.where(mask[..., np.newaxis] & np.isfinite(jac), jac, 0)
+
+
+def lm_batch(func, xs, ys, p0, mask, sigma=None, max_iter=200, ftol=1e-10, xtol=1e-10,
+             lam0=1e-3):
+    """Levenberg-Marquardt fit of func(x, *par) to each series. func must
+    broadcast parameters of shape (n_series, 1) against xs (n_series, n_x).
+    Series whose steps give nan residuals reject those steps.
+    Returns the parameters (n_series, n_par), their covariance (scaled by
+    the residual variance without sigma) and the convergence flags"""
+    xs    = np.broadcast_to(xs, ys.shape)
+    w     = _weights(ys, mask, sigma)
+    ys    = np.where(mask, ys, 0)
+    pars  = np.array(np.broadcast_to(p0, (len(ys), np.size(p0, -1))), dtype=float)
+    npar  = pars.shape[-1]
+
+    def residuals(pars, i):
+        return np.where(mask[i], ys[i] - func(xs[i], *pars.T[..., np.newaxis]), 0)
+
+    def costs(res, i):
+        return np.sum(w[i] * res * res, axis=-1)
+
+    every  = np.arange(len(ys))
+    res    = residuals(pars, every)
+    cost   = costs(res, every)
+    lam    = np.full(len(ys), lam0)
+    failed = ~np.isfinite(cost)
+    done   = failed.copy()
+    diag   = np.arange(npar)
+    for _ in range(max_iter):
+        # only the series still running are iterated
+        i = np.flatnonzero(~done)
+        if len(i) == 0:
+            break
+        with np.errstate(all='ignore'):
+            jac = _jacobian(func, xs[i], pars[i], mask[i])
+        wjac  = w[i, :, np.newaxis] * jac
+        A     = np.einsum('snk,snl->skl', wjac, jac)
+        g     = np.einsum('snk,sn->sk', wjac, res[i])
+        A[:, diag, diag] += lam[i, None] * np.maximum(A[:, diag, diag], 1e-30)
+        try:
+            step = np.linalg.solve(A, g[..., np.newaxis])[..., 0]
+        except np.linalg.LinAlgError:
+            step = (np.linalg.pinv(A) @ g[..., np.newaxis])[..., 0]
+
+        with np.errstate(all='ignore'):
+            new_res  = residuals(pars[i] + step, i)
+            new_cost = costs(new_res, i)
+        better = new_cost <= cost[i]
+        small  = np.all(np.abs(step) <= xtol * (np.abs(pars[i]) + xtol), axis=-1)
+        conv   = (better & (cost[i] - new_cost <= ftol * cost[i])) | small
+
+        j        = i[better]
+        pars[j] += step[better]
+        res [j]  = new_res [better]
+        cost[j]  = new_cost[better]
+        lam [i]  = np.where(better, lam[i] / 10, lam[i] * 10)
+        done[i]  = conv | (lam[i] > 1e16)
+
+    with np.errstate(all='ignore'):
+        jac = _jacobian(func, xs, pars, mask)
+    A   = np.einsum('snk,snl->skl', w[..., np.newaxis] * jac, jac)
+    cov = np.linalg.pinv(A)
+    if sigma is None:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cov *= (cost / (mask.sum(-1) - npar))[:, None, None]
+    return pars, cov, done & ~failed & (lam <= 1e16)
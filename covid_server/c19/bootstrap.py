@@ -0,0 +1,123 @@
+import numpy as np
+from collections        import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from . types import Bootstrap
+
+
+class QuantileAccumulator:
+    """Streaming quantiles of curves, shape (n_curves, n_t), from a histogram
+    of n_bins per point of the curve. The range of each point is taken from
+    the first update, widened by its spread on each side. When later values
+    fall outside, the range of that point is doubled (merging pairs of bins)
+    until they fit, so no value is clipped; only the bin width grows.
+    Non finite values are ignored. Memory does not grow with the number of
+    curves."""
+
+    def __init__(self, n_t, n_bins=1000):
+        self.n_t    = n_t
+        self.n_bins = n_bins + n_bins % 2   # even, to merge pairs of bins
+        self.lo     = None
+        self.dx     = None
+        self.counts = np.zeros((n_t, self.n_bins), dtype=np.int64)
+        self.sum    = np.zeros(n_t)
+        self.n      = np.zeros(n_t, dtype=np.int64)
+
+    def _double(self, left, right):
+        """doubles the range of the points left (downwards) and right (upwards)"""
+        rows  = left | right
+        half  = self.n_bins // 2
+        pairs = self.counts[rows].reshape(-1, half, 2).sum(axis=2)
+        grown = np.zeros((len(pairs), self.n_bins), dtype=np.int64)
+        down  = left[rows]
+        grown[~down, :half] = pairs[~down]
+        grown[ down, half:] = pairs[ down]
+        self.counts[rows] = grown
+        self.lo[left]    -= self.n_bins * self.dx[left]
+        self.dx[rows]    *= 2
+
+    def update(self, curves):
+        curves = np.atleast_2d(curves)
+        finite = np.isfinite(curves)
+        if self.lo is None:
+            lo, hi  = np.nanmin(np.where(finite, curves, np.nan), axis=0), \
+                      np.nanmax(np.where(finite, curves, np.nan), axis=0)
+            lo, hi  = np.nan_to_num(lo), np.nan_to_num(hi)
+            width   = np.where(hi > lo, hi - lo, np.maximum(np.abs(hi), 1) * 1e-3)
+            self.lo = lo - width
+            self.dx = 3 * width / self.n_bins
+
+        values = np.where(finite, curves, self.lo)
+        while True:
+            left  = np.any(values <  self.lo, axis=0)
+            right = np.any(values >= self.lo + self.n_bins * self.dx, axis=0)
+            if not np.any(left | right):
+                break
+            self._double(left, right & ~left)
+
+        bins  = np.floor((values - self.lo) / self.dx).astype(np.int64)
+        bins  = np.clip(bins, 0, self.n_bins - 1)   # rounding at the upper edge
+        flat  = (bins + np.arange(self.n_t) * self.n_bins)[finite]
+        self.counts += np.bincount(flat, minlength=self.counts.size).reshape(self.counts.shape)
+        self.sum    += np.where(finite, curves, 0).sum(axis=0)
+        self.n      += finite.sum(axis=0)
+
+    def quantiles(self, qs):
+        """quantiles qs of each point, shape (len(qs), n_t), interpolated in the bins"""
+        cum  = np.cumsum(self.counts, axis=1)
+        rows = np.arange(self.n_t)
+        out  = np.empty((len(qs), self.n_t))
+        for i, q in enumerate(qs):
+            target = q * self.n
+            k      = np.argmax(cum >= target[:, np.newaxis], axis=1)
+            below  = np.where(k > 0, cum[rows, k - 1], 0)
+            frac   = (target - below) / np.maximum(self.counts[rows, k], 1)
+            out[i] = self.lo + (k + frac) * self.dx
+        return out
+
+    def mean(self):
+        return self.sum / self.n
+
+
+def _refit_chunk(refit, curve, ys, start):
+    pars   = np.array([refit(y, start) for y in ys])
+    curves = np.array([curve(y, p) for y, p in zip(ys, pars)])
+    return pars, curves
+
+
+def bootstrap(refit, curve, samples, nominal, t, quantiles=(0.025, 0.16, 0.5, 0.84, 0.975),
+              n_workers=1, chunk_size=50, n_bins=1000):
+    """
+    Refits the resampled series samples, shape (n_boot, n), starting from the
+    nominal parameters, and aggregates percentile bands of the fitted curves.
+
+    refit(y, start) returns the parameters of the fit of series y and
+    curve(y, pars) the fitted curve at the points t. With n_workers > 1 the
+    chunks of chunk_size replicates run in a process pool (refit and curve
+    must be picklable, e.g. functools.partial of module functions); only
+    2 * n_workers chunks of curves are in memory at any time.
+
+    Returns a Bootstrap with the parameters of every replicate and the bands
+    """
+    acc    = QuantileAccumulator(len(t), n_bins)
+    chunks = [samples[i:i + chunk_size] for i in range(0, len(samples), chunk_size)]
+    pars   = [None] * len(chunks)
+
+    if n_workers == 1:
+        for i, ys in enumerate(chunks):
+            pars[i], curves = _refit_chunk(refit, curve, ys, nominal)
+            acc.update(curves)
+    else:
+        # the chunks are collected in order, so that the bands do not depend
+        # on the scheduling
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            pending = deque()
+            for i, ys in enumerate(chunks):
+                pending.append((i, pool.submit(_refit_chunk, refit, curve, ys, nominal)))
+                while len(pending) >= 2 * n_workers or (pending and i == len(chunks) - 1):
+                    j, future = pending.popleft()
+                    pars[j], curves = future.result()
+                    acc.update(curves)
+
+    return Bootstrap(t, np.asarray(nominal), np.concatenate(pars), np.asarray(quantiles),
+                     acc.quantiles(quantiles), acc.mean())
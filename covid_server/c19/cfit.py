@@ -41,13 +41,17 @@ def _array_par_mask(par, mask = None):
     return par, mask
 
 
-def mle(x, llike, par, mask = None):
+def mle(x, llike, par, mask = None, method = 'Nelder-Mead', grad = None, **kwargs):
     """ compute maximum likelihood estimate
     parameters:
         x    : np.array      ,   rvs
         llike: callable      ,   logpdf function, that takes x (rvs) and parameters (np.array)
         par  : np.array      ,   pdf parameters
         mask : np.array(book),   mask = fix parameters of par during the fit
+        method: str          ,   method of scipy.optimize.minimize
+        grad : callable      ,   gradient of sum(llike(x, *par)) with respect to par,
+                                 for the gradient based methods
+        kwargs:              ,   other arguments of minimize (options, bounds...)
     """
     #print('mle par, size', par, par.size, mask)
     par, mask = _array_par_mask(par, mask)
@@ -58,15 +62,17 @@ def mle(x, llike, par, mask = None):
         ms = _setpar(par, ps, mask)
         #print('xs, ms ', x, *ms)
         return np.sum(-2. * llike(x, *ms))
-    result = optimize.minimize(_mll, ps, method='Nelder-Mead')
+    if grad is not None:
+        kwargs['jac'] = lambda ps: -2. * _par(np.asarray(grad(x, *_setpar(par, ps, mask))), mask)
+    result = optimize.minimize(_mll, ps, method=method, **kwargs)
     if (not result.success): print('mle: warning')
     #print('mle ', result)
     return result.x
 
-def parbest(x, llike, par, mask = None):
+def parbest(x, llike, par, mask = None, **kwargs):
     par, mask = _array_par_mask(par, mask)
     if (type(par) is tuple): par = np.array(par)
-    muhat  = mle(x, llike, par, mask = mask)
+    muhat  = mle(x, llike, par, mask = mask, **kwargs)
     pbest  = _setpar(par, muhat, mask)
     #print('parbest ', pbest);{value for value in variable}
     return pbest
@@ -102,6 +108,80 @@ def qmu_pvalue(qmu):
 def q0_pvalue(q0):
     return qmu_pvalue(q0)
 
+class profile:
+    """ profile likelihood of the parameter mu (maskmu) of par, with the
+    nuisance parameters masknu, for the data x.
+    The global best fit is computed once and the conditional fits at each mu
+    are memoized, each one starting from the fit at the nearest mu.
+    """
+
+    def __init__(self, x, llike, par, maskmu, masknu = None):
+        par, maskmu  = _array_par_mask(par, maskmu)
+        masknu       = np.zeros(par.size, dtype = bool) if masknu is None else np.array(masknu, dtype = bool)
+        self.x       = x
+        self.llike   = llike
+        self.maskmu  = maskmu
+        self.masknu  = masknu
+        self.parbest = parbest(x, llike, par, mask = maskmu | masknu)
+        self.mubest  = float(self.parbest[maskmu][0])
+        self.lbest   = np.sum(llike(x, *self.parbest))
+        self.fits    = {self.mubest: self.parbest}
+
+    def parmubest(self, mu):
+        """ best parameters with mu fixed (memoized) """
+        mu = float(mu)
+        if mu not in self.fits:
+            near = min(self.fits, key = lambda m: abs(m - mu))
+            par  = _setpar(self.fits[near], mu, self.maskmu)
+            if np.any(self.masknu):
+                par = _setpar(par, mle(self.x, self.llike, par, self.masknu), self.masknu)
+            self.fits[mu] = par
+        return self.fits[mu]
+
+    def tmu(self, mu):
+        return 2. * (self.lbest - np.sum(self.llike(self.x, *self.parmubest(mu))))
+
+    def scan(self, mus):
+        """ tmu at each of mus. Without nuisance parameters the likelihood is
+        evaluated for all mus at once (llike must broadcast its parameters),
+        otherwise the conditional fits run outwards from the best fit """
+        mus = np.asarray(mus, dtype = float)
+        if not np.any(self.masknu):
+            pars = np.tile(self.parbest, (len(mus), 1))
+            pars[:, self.maskmu] = mus[:, np.newaxis]
+            x    = np.asarray(self.x)[np.newaxis, :]
+            ls   = np.sum(self.llike(x, *pars.T[:, :, np.newaxis]), axis = 1)
+            return 2. * (self.lbest - ls)
+        order = np.argsort(np.abs(mus - self.mubest))
+        ts    = np.empty(len(mus))
+        for i in order:
+            ts[i] = self.tmu(mus[i])
+        return ts
+
+    def cint(self, beta = 0.68, step = None, n_scan = 8, max_expand = 10, xtol = 1e-6):
+        """ confidence interval of mu with confidence level beta from
+        tmu = chi2(1).ppf(beta). Each side is bracketed with a coarse scan of
+        n_scan points over step (doubled until tmu crosses), then refined
+        with brentq. Returns (lower, upper), infinite if not bracketed """
+        tcrit = stats.chi2(1).ppf(beta)
+        step  = step if step is not None else 0.1 * abs(self.mubest) or 0.1
+        cint  = []
+        for sign in (-1, 1):
+            h = step
+            for i in range(max_expand):
+                mus   = self.mubest + sign * h * np.arange(1, n_scan + 1) / n_scan
+                above = np.nonzero(self.scan(mus) >= tcrit)[0]
+                if len(above): break
+                h *= 2
+            else:
+                cint.append(sign * np.inf)
+                continue
+            k  = above[0]
+            lo = self.mubest if k == 0 else mus[k - 1]
+            cint.append(optimize.brentq(lambda mu: self.tmu(mu) - tcrit, lo, mus[k], xtol = xtol))
+        return np.array(cint)
+
+# working, vectorized versions of htsimple and htcomposite are in c19.htests
 #
 # class htsimple:
 #
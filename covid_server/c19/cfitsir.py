@@ -1,10 +1,14 @@
+from collections import OrderedDict
+from functools   import partial
+
 import numpy       as np
 import scipy.stats as stats
 from scipy.integrate import odeint
 
-from   c19.types import SIR
+from   c19.types import SIR, SEIR
 import c19.basic_models as cbm
 import c19.cfit         as cfit
+import c19.bootstrap    as cboot
 from numpy.linalg import inv
 
 
@@ -24,18 +28,67 @@ beta0 = R0 * gamma0
 # alpha = (R0-1) * gamma
 
 def _binedges(ts):
+    ts = np.asarray(ts, dtype = float)
     dt = 0.5*(ts[-1] - ts[-2])
-    tbins = np.array([ts[i] - 0.5*(ts[i+1] - ts[i]) for i in range(len(ts)-1)] + [ts[-1] - dt, ts[-1] +dt])
-    #print(len(tbins))
+    tbins = np.concatenate((ts[:-1] - 0.5*np.diff(ts), (ts[-1] - dt, ts[-1] + dt)))
     return tbins
 
 def sir(N, beta, gamma, y0 = y0, ts = ts):
     #N, beta, gamma = sir_constrains(N, beta, gamma)
-    ret = odeint(cbm.sir_deriv, y0, ts, args=(N, beta, gamma))
+    # populations are absolute: the contact term is beta * S * I / N
+    M   = lambda t: 1./N
+    ret = odeint(cbm.sir_deriv, y0, ts, args=(M, beta, gamma), Dfun=cbm.sir_jac)
     S, I, R = ret.T
-    sir = SIR(N, S, I, R, ts, R0, beta, gamma)
+    sir = SIR(N, S, I, R, ts, beta/gamma, beta, gamma)
     return sir
 
+def seir(N, beta, gamma, sigma, y0 = y0, ts = ts):
+    """ SEIR with absolute populations, y0 = (S, E, I) """
+    M   = lambda t: 1./N
+    ret = odeint(cbm.seir_deriv_time, y0, ts, args=(M, beta, gamma, sigma),
+                 Dfun=cbm.seir_jac_time)
+    S, E, I = ret.T
+    R = N - S - E - I
+    seir = SEIR(N, S, I, R, ts, beta/gamma, beta, gamma, E, sigma)
+    return seir
+
+#---- Forward sensitivities: derivatives of the solution with the parameters
+
+def _sir_dfdp(y, N, beta, gamma):
+    """ derivative of sir_deriv (absolute populations) with (beta, gamma) """
+    S, I, R = y
+    return np.array([[-S * I / N,  0.],
+                     [ S * I / N, -I ],
+                     [ 0.       ,  I ]])
+
+def _seir_dfdp(y, N, beta, gamma, sigma):
+    """ derivative of seir_deriv_time (absolute populations) with (beta, gamma, sigma) """
+    S, E, I = y
+    return np.array([[-S * I / N,  0., 0.],
+                     [ S * I / N,  0., -E],
+                     [ 0.       , -I ,  E]])
+
+def sensitivities(deriv, jac, dfdp, N, pars, y0 = y0, ts = ts):
+    """ integrates a model with absolute populations (deriv and jac with the
+    odeint signature of c19.basic_models and M = 1/N) together with its
+    forward sensitivity equations, ds/dt = J s + df/dp, s(0) = 0.
+    Returns the solution, shape (n_t, n), and the sensitivities dy/dp,
+    shape (n_t, n, n_pars)
+    """
+    n, npar = len(y0), len(pars)
+    M = lambda t: 1./N
+
+    def _deriv(Y, t):
+        y  = Y[:n]
+        sp = Y[n:].reshape(n, npar)
+        dy = deriv(y, t, M, *pars)
+        ds = jac(y, t, M, *pars) @ sp + dfdp(y, N, *pars)
+        return np.concatenate((dy, ds.ravel()))
+
+    Y0  = np.concatenate((np.asarray(y0, dtype = float), np.zeros(n * npar)))
+    ret = odeint(_deriv, Y0, ts)
+    return ret[:, :n], ret[:, n:].reshape(-1, n, npar)
+
 def sir_rv(sir):
     tbins  = _binedges(sir.t)
     irv = stats.rv_histogram((sir.I, tbins))
@@ -53,8 +106,168 @@ def sir_fun(times, N, beta, gamma, y0 = y0, ts = ts):
     nn   = float(np.sum(isir.I)) * dt
     return nn * irv.pdf(times)
 
+class SIRLikelihood:
+    """ Log-likelihood of infection times for a SIR model, for cfit.mle:
+    llike(times, N, beta, gamma) is the logpdf of times for the histogram of
+    I(t), equal to sir_llike, but
+        the bin edges of ts are computed once,
+        the solves are memoized by (N, beta, gamma) in a small LRU cache,
+        the logpdf is a lookup with np.searchsorted on the bin edges.
+    """
+    model   = staticmethod(sir)
+    deriv   = staticmethod(cbm.sir_deriv)
+    jac     = staticmethod(cbm.sir_jac)
+    dfdp    = staticmethod(_sir_dfdp)
+    i_index = 1
+
+    def __init__(self, ts = ts, y0 = y0, cache_size = 32, sensitivities = False):
+        """ with sensitivities the solves include the forward sensitivity
+        equations, so that grad() is available without solving again """
+        self.ts         = np.asarray(ts, dtype = float)
+        self.y0         = y0
+        self.sensitivities = sensitivities
+        self.tbins      = _binedges(self.ts)
+        self.widths     = np.diff(self.tbins)
+        self.cache_size = cache_size
+        self.cache      = OrderedDict()
+        self.nsolves    = 0
+
+    def _hist(self, *pars):
+        """ (log pdf, pdf, number of infected) of the histogram of I(t).
+        The pdf is padded with zeros below and above the bins """
+        key = tuple(float(par) for par in pars)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        dI = None
+        if self.sensitivities:
+            N, mpars = pars[0], pars[1:]
+            ret, sp  = sensitivities(self.deriv, self.jac, self.dfdp, N, mpars, self.y0, self.ts)
+            I, dI    = ret[:, self.i_index], sp[:, self.i_index].T
+        else:
+            I    = self.model(*pars, self.y0, self.ts).I
+        pdf  = np.concatenate(((0.,), I / np.sum(I * self.widths), (0.,)))
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            lpdf = np.log(pdf)
+        nn   = float(np.sum(I)) * (self.ts[1] - self.ts[0])
+        self.nsolves += 1
+
+        self.cache[key] = lpdf, pdf, nn, I, dI
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last = False)
+        return self.cache[key]
+
+    def _bins(self, times):
+        return np.searchsorted(self.tbins, times, side = 'right')
+
+    def __call__(self, times, *pars):
+        lpdf = self._hist(*pars)[0]
+        return lpdf[self._bins(times)]
+
+    logpdf = __call__
+
+    def fun(self, times, *pars):
+        """ same as sir_fun """
+        _, pdf, nn = self._hist(*pars)[:3]
+        return nn * pdf[self._bins(times)]
+
+    def grad(self, times, *pars, weights = 1.):
+        """ gradient of sum(weights * logpdf(times)) with respect to (N, *pars),
+        from the forward sensitivities (needs sensitivities = True).
+        The derivative with N is not computed (0): N must be fixed in fits.
+        The times must be inside the bins """
+        _, _, _, I, dI = self._hist(*pars)
+        k     = self._bins(times) - 1
+        norm  = np.sum(I * self.widths)
+        dlpdf = dI[:, k] / I[k] - (dI @ self.widths)[:, None] / norm
+        return np.concatenate(((0.,), np.sum(weights * dlpdf, axis = 1)))
+
+
+class SEIRLikelihood(SIRLikelihood):
+    """ SIRLikelihood for a SEIR model: llike(times, N, beta, gamma, sigma),
+    with y0 = (S, E, I) """
+    model   = staticmethod(seir)
+    deriv   = staticmethod(cbm.seir_deriv_time)
+    jac     = staticmethod(cbm.seir_jac_time)
+    dfdp    = staticmethod(_seir_dfdp)
+    i_index = 2
+
 #--- MLike tools
 
+def _series_y0(I, N, kind = 'SIR'):
+    """ initial conditions of the fits of a series: I[0] infected (at least 1),
+    and as many exposed for SEIR """
+    i0 = max(I[0], 1.)
+    return (N - i0, i0, 0) if kind == 'SIR' else (N - 2 * i0, i0, i0)
+
+def fit_series(t, I, N, par0, kind = 'SIR', gradient = False, **kwargs):
+    """ Maximum likelihood fit of (beta, gamma) for SIR, or (beta, gamma, sigma)
+    for SEIR, to the infected counts I at days t of a population N, starting
+    from par0. The log likelihood of each day is weighted by its counts.
+    With gradient the fit is a bounded L-BFGS-B driven by the exact gradient
+    of the forward sensitivities, otherwise Nelder-Mead.
+    kwargs are passed to cfit.parbest (method, options...).
+    Returns the best parameters and the number of model solves
+    """
+    I     = np.asarray(I, dtype = float)
+    Like  = SIRLikelihood if kind == 'SIR' else SEIRLikelihood
+    llike = Like(t, _series_y0(I, N, kind), sensitivities = gradient)
+
+    weighted = lambda x, *pars: I * llike(x, *pars)
+    if gradient:
+        kwargs.setdefault('method', 'L-BFGS-B')
+        kwargs.setdefault('bounds', [(1e-6, None)] * len(par0))
+        # the log likelihood scales with the counts: stop on absolute changes
+        kwargs.setdefault('options', {'ftol': 1e-12})
+        kwargs['grad'] = lambda x, *pars: llike.grad(x, *pars, weights = I)
+
+    par   = (N,) + tuple(par0)
+    mask  = (False,) + (True,) * len(par0)
+    pbest = cfit.parbest(t, weighted, par, mask, **kwargs)
+    return pbest[1:], llike.nsolves
+
+
+def r0_cint(t, I, N, par0, kind = 'SIR', beta = 0.68, **kwargs):
+    """ profile likelihood confidence interval of R0 = beta/gamma, with the
+    other rates as nuisance parameters, for the infected counts I at days t
+    of a population N. par0 are the starting (beta, gamma[, sigma]).
+    kwargs are passed to cfit.profile.cint.
+    Returns the best R0, the interval (lower, upper) and the cfit.profile
+    """
+    I     = np.asarray(I, dtype = float)
+    Like  = SIRLikelihood if kind == 'SIR' else SEIRLikelihood
+    llike = Like(t, _series_y0(I, N, kind))
+
+    # parameters (N, R0, gamma[, sigma])
+    weighted = lambda x, N, R0, gamma, *pars: I * llike(x, N, R0 * gamma, gamma, *pars)
+
+    par    = (N, par0[0] / par0[1]) + tuple(par0[1:])
+    maskmu = (False, True) + (False,) * (len(par0) - 1)
+    masknu = (False, False) + (True,) * (len(par0) - 1)
+    prof   = cfit.profile(t, weighted, par, maskmu, masknu)
+    return prof.mubest, prof.cint(beta, **kwargs), prof
+
+def _series_curve(t, N, kind, I, pars):
+    model = sir if kind == 'SIR' else seir
+    return model(N, *pars, _series_y0(I, N, kind), t).I
+
+def _series_refit(t, N, kind, I, start):
+    return fit_series(t, I, N, start, kind)[0]
+
+def bootstrap_series(t, I, N, par0, kind = 'SIR', n_boot = 1000, seed = None, **kwargs):
+    """ parametric bootstrap of fit_series: n_boot Poisson resamples of the
+    nominal fitted curve are refitted, starting from the nominal fit.
+    kwargs are passed to c19.bootstrap.bootstrap (n_workers, chunk_size,
+    quantiles...). Returns a Bootstrap with the bands of the fitted I(t)
+    """
+    I          = np.asarray(I, dtype = float)
+    nominal, _ = fit_series(t, I, N, par0, kind)
+    mu         = _series_curve(t, N, kind, I, nominal)
+    samples    = np.random.default_rng(seed).poisson(np.maximum(mu, 0), size = (n_boot, len(t)))
+    return cboot.bootstrap(partial(_series_refit, t, N, kind), partial(_series_curve, t, N, kind),
+                           samples.astype(float), nominal, t, **kwargs)
+
 def sir_mle(cis, crs, ts, N, beta, gamma):
 
     isir  = sir(N, beta, gamma)
@@ -72,13 +285,9 @@ def _hrandom(xs, ys, N):
     return cis
 
 def _poisson(ns):
-    def _delta_ni(i):
-        if (i == 0): return ns[0]
-        return abs(ns[i] - ns[i-1])
-    dns  = [_delta_ni(i) for i in range(len(ns))]
-    udns = [np.random.poisson(dni) for dni in dns]
-    cns  = [ni + dni for ni, dni in zip(ns, udns)]
-    return np.array(cns)
+    ns   = np.asarray(ns)
+    dns  = np.abs(np.diff(ns, prepend = 0))
+    return ns + np.random.poisson(dns)
 
 def sir_experiment(sir):
     """ Generate an experiment with a sir model
@@ -90,6 +299,22 @@ def sir_experiment(sir):
     crs = _poisson(sir.R)
     return cis, crs, sir.t
 
+def sir_experiments(sir, n_toys, chunk_size = None, seed = None):
+    """ Generator of toy experiments of a sir model, with the distribution of
+    sir_experiment: yields (cis, crs) of shape (n, n_t) in chunks of at most
+    chunk_size toys (all the n_toys in one chunk by default), so that the
+    memory is bounded by the chunk size.
+    seed is passed to np.random.default_rng
+    """
+    rng   = np.random.default_rng(seed)
+    ns    = np.stack((sir.I, sir.R))
+    dns   = np.abs(np.diff(ns, axis = 1, prepend = 0))
+    chunk = n_toys if chunk_size is None else chunk_size
+    for start in range(0, n_toys, chunk):
+        n   = min(chunk, n_toys - start)
+        cns = ns + rng.poisson(dns, size = (n,) + dns.shape)
+        yield cns[:, 0], cns[:, 1]
+
 
 def _sir_kmeasurements(cis, crs, ts, N = N0, fi = 2.):
 
@@ -152,3 +377,146 @@ def sir_kfilter(cis, ris, ts, N = N0, beta = beta0, gamma = gamma0, full_output
         xs[i], uxs[i], res[i] = xi, uxi, resi
     result = (xs, uxs) if full_output is False else (xs, uxs, ms, dms, ums, hs, res)
     return result
+
+
+#---- Batched Kalman Filter: all the series advance in one time loop
+
+def _inv2(a):
+    """ closed-form inverse of a stack of 2x2 matrices, shape (..., 2, 2) """
+    det = a[..., 0, 0] * a[..., 1, 1] - a[..., 0, 1] * a[..., 1, 0]
+    inv = np.empty_like(a)
+    inv[..., 0, 0] =   a[..., 1, 1] / det
+    inv[..., 0, 1] = - a[..., 0, 1] / det
+    inv[..., 1, 0] = - a[..., 1, 0] / det
+    inv[..., 1, 1] =   a[..., 0, 0] / det
+    return inv
+
+
+def _sir_kmeasurements_batch(cis, crs, dt, N = N0, fi = 2., m0 = None):
+    """ measurements of _sir_kmeasurements for a batch of series:
+    cis, crs shape (n_series, n_t) and N a scalar or shape (n_series,).
+    Returns ms, dms shape (n_series, n_t, 2) and ums, hs (n_series, n_t, 2, 2).
+    m0, shape (n_series, 2), is the measurement before the first one
+    (the first dm is the first measurement if not given)
+    """
+    cis = np.asarray(cis, dtype = float)
+    crs = np.asarray(crs, dtype = float)
+    N   = np.asarray(N  , dtype = float).reshape(-1, 1)
+
+    ms  = np.stack((cis, crs), axis = -1)
+    dms = np.diff(ms, axis = 1, prepend = 0. if m0 is None else m0[:, None, :])
+
+    ums = np.zeros(cis.shape + (2, 2))
+    ums[..., 0, 0] = fi * np.maximum(2.4, np.sqrt(cis))
+    ums[..., 1, 1] = fi * np.maximum(2.4, np.sqrt(crs))
+
+    hs  = np.zeros(cis.shape + (2, 2))
+    hs[..., 0, 0] =   cis * dt * (N - (cis + crs)) / N
+    hs[..., 0, 1] = - cis * dt
+    hs[..., 1, 1] =   cis * dt
+    return ms, dms, ums, hs
+
+
+def _kfilter_batch(xp, uxp, m, um, h):
+    """ _kfilter for a batch: xp, m shape (n_series, 2), uxp, um, h (n_series, 2, 2) """
+    ht  = np.swapaxes(h, -1, -2)
+    res = m - np.einsum('nij,nj->ni', h, xp)
+    uht = uxp @ ht
+    k   = uht @ _inv2(h @ uht + um)
+    x   = xp + np.einsum('nij,nj->ni', k, res)
+    ux  = uxp - k @ h @ uxp
+    return x, ux, res, k
+
+
+def _kfilter_run(x, ux, dms, ums, hs, xs = None, uxs = None):
+    """ advances the states x, ux of every series over the measurements
+    dms, ums, hs of shape (n_series, n_steps, ...). The states after each
+    step are written in xs, uxs if given. Returns the last states """
+    for i in range(dms.shape[1]):
+        x, ux, _, _ = _kfilter_batch(x, ux, dms[:, i], ums[:, i], hs[:, i])
+        if xs is not None:
+            xs[:, i], uxs[:, i] = x, ux
+    return x, ux
+
+
+def sir_kfilter_batch(cis, ris, ts, N = N0, beta = beta0, gamma = gamma0,
+                      fi = 2., sigma = 100.):
+    """ sir_kfilter for many series at once.
+    cis, ris shape (n_series, n_t), N, beta, gamma scalars or (n_series,).
+    Returns xs shape (n_series, n_t, 2) and uxs (n_series, n_t, 2, 2), with the
+    same values as sir_kfilter for each series (the last time is not filtered)
+    """
+    cis  = np.atleast_2d(cis)
+    ris  = np.atleast_2d(ris)
+    size = cis.shape[1]
+
+    nseries = cis.shape[0]
+    x0  = np.empty((nseries, 2))
+    x0[:, 0], x0[:, 1] = beta, gamma
+    ux0 = np.broadcast_to(sigma * np.identity(2), (nseries, 2, 2))
+
+    xs  = np.empty((nseries, size, 2))
+    uxs = np.empty((nseries, size, 2, 2))
+    xs [:] = x0 [:, None]
+    uxs[:] = ux0[:, None]
+
+    _, dms, ums, hs = _sir_kmeasurements_batch(cis, ris, ts[1] - ts[0], N, fi)
+    _kfilter_run(x0, ux0, dms[:, :-1], ums[:, :-1], hs[:, :-1], xs, uxs)
+    return xs, uxs
+
+
+class SIRKalmanOnline:
+    """ Resumable batched SIR Kalman filter for daily data arrivals.
+    Keeps the last state (x, ux) and measurement of each series, so that
+    update() only processes the new days. The state is saved to and loaded
+    from a file (in .npz format, at the exact path given) with save() and
+    load().
+    """
+
+    def __init__(self, nseries, N = N0, beta = beta0, gamma = gamma0, dt = 1.,
+                 fi = 2., sigma = 100.):
+        self.x  = np.empty((nseries, 2))
+        self.x[:, 0], self.x[:, 1] = beta, gamma
+        self.ux = np.tile(sigma * np.identity(2), (nseries, 1, 1))
+        self.m  = np.zeros((nseries, 2))
+        self.N  = np.broadcast_to(np.asarray(N, dtype = float), (nseries,)).copy()
+        self.dt = float(dt)
+        self.fi = float(fi)
+        self.ndays = 0
+
+    @property
+    def nseries(self):
+        return len(self.x)
+
+    def update(self, new_cis, new_ris):
+        """ filters the new days, new_cis and new_ris of shape (n_series, n_new)
+        (or (n_series,) for a single day). Returns the states after each new
+        day, xs shape (n_series, n_new, 2) and uxs (n_series, n_new, 2, 2)
+        """
+        cis = np.asarray(new_cis, dtype = float).reshape(self.nseries, -1)
+        ris = np.asarray(new_ris, dtype = float).reshape(self.nseries, -1)
+        if cis.shape[1] == 0:
+            return np.empty(cis.shape + (2,)), np.empty(cis.shape + (2, 2))
+
+        ms, dms, ums, hs = _sir_kmeasurements_batch(cis, ris, self.dt, self.N, self.fi,
+                                                   m0 = self.m)
+        xs  = np.empty(cis.shape + (2,))
+        uxs = np.empty(cis.shape + (2, 2))
+        self.x, self.ux = _kfilter_run(self.x, self.ux, dms, ums, hs, xs, uxs)
+        self.m      = ms[:, -1]
+        self.ndays += cis.shape[1]
+        return xs, uxs
+
+    def save(self, path):
+        # np.savez appends .npz to a path, not to a file object
+        with open(path, 'wb') as f:
+            np.savez(f, x = self.x, ux = self.ux, m = self.m, N = self.N,
+                     dt = self.dt, fi = self.fi, ndays = self.ndays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as state:
+            kf = cls(len(state['x']), N = state['N'], dt = state['dt'], fi = state['fi'])
+            kf.x, kf.ux, kf.m = state['x'], state['ux'], state['m']
+            kf.ndays = int(state['ndays'])
+        return kf
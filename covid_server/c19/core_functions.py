@@ -90,3 +90,20 @@ def divide_np_arrays(num : np.array, denom : np.array) -> np.array:
     ratio = np.zeros(len(denom))
     np.divide(num, denom, out=ratio, where=ok)
     return ratio
+
+
+def pivot_regions(df : DataFrame, column : str = 'cases',
+                  region : str = 'countriesAndTerritories',
+                  date : str = 'dateRep') -> Tuple[np.array, np.array, np.array]:
+    """
+    Series of column of every region of a combined data frame
+    (get_data_communities or get_data_world) as a 2D array
+
+    Returns
+    -------
+        regions, dates and a float array of shape (n_regions, n_dates),
+        with NaN on the dates missing for a region
+    """
+    table = df.pivot_table(index=region, columns=date, values=column, aggfunc='sum')
+    table = table.sort_index(axis=1)
+    return table.index.values, table.columns.values, table.values.astype(np.float64)
@@ -5,14 +5,19 @@ GML November 2016
 """
 
 import numpy  as np
-import pandas as pd
 import scipy.optimize
 import scipy.stats
+from   functools import partial
+from   inspect   import signature
 
 from invisible_cities.core                   import core_functions as coref
 from invisible_cities.core.stat_functions    import poisson_sigma
 from invisible_cities.evm.ic_containers      import FitFunction
 from . core_functions                        import  NN
+from . bootstrap                             import  bootstrap
+from . stats                                 import  binned_stats
+from . batch_fit                             import  fit_mask, chi2_batch
+from . batch_fit                             import  loglinear_batch, lm_batch
 
 
 def get_errors(cov):
@@ -74,13 +79,16 @@ def get_chi2_and_pvalue(ydata, yfit, ndf, sigma=None):
 # ###########################################################
 # Functions
 def gauss(x, amp, mu, sigma):
-    if sigma <= 0.:
-        return np.inf
+    if np.ndim(sigma) == 0:
+        if sigma <= 0.:
+            return np.inf
+    else:  # parameters of a batch: nan for the series with sigma <= 0
+        sigma = np.where(sigma > 0., sigma, np.nan)
     return amp/(2*np.pi)**.5/sigma * np.exp(-0.5*(x-mu)**2./sigma**2.)
 
 
 def polynom(x, *coeffs):
-    return np.polynomial.polynomial.polyval(x, coeffs)
+    return np.polynomial.polynomial.polyval(x, coeffs, tensor=False)
 
 
 def expo(x, const, mean):
@@ -174,6 +182,81 @@ def fit(func, x, y, seed=(), fit_range=None, **kwargs):
     return FitFunction(fitf, vals, errors, chi2, pval, cov)
 
 
+def _expo_from_log(a, b):
+    """(const, mean) of expo and their derivatives in a, b"""
+    vals = np.stack([np.exp(a), 1 / b], -1)
+    return vals, np.stack([vals[:, 0], -1 / b**2], -1)
+
+
+def _power_from_log(a, b):
+    """(const, pow_) of power and their derivatives in a, b"""
+    vals = np.stack([np.exp(a), b], -1)
+    return vals, np.stack([vals[:, 0], np.ones_like(b)], -1)
+
+
+# linearizable models: regressor of log(y) and parameters from (a, b)
+_loglinear = {expo  : (lambda x: x        , _expo_from_log ),
+              power : (lambda x: np.log(x), _power_from_log)}
+
+
+def fit_batch(func, x, ys, seed=(), fit_range=None, sigma=None,
+              linearize=True, **kwargs):
+    """
+    Fit a stack of series with one set of parameters per series.
+
+    Parameters
+    ----------
+    func : function
+        As in fit, but it must broadcast parameters of shape (n_series, 1)
+        against x of shape (n_series, n_x).
+    x : np.ndarray
+        Common x, shape (n_x,), or one per series, shape (n_series, n_x).
+    ys : np.ndarray
+        Data, shape (n_series, n_x). Nan values are not fitted.
+    seed : sequence
+        Initial parameters, common (n_par,) or per series (n_series, n_par).
+    fit_range : tuple or np.ndarray
+        Common range (lo, hi) or one range per series, shape (n_series, 2).
+    sigma : np.ndarray
+        Data errors, broadcastable to ys.
+    linearize : bool
+        Fit expo and power in closed form by weighted least squares of
+        log(y), with weights (y / sigma)**2. Points with y <= 0 are dropped.
+        The other functions, or linearize=False, use a Levenberg-Marquardt
+        iterated over all the series at once.
+    kwargs :
+        Passed to c19.batch_fit.lm_batch (max_iter, ftol, xtol).
+
+    Returns
+    -------
+    fitted_fun : FitFunction with vectorized fields
+        fn(x) evaluates all the series, shape (n_series, len(x)); values and
+        errors have shape (n_series, n_par), chi2 and pvalue (n_series,)
+        and cov (n_series, n_par, n_par).
+    """
+    ys   = np.asarray(ys, dtype=float)
+    xs   = np.broadcast_to(np.asarray(x, dtype=float), ys.shape)
+    mask = fit_mask(xs, ys, fit_range)
+
+    if linearize and func in _loglinear:
+        regressor, from_log = _loglinear[func]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pars, cov_log = loglinear_batch(regressor(xs), ys, mask, sigma)
+            vals, jac     = from_log(*pars.T)
+        cov = jac[:, :, None] * cov_log * jac[:, None, :]
+    else:
+        p0 = np.ones(len(signature(func).parameters) - 1) if len(seed) == 0 else seed
+        vals, cov, _ = lm_batch(func, xs, ys, p0, mask, sigma, **kwargs)
+
+    with np.errstate(all='ignore'):
+        yfit = func(xs, *vals.T[..., np.newaxis])
+    chi2, pval = chi2_batch(ys, yfit, mask, vals.shape[-1], sigma)
+    errors     = np.sqrt(np.diagonal(cov, axis1=-2, axis2=-1))
+    fitf       = lambda x: func(x, *vals.T[..., np.newaxis])
+
+    return FitFunction(fitf, vals, errors, chi2, pval, cov)
+
+
 def profileX(xdata, ydata, nbins=100,
              xrange=None, yrange=None,
              std=False, drop_nan=True):
@@ -215,23 +298,18 @@ def profileX(xdata, ydata, nbins=100,
 
     bin_edges   = np.linspace(*xrange, nbins + 1)
     bin_centers = coref.shift_to_bin_centers(bin_edges)
-    bin_numbers = np.digitize(xdata, bin_edges, right=False)
-    df          = pd.DataFrame(dict(bin=bin_numbers, y=ydata))
-    gb          = df.groupby("bin").y
+    bin_numbers = np.digitize(xdata, bin_edges, right=False) - 1
 
-    mean      = gb.mean().values
-    deviation = gb.std () if std else gb.std() / gb.size()**0.5
-    indices   = deviation.index.values - 1
+    size, mean, deviation = binned_stats(bin_numbers, ydata, nbins, std)
 
     if drop_nan:
-        return bin_centers[indices], mean, deviation.values
+        filled = size > 0
+        return bin_centers[filled], mean[filled], deviation[filled]
 
-    mean_               = np.full_like(bin_centers, np.nan)
-    deviation_          = np.full_like(bin_centers, np.nan)
-    mean_     [indices] = mean
-    deviation_[indices] = deviation
+    mean     [size == 0] = np.nan
+    deviation[size == 0] = np.nan
 
-    return bin_centers, mean_, deviation_
+    return bin_centers, mean, deviation
 
 
 def profileY(xdata, ydata, nbins = 100,
@@ -316,22 +394,57 @@ def profileXY(xdata, ydata, zdata, nbinsx, nbinsy,
     bin_edges_y   = np.linspace(*yrange, nbinsy + 1)
     bin_centers_x = coref.shift_to_bin_centers(bin_edges_x)
     bin_centers_y = coref.shift_to_bin_centers(bin_edges_y)
-    bin_numbers_x = np.digitize(xdata, bin_edges_x, right=False)
-    bin_numbers_y = np.digitize(ydata, bin_edges_y, right=False)
-    df            = pd.DataFrame(dict(binx=bin_numbers_x, biny=bin_numbers_y, z=zdata))
-    gb            = df.groupby(["binx", "biny"]).z
+    bin_numbers_x = np.digitize(xdata, bin_edges_x, right=False) - 1
+    bin_numbers_y = np.digitize(ydata, bin_edges_y, right=False) - 1
+    bin_numbers   = bin_numbers_x * nbinsy + bin_numbers_y
+
+    shape = nbinsx, nbinsy
+    size, mean, deviation = binned_stats(bin_numbers, zdata, nbinsx * nbinsy, std)
+
+    mean     [size == 0]           = 0
+    deviation[np.isnan(deviation)] = 0
 
-    shape     = nbinsx, nbinsy
-    mean      = np.zeros(shape)
-    deviation = np.zeros(shape)
+    return bin_centers_x, bin_centers_y, mean.reshape(shape), deviation.reshape(shape)
 
-    mean_       = gb.mean().values
-    deviation_  = gb.std () if std else gb.std() / gb.size()**0.5
-    (indices_x,
-     indices_y) = map(np.array, zip(*deviation_.index.values))
 
-    notnan = ~np.isnan(deviation_.values)
-    mean     [indices_x - 1, indices_y - 1] = mean_
-    deviation[indices_x - 1, indices_y - 1] = np.where(notnan, deviation_.values, 0)
+def _bootstrap_refit(func, x, sigma, y, start):
+    kwargs = {} if sigma is None else {'sigma': sigma}
+    return fit(func, x, y, start, **kwargs).values
+
+
+def _bootstrap_curve(func, x_curve, y, pars):
+    return func(x_curve, *pars)
+
+
+def bootstrap_fit(func, x, y, seed=(), n_boot=1000, sigma=None, x_curve=None,
+                  rng_seed=None, **kwargs):
+    """
+    Parametric bootstrap of fit: n_boot resamples of the nominal fitted
+    curve (gaussian with sigma if given, poisson otherwise) are refitted,
+    starting from the nominal parameters.
+
+    Parameters
+    ----------
+    x_curve : np.ndarray
+        Points of the percentile bands. Defaults to x.
+    kwargs :
+        Passed to c19.bootstrap.bootstrap (n_workers, chunk_size, quantiles...).
+
+    Returns
+    -------
+    fitted_fun : FitFunction of the nominal fit
+    boot : Bootstrap with the parameters of the replicates and the bands
+    """
+    x_curve = x if x_curve is None else x_curve
+    nominal = fit(func, x, y, seed, **({} if sigma is None else {'sigma': sigma}))
+    mu      = func(x, *nominal.values)
+    rng     = np.random.default_rng(rng_seed)
+    if sigma is None:
+        samples = rng.poisson(np.maximum(mu, 0), size=(n_boot, len(x))).astype(float)
+    else:
+        samples = mu + sigma * rng.standard_normal((n_boot, len(x)))
 
-    return bin_centers_x, bin_centers_y, mean, deviation
+    boot = bootstrap(partial(_bootstrap_refit, func, x, sigma),
+                     partial(_bootstrap_curve, func, x_curve),
+                     samples, nominal.values, x_curve, **kwargs)
+    return nominal, boot
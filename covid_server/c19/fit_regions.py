@@ -0,0 +1,94 @@
+"""
+Fit of all the regions (CCAA, countries) of a combined data frame in
+parallel with a ProcessPoolExecutor.
+
+The series are copied once into shared memory: each worker attaches to the
+block by name and reads its rows, so no data frames are pickled.
+"""
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing    import shared_memory
+
+import numpy  as np
+import pandas as pd
+
+from . core_functions import pivot_regions
+from . cfitsir        import fit_series
+
+
+_series = None   # (shared memory, array) attached in each worker
+
+
+def _attach(name, shape, dtype):
+    global _series
+    shm     = shared_memory.SharedMemory(name=name)
+    _series = shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _fit_task(i, region, N, par0, kind, seed, min_cases):
+    """Fits row i of the shared series. The legacy global RNG is seeded with
+    the task seed, so that fits with random components are reproducible"""
+    t0 = time.perf_counter()
+    np.random.seed(seed)
+
+    I       = np.nan_to_num(_series[1][i])
+    reached = I >= min_cases
+    if not reached.any():
+        # no day with min_cases: there is no epidemic to fit
+        return i, region, np.full(len(par0), np.nan), 0, -1, time.perf_counter() - t0
+    first = np.argmax(reached)
+    I     = I[first:]
+    t     = np.arange(len(I), dtype=float)
+    pars, nsolves = fit_series(t, I, N, par0, kind)
+
+    return i, region, pars, nsolves, first, time.perf_counter() - t0
+
+
+def fit_regions(df, column='cases', kind='SIR', par0=(3/7, 1/7, 1/5),
+                population='popData2018', region='countriesAndTerritories',
+                min_cases=1, n_workers=None, seed=0):
+    """
+    Fits every region of a combined data frame (get_data_communities or
+    get_data_world) to a SIR or SEIR model in a ProcessPoolExecutor.
+
+    Parameters
+    ----------
+    column     : column with the series fitted (from the first day with min_cases)
+    kind       : 'SIR' or 'SEIR'
+    par0       : starting (beta, gamma, sigma), sigma only used by SEIR
+    population : column with the population of each region
+    n_workers  : processes of the pool (number of CPUs by default)
+    seed       : root seed, each region gets its own seed from a SeedSequence
+
+    Returns
+    -------
+        DataFrame with one row per region: the best parameters, R0, the number
+        of model solves, the first day fitted and the fit time in seconds.
+        Regions that never reach min_cases are not fitted: their parameters
+        are nan, first_day is -1 and fitted is False
+    """
+    regions, _, series = pivot_regions(df, column, region)
+    N     = df.groupby(region)[population].first().loc[regions].values
+    par0  = tuple(par0[:2]) if kind == 'SIR' else tuple(par0[:3])
+    seeds = [s.generate_state(1)[0] for s in np.random.SeedSequence(seed).spawn(len(regions))]
+
+    shm = shared_memory.SharedMemory(create=True, size=series.nbytes)
+    try:
+        np.ndarray(series.shape, dtype=series.dtype, buffer=shm.buf)[:] = series
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_attach,
+                                 initargs=(shm.name, series.shape, series.dtype)) as pool:
+            futures = [pool.submit(_fit_task, i, r, float(N[i]), par0, kind, seeds[i], min_cases)
+                       for i, r in enumerate(regions)]
+            results = [f.result() for f in futures]
+    finally:
+        shm.close()
+        shm.unlink()
+
+    names = ('beta', 'gamma') if kind == 'SIR' else ('beta', 'gamma', 'sigma')
+    rows  = []
+    for i, r, pars, nsolves, first, seconds in results:
+        row = dict(zip(names, pars))
+        row.update({region: r, 'R0': pars[0] / pars[1], 'nsolves': nsolves,
+                    'first_day': first, 'fitted': first >= 0, 'seconds': seconds})
+        rows.append(row)
+    return pd.DataFrame(rows).set_index(region)
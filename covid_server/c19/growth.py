@@ -0,0 +1,102 @@
+"""
+Rolling growth rates and doubling times of every region of a combined data
+frame (get_data_communities or get_data_world).
+
+log(y) = a + b t is fitted by least squares on each window of the series,
+b being the daily growth rate. The sums of the normal equations of all the
+windows come from cumulative sums (prefix arrays) of the series, so every
+window end of every region costs O(1): O(n) per series for any window.
+"""
+import numpy  as np
+import pandas as pd
+
+from . core_functions import pivot_regions
+
+
+def _window_sums(x, window):
+    """sums of x over the windows of the last axis ending at each point,
+    nan for the first window - 1 points"""
+    prefix = np.concatenate([np.zeros(x.shape[:-1] + (1,)), np.cumsum(x, axis=-1)], axis=-1)
+    sums   = np.full(x.shape, np.nan)
+    sums[..., window - 1:] = prefix[..., window:] - prefix[..., :-window]
+    return sums
+
+
+def rolling_loglinear(ys, window=7, poisson=False):
+    """
+    Least squares fit of log(y) = a + b t on the windows of window days of
+    each series, ys of shape (n_series, n_t) (one point per day).
+    Days with y <= 0 or nan are not fitted.
+
+    Parameters
+    ----------
+    poisson : bool
+        Weight the logs with y (their poisson variance is 1 / y) and take
+        absolute errors. Otherwise the fit is unweighted and the error of
+        b is scaled by the residual variance.
+
+    Returns
+    -------
+        growth rate b, its error and the number of days fitted, arrays of
+        shape (n_series, n_t) for the windows ending at each day (nan for
+        the first window - 1 days and for windows with too few days)
+    """
+    ys   = np.atleast_2d(np.asarray(ys, dtype=float))
+    ok   = ys > 0
+    v    = np.log(np.where(ok, ys, 1))
+    w    = np.where(ok, ys if poisson else 1., 0)
+    t    = np.arange(ys.shape[-1], dtype=float)
+
+    n    = _window_sums(ok.astype(float), window)
+    s0   = _window_sums(w          , window)
+    st   = _window_sums(w * t      , window)
+    stt  = _window_sums(w * t * t  , window)
+    sv   = _window_sums(w * v      , window)
+    stv  = _window_sums(w * t * v  , window)
+    svv  = _window_sums(w * v * v  , window)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        det  = s0 * stt - st * st
+        b    = (s0 * stv - st * sv) / det
+        a    = (stt * sv - st * stv) / det
+        var  = s0 / det
+        if not poisson:
+            res2 = np.maximum(svv - a * sv - b * stv, 0)
+            var  = var * res2 / (n - 2)
+    fitted = n > (1 if poisson else 2)
+    return (np.where(fitted, b, np.nan), np.where(fitted, np.sqrt(var), np.nan),
+            np.nan_to_num(n).astype(int))
+
+
+def doubling_time(rate, rate_error):
+    """doubling time log(2) / rate and its error (negative times are halving times)"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        td = np.log(2) / rate
+        return td, np.abs(td) * rate_error / np.abs(rate)
+
+
+def growth_rates(df, column='cases', window=7, poisson=False,
+                 region='countriesAndTerritories', date='dateRep'):
+    """
+    Rolling growth rate and doubling time of column for every region of a
+    combined data frame (get_data_communities or get_data_world), see
+    rolling_loglinear. The series are put on a daily grid: the dates missing
+    for a region are not fitted.
+
+    Returns
+    -------
+        DataFrame indexed by (region, date) with the days fitted, the growth
+        rate, the doubling time and their errors for the window ending at date
+    """
+    regions, dates, series = pivot_regions(df, column, region, date)
+    days                   = pd.date_range(dates[0], dates[-1], freq='D')
+    series                 = pd.DataFrame(series, columns=pd.DatetimeIndex(dates)).reindex(columns=days).values
+    rate, rate_error, n    = rolling_loglinear(series, window, poisson)
+    td, td_error           = doubling_time(rate, rate_error)
+
+    index = pd.MultiIndex.from_product([regions, days], names=[region, date])
+    return pd.DataFrame({'days'               : n.ravel(),
+                         'growth_rate'        : rate.ravel(),
+                         'growth_rate_error'  : rate_error.ravel(),
+                         'doubling_time'      : td.ravel(),
+                         'doubling_time_error': td_error.ravel()}, index=index)
@@ -0,0 +1,191 @@
+##
+##  Hypothesis tests with toy Monte Carlo (htsimple, htcomposite of c19.cfit)
+##
+##  The toys are a (n_toys, n_obs) array: the log likelihoods of all the toys
+##  are evaluated at once, the refits of the toys run in a process pool and
+##  the test statistics are kept sorted, so that p-values are searchsorted.
+##
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools          import repeat
+
+import numpy as np
+
+from c19.cfit import _llike, _masks, _par, _setpar, mle
+
+
+def _sorted(xs):
+    return np.sort(np.asarray(xs, dtype = float))
+
+
+def _fraction_above(sorted_xs, x):
+    """ fraction of sorted_xs >= x """
+    n = len(sorted_xs)
+    return (n - np.searchsorted(sorted_xs, x, side = 'left')) / n
+
+
+def _fraction_below(sorted_xs, x):
+    """ fraction of sorted_xs <= x """
+    return np.searchsorted(sorted_xs, x, side = 'right') / len(sorted_xs)
+
+
+def _toys(xs):
+    """ toys as a 2D array (n_toys, n_obs), a 1D array is one observation per toy """
+    xs = np.asarray(xs, dtype = float)
+    return xs[:, np.newaxis] if xs.ndim == 1 else xs
+
+
+def llike_toys(llike, xs, pars):
+    """ log likelihood of each toy, xs shape (n_toys, n_obs), for parameters pars,
+    common (n_par,) or per toy (n_toys, n_par). llike must broadcast its parameters """
+    pars = np.asarray(pars, dtype = float)
+    if pars.ndim == 1:
+        return np.sum(llike(xs, *pars), axis = 1)
+    return np.sum(llike(xs, *pars.T[:, :, np.newaxis]), axis = 1)
+
+
+def _fit_rows(xs, llike, par, mask):
+    return np.array([_setpar(par, mle(x, llike, par, mask), mask) for x in xs])
+
+
+def fit_toys(xs, llike, par, mask, n_workers = 1):
+    """ best parameters of each toy, shape (n_toys, n_par), with the parameters
+    of mask free. With n_workers > 1 the toys are split in a process pool
+    (llike must then be picklable: a module function or a method of a
+    scipy distribution) """
+    par, mask = np.asarray(par, dtype = float), np.asarray(mask, dtype = bool)
+    if n_workers == 1:
+        return _fit_rows(xs, llike, par, mask)
+    chunks = np.array_split(xs, n_workers)
+    with ProcessPoolExecutor(max_workers = n_workers) as pool:
+        fits = pool.map(_fit_rows, chunks, repeat(llike), repeat(par), repeat(mask))
+        return np.concatenate(list(fits))
+
+
+class htsimple:
+    """ simple hypothesis test H0: rv0 against H1: rv1 (frozen distributions)
+    with q = 2 (log L1 - log L0) of toys of n_obs observations """
+
+    def __init__(self, rv0, rv1, size, n_obs = 1, seed = None):
+        rng         = np.random.default_rng(seed)
+        self.rv0    = rv0
+        self.rv1    = rv1
+        self.size   = int(size)
+        self.llike0 = _llike(rv0)
+        self.llike1 = _llike(rv1)
+        self.x0s    = rv0.rvs(size = (self.size, n_obs), random_state = rng)
+        self.x1s    = rv1.rvs(size = (self.size, n_obs), random_state = rng)
+        self.q0s    = _sorted(self.q(self.x0s))
+        self.q1s    = _sorted(self.q(self.x1s))
+
+    def q(self, x):
+        """ q of one experiment x (n_obs,) or of toys (n_toys, n_obs) """
+        x = np.asarray(x, dtype = float)
+        return 2. * np.sum(self.llike1(x) - self.llike0(x), axis = -1)
+
+    def qrange(self):
+        return (self.q0s[0], self.q1s[-1])
+
+    def p0value(self, q):
+        return _fraction_above(self.q0s, q)
+
+    def p1value(self, q):
+        return _fraction_below(self.q1s, q)
+
+    def cls(self, q):
+        beta0 = _fraction_below(self.q0s, q)
+        beta1 = _fraction_below(self.q1s, q)
+        return beta1 / beta0
+
+
+class htcomposite:
+    """ composite hypothesis tests on the parameter mu (maskmu) of a family of
+    distributions rv (rv.rvs(*par, size), rv.logpdf(x, *par)), with nuisance
+    parameters masknu, using the profile likelihood ratio tmu and the one
+    sided qmu (upper limits, or evidence of mu below a value: R below 1 is
+    qmu at mu = 1) and q0 (discovery of mu above mu0, e.g. R above 1).
+    The distributions of the statistics come from toys; the refits of the
+    toys run in n_workers processes """
+
+    def __init__(self, rv, par, mask = None, masknu = None, n_workers = 1):
+        self.rv     = rv
+        self.llike  = _llike(rv)
+        self.par    = np.atleast_1d(np.array(par, dtype = float))
+        mask, maskmu, masknu = _masks(self.par.size, mask, masknu)
+        self.maskmu = maskmu
+        self.masknu = masknu
+        self.mask   = mask
+        self.n_workers = n_workers
+
+    def _has_nus(self):
+        return (np.sum(self.masknu) > 0)
+
+    def _mu(self, pars):
+        return np.asarray(pars)[..., self.maskmu][..., 0]
+
+    def parbest(self, xs, par = None):
+        """ best parameters of the toys xs (n_toys, n_obs) """
+        par = self.par if par is None else par
+        return fit_toys(_toys(xs), self.llike, par, self.mask, self.n_workers)
+
+    def parmubest(self, xs, mu, par = None):
+        """ best parameters of the toys with mu fixed """
+        par = _setpar(self.par if par is None else par, mu, self.maskmu)
+        xs  = _toys(xs)
+        if not self._has_nus():
+            return np.tile(par, (len(xs), 1))
+        return fit_toys(xs, self.llike, par, self.masknu, self.n_workers)
+
+    def tmu(self, xs, mu, par = None, parbest = None, mu0 = None):
+        """ tmu = -2 log(L(mu, nu_mu) / L(mu_hat, nu_hat)) of each toy.
+        With mu0 the best fits are restricted to mu >= mu0 """
+        xs      = _toys(xs)
+        parbest = self.parbest(xs, par) if parbest is None else parbest
+        if mu0 is not None:
+            low = self._mu(parbest) < mu0
+            if np.any(low):
+                parbest = np.array(parbest)
+                parbest[low] = self.parmubest(xs[low], mu0, par)
+        parmu = self.parmubest(xs, mu, par)
+        return 2. * (llike_toys(self.llike, xs, parbest) - llike_toys(self.llike, xs, parmu))
+
+    def qmu(self, xs, mu, par = None, parbest = None):
+        """ tmu for mu above the best fit, 0 otherwise (upper limits) """
+        xs      = _toys(xs)
+        parbest = self.parbest(xs, par) if parbest is None else parbest
+        res     = self.tmu(xs, mu, par, parbest)
+        return np.where(self._mu(parbest) < mu, res, 0.)
+
+    def q0(self, xs, mu0, par = None, parbest = None):
+        """ tmu of mu0 for a best fit above mu0, 0 otherwise (evidence of
+        mu above mu0; evidence of mu below a value is qmu) """
+        xs      = _toys(xs)
+        parbest = self.parbest(xs, par) if parbest is None else parbest
+        res     = self.tmu(xs, mu0, par, parbest)
+        return np.where(self._mu(parbest) > mu0, res, 0.)
+
+    def rvs(self, mu = None, par = None, size = 1000, n_obs = 1, seed = None):
+        """ toys (size, n_obs) generated with mu """
+        mu    = mu if mu is not None else _par(self.par, self.maskmu)
+        parmu = _setpar(self.par if par is None else par, mu, self.maskmu)
+        return self.rv.rvs(*parmu, size = (size, n_obs),
+                           random_state = np.random.default_rng(seed))
+
+    def tmu_rvs(self, mu = None, par = None, size = 1000, n_obs = 1, seed = None,
+                stat = 'tmu', mu_test = None):
+        """ sorted values of the statistic stat ('tmu', 'qmu' or 'q0') at mu_test
+        (mu by default) for toys generated with mu """
+        mu      = mu if mu is not None else _par(self.par, self.maskmu)[0]
+        mu_test = mu if mu_test is None else mu_test
+        xs      = self.rvs(mu, par, size, n_obs, seed)
+        ts      = getattr(self, stat)(xs, mu_test, par)
+        return _sorted(ts)
+
+    def pvalue_rvs(self, t, ts):
+        """ p-value of an observed statistic t from the sorted toy values ts """
+        return _fraction_above(ts, t)
+
+    def cls(self, q, qmus_mu, qmus_0):
+        """ CLs = CLs+b / CLb: fractions of the sorted qmu >= q of toys generated
+        with mu and of toys generated with the background only value """
+        return _fraction_above(qmus_mu, q) / _fraction_above(qmus_0, q)
@@ -70,3 +70,47 @@ def gaussian_experiments_variable_mean_and_std(mexperiments : Number   = 1000,
 
 def smear_e(e : np.array, std : float)->np.array:
     return np.array([np.random.normal(x, std) for x in e])
+
+
+def binned_sums(bins : np.array, values : np.array, nbins : int,
+                shift : float = 0.)->Tuple[np.array, np.array, np.array, np.array]:
+    """Per bin size, number of non NaN values, sum and sum of squares of
+    values - shift, in one pass with np.bincount. bins are the bin indices
+    (0 to nbins - 1) of values. The shift (a typical value) keeps the sums
+    of squares accurate"""
+    size = np.bincount(bins, minlength=nbins)[:nbins]
+    nan  = np.isnan(values)
+    if nan.any():
+        bins, values = bins[~nan], values[~nan]
+        count = np.bincount(bins, minlength=nbins)[:nbins]
+    else:
+        count = size
+    dv    = values - shift
+    sums  = np.bincount(bins, weights=dv, minlength=nbins)[:nbins]
+    sums2 = np.bincount(bins, weights=np.square(dv, out=dv), minlength=nbins)[:nbins]
+    return size, count, sums, sums2
+
+
+def binned_mean_std(size : np.array, count : np.array, sums : np.array, sums2 : np.array,
+                    shift : float = 0., std : bool = False)->Tuple[np.array, np.array]:
+    """Per bin mean and standard deviation (ddof=1) of the values, or error
+    of the mean (std / sqrt(size)), from binned_sums. As pandas groupby,
+    NaN values are skipped by the mean and std but counted in the size, and
+    bins with less than 1 (mean) or 2 (std) values give NaN"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = shift + sums / count
+        var  = np.maximum(sums2 - sums * sums / count, 0) / (count - 1)
+        dev  = np.sqrt(var) if std else np.sqrt(var / size)
+    mean[count == 0] = NN
+    dev [count <  2] = NN
+    return mean, dev
+
+
+def binned_stats(bins : np.array, values : np.array, nbins : int,
+                 std : bool = False)->Tuple[np.array, np.array, np.array]:
+    """Per bin size, mean and deviation of values (see binned_mean_std)"""
+    values = np.asarray(values, dtype=float)
+    finite = values[~np.isnan(values)]
+    shift  = finite[0] if len(finite) else 0.
+    size, count, sums, sums2 = binned_sums(bins, values, nbins, shift)
+    return (size,) + binned_mean_std(size, count, sums, sums2, shift, std)
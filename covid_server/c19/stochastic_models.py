@@ -0,0 +1,87 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from . basic_models import mitigation_function
+from . types        import StochasticSEIR
+
+
+def _tau_leap_seir_run(N, y0, beta, gamma, sigma, Mt, dt, steps_per_day,
+                       n_realizations, seed):
+    """Binomial tau-leaping of n_realizations SEIR chains at once.
+    Returns the daily states, shape (n_days, n_realizations, 4), and the
+    infections at the time each chain died out (N if it never did)"""
+    rng    = np.random.default_rng(seed)
+    state  = np.empty((n_realizations, 4), dtype=np.int64)
+    state[:] = y0
+    S, E, I, R = state.T
+
+    n_days = len(Mt) // steps_per_day + 1
+    daily  = np.empty((n_days, n_realizations, 4), dtype=np.int32)
+    daily[0] = state
+    size_at_extinction = np.full(n_realizations, N, dtype=np.int64)
+
+    p_EI = 1 - np.exp(-sigma * dt)
+    p_IR = 1 - np.exp(-gamma * dt)
+    for k, m in enumerate(Mt):
+        p_SE  = 1 - np.exp(-beta * m * I / N * dt)
+        new_E = rng.binomial(S, p_SE)
+        new_I = rng.binomial(E, p_EI)
+        new_R = rng.binomial(I, p_IR)
+        S -= new_E
+        E += new_E - new_I
+        I += new_I - new_R
+        R += new_R
+
+        extinct = (E + I == 0) & (size_at_extinction == N)
+        size_at_extinction[extinct] = N - S[extinct]
+
+        if (k + 1) % steps_per_day == 0:
+            daily[(k + 1) // steps_per_day] = state
+
+    return daily, size_at_extinction
+
+
+def tau_leap_seir(N, R0, Gamma, Sigma, days, n_realizations=1000, e0=0, i0=1,
+                  ts = [(0, 400)], ms=[1.0], dt=1., quantiles=(0.05, 0.5, 0.95),
+                  minor_outbreak=0.01, seed=None, n_workers=1):
+    """Stochastic SEIR with binomial tau-leaping, advancing all the
+    realizations at once as an (n_realizations, 4) integer state.
+
+    N is the (integer) population, e0 and i0 the initial number of exposed
+    and infected individuals, dt the time step in days (an integer
+    fraction of a day). The daily states are summarized as quantile bands.
+    p_extinction is the probability that the chains die out having
+    infected less than a fraction minor_outbreak of the population.
+    seed feeds a numpy.random.SeedSequence; with n_workers > 1 the
+    realizations are split over a process pool, each with its own stream.
+    """
+    N             = int(N)
+    steps_per_day = int(round(1 / dt))
+    dt            = 1 / steps_per_day
+    Beta          = Gamma * R0
+    t_days        = np.arange(0, days + 1, 1.)
+    M             = mitigation_function(t_days, ts, ms)
+    Mt            = M(np.arange(days * steps_per_day) * dt)
+    y0            = (N - e0 - i0, e0, i0, 0)
+
+    n_workers = max(1, min(int(n_workers), n_realizations))
+    seeds     = np.random.SeedSequence(seed).spawn(n_workers)
+    sizes     = np.diff(np.linspace(0, n_realizations, n_workers + 1).astype(int))
+    args      = [(N, y0, Beta, Gamma, Sigma, Mt, dt, steps_per_day, size, seed)
+                 for size, seed in zip(sizes, seeds)]
+
+    if n_workers == 1:
+        runs = [_tau_leap_seir_run(*args[0])]
+    else:
+        with ProcessPoolExecutor(n_workers) as pool:
+            runs = list(pool.map(_tau_leap_seir_run, *zip(*args)))
+
+    daily = np.concatenate([run[0] for run in runs], axis=1)
+    final = np.concatenate([run[1] for run in runs])
+    bands = np.quantile(daily, quantiles, axis=1)   # (n_q, n_days, 4)
+    S, E, I, R = np.moveaxis(bands, -1, 0)
+
+    return StochasticSEIR(N = N, t = t_days, quantiles = np.array(quantiles),
+                          S = S, E = E, I = I, R = R,
+                          p_extinction = np.mean(final < minor_outbreak * N),
+                          n_realizations = n_realizations)
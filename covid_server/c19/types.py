@@ -95,3 +95,79 @@ class SEIR2(SEIR):
     g     : float     # 1/g mean time from loss of inf to death
     lamda : float     # 1/landa mean duration of impact of death on population
     k     : float     # Parameter controlling the intensity of response
+
+
+class Compartments:
+    """Result of a compartmental model (SIR, SEIR, SEIR2...) stored as one
+    contiguous (n_compartments, n_t) array. Compartments are accessed as
+    named views (res.S, res.I...) and the model parameters (R0, beta...)
+    as attributes. Values are normalized (fractions of N) unless absolute.
+    """
+    __slots__ = ('names', 'data', 't', 'N', 'absolute', 'params', '_index')
+
+    def __init__(self, names, t, N, dtype=np.float64, absolute=False, **params):
+        self.names    = tuple(names)
+        self.data     = np.empty((len(self.names), len(t)), dtype=dtype)
+        self.t        = t
+        self.N        = N
+        self.absolute = absolute
+        self.params   = params
+        self._index   = {name: i for i, name in enumerate(self.names)}
+
+    def __getattr__(self, name):
+        try:
+            index = object.__getattribute__(self, '_index')
+            if name in index:
+                return self.data[index[name]]
+            return object.__getattribute__(self, 'params')[name]
+        except (KeyError, AttributeError):
+            raise AttributeError(name) from None
+
+    def __repr__(self):
+        return (f'Compartments({", ".join(self.names)}; n_t = {len(self.t)}, '
+                f'N = {self.N}, absolute = {self.absolute}, {self.params})')
+
+    def to_absolute(self):
+        """Scale in place to number of individuals"""
+        if not self.absolute:
+            self.data *= self.N
+            self.absolute = True
+        return self
+
+    def to_normalized(self):
+        """Scale in place to fractions of the population"""
+        if self.absolute:
+            self.data /= self.N
+            self.absolute = False
+        return self
+
+    def as_dict(self):
+        """Time axis and compartments (views, no copies) by name"""
+        views = {'t': self.t}
+        views.update(zip(self.names, self.data))
+        return views
+
+
+@dataclass
+class StochasticSEIR:
+    """Quantile bands of a stochastic SEIR"""
+    N              : float     # total population
+    t              : np.array  # time axis
+    quantiles      : np.array  # quantile levels of the bands
+    S              : np.array  # bands of susceptible, (n_quantiles, n_t)
+    E              : np.array  # bands of exposed
+    I              : np.array  # bands of infected
+    R              : np.array  # bands of recovered
+    p_extinction   : float     # probability of extinction before a major outbreak
+    n_realizations : int       # number of realizations
+
+
+@dataclass
+class Bootstrap:
+    """Bootstrap of a fit: parameters of the replicates and percentile bands"""
+    t          : np.array  # points of the fitted curve
+    nominal    : np.array  # parameters of the nominal fit
+    pars       : np.array  # parameters of the replicates, (n_boot, n_par)
+    quantiles  : np.array  # quantile levels of the bands
+    bands      : np.array  # bands of the curve, (n_quantiles, n_t)
+    mean       : np.array  # mean curve of the replicates
@@ -0,0 +1,107 @@
+"""
+Local multi-worker HTTP server around lambda_handler.
+
+Concurrent requests for the same scenario (same canonical parameter key)
+are coalesced: the first one runs the model and the others wait for it
+and share its serialized response.
+
+Usage:
+    python local_server.py [port]
+    curl -X POST -d @payload.json http://localhost:3000/model
+"""
+import sys
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from app import lambda_handler, canonical_key
+
+
+class _Call:
+    """An in-flight computation"""
+    def __init__(self):
+        self.done  = threading.Event()
+        self.value = None
+        self.error = None
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time. Callers arriving while a
+    call for their key is in flight wait for it and share its result"""
+    def __init__(self):
+        self.lock  = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        """Returns the result of fn() and whether it was shared"""
+        with self.lock:
+            call   = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            return call.result(), True
+
+        try:
+            call.value = fn()
+        except Exception as e:
+            call.error = e
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+        return call.result(), False
+
+
+flight = SingleFlight()
+
+
+class ModelHandler(BaseHTTPRequestHandler):
+    """Translates HTTP requests into API Gateway events for lambda_handler"""
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body   = self.rfile.read(length).decode('utf-8')
+        try:
+            key = canonical_key(json.loads(body))
+        except (ValueError, AttributeError):
+            self.send_error(400, 'Invalid JSON body')
+            return
+        # conditional requests get a 304 instead of the body, keep them apart
+        key += '|' + self.headers.get('If-None-Match', '')
+
+        event = {'body'      : body,
+                 'path'      : self.path,
+                 'httpMethod': 'POST',
+                 'headers'   : dict(self.headers)}
+        try:
+            response, _ = flight.do(key, lambda: lambda_handler(event, None))
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+
+        payload = response['body'].encode('utf-8')
+        self.send_response(response['statusCode'])
+        for name, value in response['headers'].items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def run(port=3000):
+    server = ThreadingHTTPServer(('', port), ModelHandler)
+    print(f'Serving lambda_handler on port {port}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 3000)
@@ -1,5 +1,6 @@
 import json
 
+import numpy as np
 import pytest
 
 from covid_server import app
@@ -167,7 +168,7 @@ def test_beds(request_beds, mocker):
     assert ret["statusCode"] == 200
     assert len(data['t']) == params.days + 1
 
-    assert len(data) == 20
+    assert len(data) == 21
     regions = ['Andalucía', 'Aragón', 'Asturias', 'Baleares', 'Canarias',
                'Cantabria', 'Cas-León', 'Cas-Mancha', 'Cataluña', 'Valencia',
                'Extremadura', 'Galicia', 'Madrid', 'Murcia', 'Navarra',
@@ -176,3 +177,480 @@ def test_beds(request_beds, mocker):
     for region in regions:
         assert 'capacity' in data[region]
         assert  len(data[region]['camas']) == params.days + 1
+
+    assert data['events'] == {'peak': None, 'extinction': None}
+    for region in regions:
+        assert data[region]['capacity_day'] is None
+
+
+def test_beds_events(request_beds, mocker):
+    payload = json.loads(request_beds["body"])
+    payload["params"]["M"] = "0.8"
+    request_beds["body"] = json.dumps(payload)
+
+    data = json.loads(app.lambda_handler(request_beds, "")["body"])
+    peak = data['events']['peak']
+
+    assert 0 < peak < params.days
+    assert max(data['Madrid']['camas']) == data['Madrid']['camas'][round(peak)]
+
+    # the flat model saturates all the regions at the same time
+    for region in app.poblacion[0]:
+        day = data[region]['capacity_day']
+        assert day == pytest.approx(data['Madrid']['capacity_day'])
+        assert data[region]['camas'][int(day)] <= data[region]['capacity']
+        assert data[region]['camas'][int(day) + 1] > data[region]['capacity']
+
+
+def test_beds_stops_at_extinction(request_beds, mocker):
+    payload = json.loads(request_beds["body"])
+    payload["params"]["days"] = 5000
+    request_beds["body"] = json.dumps(payload)
+
+    data = json.loads(app.lambda_handler(request_beds, "")["body"])
+
+    assert data['events']['extinction'] < 5000
+    assert len(data['t']) < 5001
+    assert 'partial' not in data
+
+
+class ExpiringContext:
+    """Lambda context with no time left"""
+    def get_remaining_time_in_millis(self):
+        return 0
+
+
+def test_sir_partial_when_out_of_time(request_sir, mocker):
+    app.scenario_cache.clear()
+
+    ret = app.lambda_handler(request_sir, ExpiringContext())
+    data = json.loads(ret["body"])
+
+    assert ret["statusCode"] == 200
+    assert data['partial']
+    assert len(data['t']) < params.days + 1
+    assert len(data['S']) == len(data['t'])
+
+
+def test_canonical_key_normalizes_numbers():
+    a = {"model": "beds", "params": {"R0": "3", "days": 100}}
+    b = {"params": {"days": "100.0", "R0": 3.0}, "model": "beds"}
+
+    assert app.canonical_key(a) == app.canonical_key(b)
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    import threading
+    import time
+    from covid_server import local_server
+
+    flight  = local_server.SingleFlight()
+    release = threading.Event()
+    calls   = []
+
+    def solve():
+        calls.append(1)
+        release.wait()
+        return 'body'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do('key', solve)))
+               for i in range(8)]
+    for thread in threads: thread.start()
+    time.sleep(0.2)
+    release.set()
+    for thread in threads: thread.join()
+
+    assert len(calls) == 1
+    assert [value for value, _ in results] == ['body'] * 8
+    assert sum(shared for _, shared in results) == 7
+
+
+def test_etag_and_not_modified(request_sir, mocker):
+
+    ret = app.lambda_handler(request_sir, "")
+    tag = ret["headers"]["ETag"]
+
+    assert ret["statusCode"] == 200
+    assert "max-age" in ret["headers"]["Cache-Control"]
+
+    request_sir["headers"]["If-None-Match"] = tag
+    ret = app.lambda_handler(request_sir, "")
+
+    assert ret["statusCode"] == 304
+    assert ret["body"] == ""
+    assert ret["headers"]["ETag"] == tag
+
+
+def test_etag_depends_on_params(request_sir):
+    tag = app.lambda_handler(request_sir, "")["headers"]["ETag"]
+
+    payload = json.loads(request_sir["body"])
+    payload["params"]["R0"] = 2.5
+    request_sir["body"] = json.dumps(payload)
+
+    assert app.lambda_handler(request_sir, "")["headers"]["ETag"] != tag
+
+
+def test_partial_results_are_not_cached(request_sir, mocker):
+    app.scenario_cache.clear()
+
+    ret = app.lambda_handler(request_sir, ExpiringContext())
+
+    assert "ETag" not in ret["headers"]
+    assert ret["headers"]["Cache-Control"] == "no-store"
+
+
+@pytest.mark.parametrize("Q, method", ((0, "analytic"), (50, "solver")))
+def test_sir_summary_only(request_sir, Q, method):
+    payload = json.loads(request_sir["body"])
+    payload["params"]["Q"] = Q
+    payload["params"]["summary_only"] = True
+    request_sir["body"] = json.dumps(payload)
+
+    data = json.loads(app.lambda_handler(request_sir, "")["body"])
+
+    assert data["method"] == method
+    assert 0 < data["peak_I"] < params.N
+    assert 0 < data["peak_day"]
+    assert 0 < data["attack_rate"] < 1
+
+
+def test_sir_summary_matches_trajectory():
+    summary = app.compute_sir_summary(params.R0, params.T, params.Tm, 0,
+                                      params.days, params.N, False)
+    sir     = app.compute_basic_sir_model(params.R0, params.T, params.Tm, 0,
+                                          1000, params.N, False)
+
+    assert summary["peak_I"]      == pytest.approx(sir.I.max(), rel=1e-3)
+    assert summary["peak_day"]    == pytest.approx(sir.t[sir.I.argmax()], abs=0.5)
+    assert summary["attack_rate"] == pytest.approx(1 - sir.S[-1], rel=1e-4)
+
+
+def test_metapop(request_beds, mocker):
+    payload = json.loads(request_beds["body"])
+    payload["model"] = "metapop"
+    payload["params"]["seed"] = "Madrid"
+    request_beds["body"] = json.dumps(payload)
+
+    ret = app.lambda_handler(request_beds, "")
+    data = json.loads(ret["body"])
+
+    assert ret["statusCode"] == 200
+    assert len(data['t']) == params.days + 1
+    assert len(data) == 20
+
+    # the epidemic starts in Madrid and reaches the rest later
+    assert data['Madrid']['camas'][0] > 0
+    assert data['Galicia']['camas'][0] == 0
+    assert max(data['Galicia']['camas']) > 0
+
+
+def test_beds_age_structured(request_beds, mocker):
+    flat = json.loads(app.lambda_handler(request_beds, "")["body"])
+
+    # identical age groups reproduce the homogeneous model
+    payload = json.loads(request_beds["body"])
+    payload["params"]["contacts"] = [[1, 1, 1], [1, 1, 1], [1, 1, 1]]
+    payload["params"]["age_dist"] = [0.2, 0.5, 0.3]
+    payload["params"]["f_uci"   ] = [0.05, 0.05, 0.05]
+    request_beds["body"] = json.dumps(payload)
+    data = json.loads(app.lambda_handler(request_beds, "")["body"])
+
+    assert data.keys() == flat.keys()
+    assert data["Madrid"].keys() == flat["Madrid"].keys()
+    assert data["Madrid"]["camas"] == pytest.approx(flat["Madrid"]["camas"], rel=1e-4, abs=1e-6)
+
+    # older groups in ICU: more beds than the flat 5 %
+    payload["params"]["f_uci"] = [0.001, 0.02, 0.2]
+    request_beds["body"] = json.dumps(payload)
+    data = json.loads(app.lambda_handler(request_beds, "")["body"])
+
+    assert max(data["Madrid"]["camas"]) > max(flat["Madrid"]["camas"])
+
+
+def test_beds_partial_when_out_of_time(request_beds, mocker):
+
+    ret = app.lambda_handler(request_beds, ExpiringContext())
+    data = json.loads(ret["body"])
+
+    assert data['partial']
+    assert len(data['t']) < params.days + 1
+    assert len(data['Madrid']['camas']) == len(data['t'])
+
+
+def test_sir_resolution_from_cached_solution(request_sir):
+    app.scenario_cache.clear()
+    daily = json.loads(app.lambda_handler(request_sir, "")["body"])
+    assert len(app.scenario_cache) == 1
+
+    payload = json.loads(request_sir["body"])
+    payload["params"]["resolution"] = 0.25
+    request_sir["body"] = json.dumps(payload)
+    fine = json.loads(app.lambda_handler(request_sir, "")["body"])
+
+    assert len(app.scenario_cache) == 1
+    assert len(fine['t']) == 4 * params.days + 1
+    assert fine['I'][::4] == pytest.approx(daily['I'], rel=1e-6)
+    assert 'partial' not in fine
+
+
+def test_seir_t_eval(request_seir):
+    payload = json.loads(request_seir["body"])
+    payload["params"]["t_eval"] = [0, 0.5, 10.25, 99.5]
+    request_seir["body"] = json.dumps(payload)
+
+    data = json.loads(app.lambda_handler(request_seir, "")["body"])
+
+    assert data['t'] == [0, 0.5, 10.25, 99.5]
+    assert len(data['E']) == 4
+
+
+def test_fit_warm_starts_from_previous_fit(apigw_event):
+    from c19 import cfitsir
+    app.fit_cache.clear()
+    app.fit_latest.clear()
+
+    t = np.arange(101.)
+    I = np.round(cfitsir.sir(1e6, 0.35, 1/8, (1e6 - 10, 10, 0), t).I)
+
+    def fit(days, version, context=""):
+        apigw_event["body"] = json.dumps({"model": "fit", "params": {
+            "region": "Madrid", "N": 1e6, "I": I[:days].tolist(), "data_version": version}})
+        ret = app.lambda_handler(apigw_event, context)
+        assert "ETag" not in ret["headers"]
+        assert ret["headers"]["Cache-Control"] == "no-store"
+        return json.loads(ret["body"])
+
+    stopped = fit(100, "day-100", ExpiringContext())
+    assert stopped['partial']
+    assert not app.fit_cache and not app.fit_latest
+
+    cold = fit(100, "day-100")
+    assert not cold['warm_start'] and not cold['cached']
+    assert cold['beta']  == pytest.approx(0.35 , rel=1e-3)
+    assert cold['gamma'] == pytest.approx(1 / 8, rel=1e-3)
+
+    warm = fit(101, "day-101")
+    assert warm['warm_start']
+    assert warm['nsolves'] < cold['nsolves']
+    assert warm['R0'] == pytest.approx(2.8, rel=1e-3)
+
+    assert fit(101, "day-101")['cached']
+
+
+def test_unknown_model_is_a_bad_request(request_sir):
+    payload = json.loads(request_sir["body"])
+    payload["model"] = "SIRS"
+    request_sir["body"] = json.dumps(payload)
+
+    ret = app.lambda_handler(request_sir, "")
+
+    assert ret["statusCode"] == 400
+    assert "error" in json.loads(ret["body"])
+    assert "ETag" not in ret["headers"]
+    assert "Cache-Control" not in ret["headers"]
+
+
+def test_summary_partial_when_out_of_time(request_seir):
+    payload = json.loads(request_seir["body"])
+    payload["params"]["summary_only"] = True
+    request_seir["body"] = json.dumps(payload)
+
+    ret  = app.lambda_handler(request_seir, ExpiringContext())
+    data = json.loads(ret["body"])
+
+    assert data["partial"]
+    assert ret["headers"]["Cache-Control"] == "no-store"
+
+
+def test_metapop_unknown_seed_and_deadline(request_beds):
+    payload = json.loads(request_beds["body"])
+    payload["model"] = "metapop"
+    payload["params"]["seed"] = "Atlantis"
+    request_beds["body"] = json.dumps(payload)
+
+    assert app.lambda_handler(request_beds, "")["statusCode"] == 400
+
+    payload["params"]["seed"] = "Madrid"
+    request_beds["body"] = json.dumps(payload)
+    data = json.loads(app.lambda_handler(request_beds, ExpiringContext())["body"])
+
+    assert data['partial']
+    assert len(data['Madrid']['camas']) == len(data['t'])
+
+
+@pytest.mark.parametrize("age", (
+    {"contacts": [[1, 1], [1, 1]]},
+    {"contacts": [[1, 1], [1, 1]], "age_dist": [0.2, 0.5, 0.3], "f_uci": [0.05] * 3},
+    {"contacts": [[1, 1], [1, 1]], "age_dist": [0, 0], "f_uci": [0.05] * 2},
+    {"contacts": [[1, 1], [1, 1]], "age_dist": [0.5, 0.5], "f_uci": [0.05]}))
+def test_beds_age_bad_request(request_beds, age):
+    payload = json.loads(request_beds["body"])
+    payload["params"].update(age)
+    request_beds["body"] = json.dumps(payload)
+
+    assert app.lambda_handler(request_beds, "")["statusCode"] == 400
+
+
+def test_beds_age_normalizes_and_stops_at_deadline(request_beds):
+    payload = json.loads(request_beds["body"])
+    payload["params"].update({"contacts": [[2, 1], [1, 2]], "f_uci": [0.01, 0.1]})
+    payload["params"]["age_dist"] = [0.4, 0.6]
+    request_beds["body"] = json.dumps(payload)
+    data = json.loads(app.lambda_handler(request_beds, "")["body"])
+
+    payload["params"]["age_dist"] = [40, 60]
+    request_beds["body"] = json.dumps(payload)
+    assert json.loads(app.lambda_handler(request_beds, "")["body"]) == data
+
+    data = json.loads(app.lambda_handler(request_beds, ExpiringContext())["body"])
+    assert data['partial']
+    assert len(data['Madrid']['camas']) == len(data['t'])
+
+
+@pytest.mark.parametrize("resolution", (0, -1, "fine"))
+def test_sir_bad_resolution(request_sir, resolution):
+    payload = json.loads(request_sir["body"])
+    payload["params"]["resolution"] = resolution
+    request_sir["body"] = json.dumps(payload)
+
+    assert app.lambda_handler(request_sir, "")["statusCode"] == 400
+
+
+def test_tiny_resolution_is_thinned_without_allocating(request_sir):
+    payload = json.loads(request_sir["body"])
+    payload["params"]["resolution"] = 1e-12
+    request_sir["body"] = json.dumps(payload)
+
+    data = json.loads(app.lambda_handler(request_sir, "")["body"])
+
+    assert data["partial"]
+    assert len(data["t"]) <= app.LAMBDA_TIMEOUT_MS * app.POINTS_PER_MS
+
+
+@pytest.mark.parametrize("model", (app.compute_beds_seir_model, app.compute_metapop_seir_model))
+def test_coarse_time_range_ends_at_days(model):
+    result = model(3, 7, 5, 1000, 15, 0.35, t_inc=3)
+    if isinstance(result, tuple):
+        result = result[0]
+
+    assert result.t[-1] == 1000
+    assert np.all(np.diff(result.t) <= 3)
+
+
+@pytest.mark.parametrize("mobility", (
+    [[1, 0], [0, 1]],
+    {"rows": [0, 1], "cols": [0, 1]},
+    {"rows": [0, 1], "cols": [0, 1], "vals": ["a", 1]},
+    {"rows": [0, 1], "cols": [0], "vals": [1, 1]},
+    {"rows": [0, 19], "cols": [0, 1], "vals": [1, 1]},
+    {"rows": [0, -1], "cols": [0, 1], "vals": [1, 1]},
+    {"rows": [0, 0.5], "cols": [0, 1], "vals": [1, 1]},
+    {"rows": [0, 1], "cols": [0, 1], "vals": [1, -1]}))
+def test_metapop_bad_mobility(request_beds, mobility):
+    payload = json.loads(request_beds["body"])
+    payload["model"] = "metapop"
+    payload["params"]["mobility"] = mobility
+    request_beds["body"] = json.dumps(payload)
+
+    ret = app.lambda_handler(request_beds, "")
+
+    assert ret["statusCode"] == 400
+    assert "mobility" in json.loads(ret["body"])["error"]
+
+
+def test_metapop_mobility(request_beds):
+    payload = json.loads(request_beds["body"])
+    payload["model"] = "metapop"
+    payload["params"]["seed"] = "Madrid"
+    # no travel between the regions: the epidemic stays in Madrid
+    payload["params"]["mobility"] = {"rows": list(range(19)), "cols": list(range(19)),
+                                     "vals": [1] * 19}
+    request_beds["body"] = json.dumps(payload)
+
+    data = json.loads(app.lambda_handler(request_beds, "")["body"])
+
+    assert max(data['Madrid']['camas']) > 0
+    assert max(data['Galicia']['camas']) == 0
+
+
+def test_beds_age_events_and_extinction(request_beds):
+    payload = json.loads(request_beds["body"])
+    payload["params"].update({"M": "0.8", "days": 5000})
+    request_beds["body"] = json.dumps(payload)
+    flat = json.loads(app.lambda_handler(request_beds, "")["body"])
+
+    # identical age groups have the events of the homogeneous model
+    payload["params"].update({"contacts": [[1, 1], [1, 1]], "age_dist": [0.4, 0.6],
+                              "f_uci": [0.05, 0.05]})
+    request_beds["body"] = json.dumps(payload)
+    data = json.loads(app.lambda_handler(request_beds, "")["body"])
+
+    assert data['events']['peak'] == pytest.approx(flat['events']['peak'], abs=1e-2)
+    assert data['events']['extinction'] == pytest.approx(flat['events']['extinction'], rel=1e-3)
+    assert len(data['t']) == len(flat['t']) < 5001
+    assert 'partial' not in data
+    for region in app.poblacion[0]:
+        assert data[region]['capacity_day'] == pytest.approx(flat[region]['capacity_day'], abs=1e-2)
+
+    # the capacity is that of the beds of the older group
+    payload["params"]["f_uci"] = [0, 0.1]
+    request_beds["body"] = json.dumps(payload)
+    data = json.loads(app.lambda_handler(request_beds, "")["body"])
+
+    day = data['Madrid']['capacity_day']
+    assert data['Madrid']['camas'][int(day)] <= data['Madrid']['capacity']
+    assert data['Madrid']['camas'][int(day) + 1] > data['Madrid']['capacity']
+
+
+@pytest.mark.parametrize("t_eval", (None, "soon", ["a", 1], [[0, 1], [2, 3]], [-1, 1000]))
+def test_seir_bad_t_eval(request_seir, t_eval):
+    payload = json.loads(request_seir["body"])
+    payload["params"]["t_eval"] = t_eval
+    request_seir["body"] = json.dumps(payload)
+
+    ret = app.lambda_handler(request_seir, ExpiringContext())
+
+    assert ret["statusCode"] == 400
+    assert "t_eval" in json.loads(ret["body"])["error"]
+
+
+def fit_request(apigw_event, **params):
+    apigw_event["body"] = json.dumps({"model": "fit",
+                                      "params": dict({"region": "Madrid", "N": 1e6}, **params)})
+    return app.lambda_handler(apigw_event, "")
+
+
+@pytest.mark.parametrize("params", (
+    {"kind": "SEIRX", "I": [10, 20, 40]},
+    {"I": []},
+    {"I": [10]},
+    {"I": [10, 20, 40], "t": [0, 1]},
+    {"I": [10, 20, 40], "N": "many"},
+    {"I": [10, 20, 40], "N": 0},
+    {"I": [10, 30, 5, 1]}))
+def test_fit_bad_request(apigw_event, params):
+    app.fit_cache.clear()
+    app.fit_latest.clear()
+
+    assert fit_request(apigw_event, **params)["statusCode"] == 400
+    assert not app.fit_cache and not app.fit_latest
+
+
+def test_fit_default_version_depends_on_t_and_N(apigw_event):
+    app.fit_cache.clear()
+    app.fit_latest.clear()
+    I = [10, 14, 20, 27, 38, 52]
+
+    first = json.loads(fit_request(apigw_event, I=I)["body"])
+    assert json.loads(fit_request(apigw_event, I=I)["body"])["cached"]
+
+    for params in ({"N": 2e6}, {"t": [0, 2, 4, 6, 8, 10]}):
+        other = json.loads(fit_request(apigw_event, I=I, **params)["body"])
+        assert not other["cached"]
+        assert other["data_version"] != first["data_version"]
+
+    # N is in the key even for an explicit data version
+    fit_request(apigw_event, I=I, data_version="v1")
+    assert not json.loads(fit_request(apigw_event, I=I, N=2e6, data_version="v1")["body"])["cached"]
@@ -0,0 +1,554 @@
+import numpy as np
+
+import pytest
+
+import c19.basic_models as cbm
+
+
+t_range = np.arange(0, 101, 1.)
+M       = cbm.mitigation_function(t_range, [(0, 15), (15, 100)], [1, 0.35])
+
+
+def numerical_jacobian(deriv, y, t, args, eps=1e-7):
+    y   = np.asarray(y, dtype=float)
+    f0  = np.array(deriv(y, t, *args))
+    jac = np.empty((len(f0), len(y)))
+    for j in range(len(y)):
+        dy     = np.zeros_like(y)
+        dy[j]  = eps
+        jac[:, j] = (np.array(deriv(y + dy, t, *args)) - f0) / eps
+    return jac
+
+
+@pytest.mark.parametrize("deriv, jac, y, args", (
+    (cbm.sir_deriv       , cbm.sir_jac       , (0.7, 0.2, 0.1),
+     (M, 0.5, 1/7)),
+    (cbm.seir_deriv_time , cbm.seir_jac_time , (0.7, 0.1, 0.1),
+     (M, 0.5, 1/7, 1/5)),
+    (cbm.seir2_deriv_time, cbm.seir2_jac_time, (0.6, 0.1, 0.1, 0.1, 0.05, 0.05),
+     (M, 0.5, 1/7, 1/5, 0.01, 0.1, 0.03))))
+def test_analytic_jacobians(deriv, jac, y, args):
+    for t in (5., 40.):
+        np.testing.assert_allclose(jac(y, t, *args),
+                                   numerical_jacobian(deriv, y, t, args),
+                                   atol=1e-6)
+
+
+def test_metapop_uncoupled_patches_follow_seir():
+    n  = 3
+    C  = cbm.mobility_matrix(n, np.arange(n), np.arange(n), np.ones(n))
+    I0 = np.array([1e-4, 1e-3, 0.])
+    E0 = np.zeros(n)
+    ts = [(0, 15), (15, 100)]
+    ms = [1, 0.35]
+
+    meta = cbm.compute_metapop_seir(np.ones(n), (1 - I0, E0, I0), 3., 1/7, 1/5, C,
+                                    t_range, ts, ms)
+    for i in range(n):
+        seir = cbm.compute_seir(1, (1 - I0[i], E0[i], I0[i]), 3., 1/7, 1/5,
+                                t_range, ts, ms)
+        np.testing.assert_allclose(meta.I[i], seir.I, atol=1e-6)
+
+
+def test_tau_leap_seir():
+    from c19.stochastic_models import tau_leap_seir
+
+    run = lambda: tau_leap_seir(84777, 2.5, 1/7, 1/5, 100, n_realizations=2000,
+                                dt=0.25, seed=7)
+    seir = run()
+
+    assert seir.I.shape == (3, 101)
+    assert np.all(seir.I[0] <= seir.I[1]) and np.all(seir.I[1] <= seir.I[2])
+    # branching process: extinction probability close to 1/R0
+    assert 0.3 < seir.p_extinction < 0.5
+    np.testing.assert_array_equal(run().I, seir.I)
+
+
+def test_compartments_views_and_scaling():
+    seir = cbm.compute_seir(1000, (1 - 2e-4, 1e-4, 1e-4), 3., 1/7, 1/5, t_range)
+
+    assert seir.data.shape == (4, len(t_range))
+    assert seir.data.flags['C_CONTIGUOUS']
+    assert np.shares_memory(seir.I, seir.data)
+    np.testing.assert_allclose(seir.S + seir.E + seir.I + seir.R, 1)
+    assert seir.R0 == 3.
+
+    I = seir.I.copy()
+    seir.to_absolute()
+    np.testing.assert_allclose(seir.I, 1000 * I)
+    seir.to_normalized()
+    np.testing.assert_allclose(seir.I, I)
+
+    single = cbm.compute_seir(1000, (1 - 2e-4, 1e-4, 1e-4), 3., 1/7, 1/5, t_range,
+                              dtype=np.float32)
+    assert single.data.dtype == np.float32
+    np.testing.assert_allclose(single.I, I, rtol=1e-5)
+
+
+def test_sir_likelihood_matches_rv_histogram():
+    from c19 import cfitsir
+
+    llike = cfitsir.SIRLikelihood(cache_size=2)
+    times = np.random.default_rng(3).uniform(-5, 105, 500)
+    for pars in ((20000, 0.4, 1/7), (20000, 0.3, 1/10), (20000, 0.4, 1/7)):
+        np.testing.assert_allclose(llike(times, *pars), cfitsir.sir_llike(times, *pars))
+        np.testing.assert_allclose(llike.fun(times, *pars), cfitsir.sir_fun(times, *pars))
+
+    assert llike.nsolves == 2
+    llike(times, 20000, 0.5, 1/7)
+    assert len(llike.cache) == 2
+
+
+def test_sir_kfilter_batch_matches_scalar():
+    from c19 import cfitsir
+
+    np.random.seed(5)
+    series = [cfitsir.sir_experiment(cfitsir.sir(20000, beta, 1/7)) for beta in (0.3, 0.4, 0.5)]
+    cis = np.array([s[0] for s in series])
+    ris = np.array([s[1] for s in series])
+
+    xs, uxs = cfitsir.sir_kfilter_batch(cis, ris, cfitsir.ts)
+
+    assert xs.shape == (3, len(cfitsir.ts), 2)
+    for k in range(3):
+        x, ux = cfitsir.sir_kfilter(cis[k], ris[k], cfitsir.ts)
+        np.testing.assert_allclose(xs[k] , np.array(x) , rtol=1e-10)
+        np.testing.assert_allclose(uxs[k], np.array(ux), rtol=1e-8, atol=1e-12)
+
+
+def test_sir_kalman_online_resumes_from_file(tmp_path):
+    from c19 import cfitsir
+
+    np.random.seed(6)
+    series = [cfitsir.sir_experiment(cfitsir.sir(20000, beta, 1/7)) for beta in (0.3, 0.5)]
+    cis = np.array([s[0] for s in series])
+    ris = np.array([s[1] for s in series])
+    dt  = cfitsir.ts[1] - cfitsir.ts[0]
+    xs, uxs = cfitsir.sir_kfilter_batch(cis, ris, cfitsir.ts)
+
+    kf = cfitsir.SIRKalmanOnline(2, dt=dt)
+    kf.update(cis[:, :120], ris[:, :120])
+    xs0, uxs0 = kf.update(cis[:, :0], ris[:, :0])
+    assert xs0.shape == (2, 0, 2) and uxs0.shape == (2, 0, 2, 2)
+    kf.save(tmp_path / 'state')
+    assert cfitsir.SIRKalmanOnline.load(tmp_path / 'state').ndays == 120
+    kf.save(tmp_path / 'state.npz')
+    for day in range(120, 199):
+        kf = cfitsir.SIRKalmanOnline.load(tmp_path / 'state.npz')
+        kf.update(cis[:, day], ris[:, day])
+        kf.save(tmp_path / 'state.npz')
+
+    assert kf.ndays == 199
+    np.testing.assert_allclose(kf.x , xs [:, -2], rtol=1e-10)
+    np.testing.assert_allclose(kf.ux, uxs[:, -2], rtol=1e-8, atol=1e-12)
+
+
+def test_sir_experiments_chunks_and_distribution():
+    from c19 import cfitsir
+
+    sir    = cfitsir.sir(20000, 0.4, 1/7)
+    chunks = list(cfitsir.sir_experiments(sir, 5000, chunk_size=2000, seed=1))
+
+    assert [len(cis) for cis, crs in chunks] == [2000, 2000, 1000]
+    cis = np.concatenate([c[0] for c in chunks])
+    crs = np.concatenate([c[1] for c in chunks])
+    assert cis.shape == crs.shape == (5000, len(sir.t))
+
+    # same distribution as sir_experiment: n + Poisson(|delta n|)
+    for ns, cns in ((sir.I, cis), (sir.R, crs)):
+        dns = np.abs(np.diff(ns, prepend=0))
+        np.testing.assert_allclose(cns.mean(axis=0), ns + dns, atol=5 * np.sqrt(dns.max() / 5000))
+        np.testing.assert_allclose(cns.var (axis=0), dns, rtol=0.2, atol=0.05)
+
+
+def test_fit_regions_in_process_pool():
+    import pandas as pd
+    from c19 import cfitsir
+    from c19.fit_regions import fit_regions
+
+    dates = pd.date_range('2020-03-01', periods=100)
+    frames = []
+    for region, beta in (('A', 0.3), ('B', 0.45), ('C', 0.3)):
+        I = np.round(cfitsir.sir(1e6, beta, 1/8, (1e6 - 10, 10, 0), np.arange(100.)).I)
+        I[:5] = 0
+        if region == 'C':
+            I[:] = 0
+        frames.append(pd.DataFrame({'dateRep': dates, 'cases': I, 'popData2018': 1e6,
+                                    'countriesAndTerritories': region}))
+    df = pd.concat(frames, ignore_index=True)
+
+    fits = fit_regions(df, n_workers=2)
+
+    assert list(fits.index) == ['A', 'B', 'C']
+    assert list(fits.first_day) == [5, 5, -1]
+    assert list(fits.fitted) == [True, True, False]
+    assert np.isnan(fits.beta['C'])
+    fits = fits[fits.fitted]
+    np.testing.assert_allclose(fits.beta , (0.3, 0.45), rtol=1e-2)
+    np.testing.assert_allclose(fits.gamma, 1/8, rtol=1e-2)
+    assert np.all(fits.seconds > 0)
+
+
+@pytest.mark.parametrize("kind, pars, y0", (
+    ('SIR' , (0.35, 1/8)     , (1e6 - 10, 10, 0)),
+    ('SEIR', (0.5 , 1/8, 1/5), (1e6 - 20, 10, 10))))
+def test_sensitivity_gradient_and_fit(kind, pars, y0):
+    from c19 import cfitsir
+
+    t     = np.arange(100.)
+    model = cfitsir.sir if kind == 'SIR' else cfitsir.seir
+    Like  = cfitsir.SIRLikelihood if kind == 'SIR' else cfitsir.SEIRLikelihood
+    I     = np.round(model(1e6, *pars, y0, t).I)
+    llike = Like(t, y0, sensitivities=True)
+
+    p    = 1.1 * np.array(pars)
+    grad = llike.grad(t, 1e6, *p, weights=I)
+    for j in range(len(p)):
+        dp = np.zeros(len(p))
+        dp[j] = 1e-6
+        num = (np.sum(I * llike(t, 1e6, *(p + dp))) - np.sum(I * llike(t, 1e6, *(p - dp)))) / 2e-6
+        assert grad[j + 1] == pytest.approx(num, rel=1e-3)
+
+    pbest, _ = cfitsir.fit_series(t, I, 1e6, 1.3 * np.array(pars), kind, gradient=True)
+    np.testing.assert_allclose(pbest, pars, rtol=2e-3)
+
+
+def test_htsimple_pvalues_match_analytic():
+    import scipy.stats as stats
+    from c19 import htests
+
+    # q = 2 sum(x) - n_obs for N(1, 1) against N(0, 1)
+    h = htests.htsimple(stats.norm(0, 1), stats.norm(1, 1), 20000, n_obs=4, seed=1)
+    q = 1.
+    assert h.p0value(q) == pytest.approx(stats.norm(0, 2).sf((q + 4) / 2), abs=0.01)
+    assert h.p1value(q) == pytest.approx(stats.norm(4, 2).cdf((q + 4) / 2), abs=0.01)
+    assert h.cls(q) == pytest.approx(h.p1value(q) / (1 - h.p0value(q)), rel=1e-3)
+
+
+def test_htcomposite_toys_in_process_pool():
+    import scipy.stats as stats
+    from c19 import htests
+
+    hc = htests.htcomposite(stats.norm, (1., 1.), masknu=(False, True))
+    xs = hc.rvs(1., size=20, n_obs=30, seed=2)
+
+    tmus = hc.tmu(xs, 1.)
+    assert tmus.shape == (20,) and np.all(tmus >= -1e-6)
+    hc.n_workers = 2
+    np.testing.assert_allclose(hc.tmu(xs, 1.), tmus)
+
+    q0s = hc.q0(xs, 0.5)
+    assert np.all(q0s > 0)
+    ts = np.sort(tmus)
+    assert hc.pvalue_rvs(ts[0], ts) == 1 and hc.pvalue_rvs(ts[-1] + 1, ts) == 0
+
+
+def test_htcomposite_sidedness():
+    import scipy.stats as stats
+    from c19 import htests
+
+    hc = htests.htcomposite(stats.norm, (1., 1.), masknu=(False, True))
+    xs = hc.rvs(1., size=20, n_obs=30, seed=3)
+
+    # q0 is evidence of mu above mu0, qmu of mu below mu
+    assert np.all(hc.q0 (xs, 0.5) > 0) and np.all(hc.q0 (xs, 1.5) == 0)
+    assert np.all(hc.qmu(xs, 1.5) > 0) and np.all(hc.qmu(xs, 0.5) == 0)
+
+
+def test_profile_cint():
+    import scipy.stats as stats
+    from c19 import cfit
+
+    x = np.random.default_rng(4).normal(2, 1, 100)
+    # sigma fixed: vectorized scan, exact interval mean +- z / sqrt(n)
+    prof = cfit.profile(x, stats.norm.logpdf, (1., 1.), (True, False))
+    half = np.sqrt(stats.chi2(1).ppf(0.68)) / 10
+    np.testing.assert_allclose(prof.cint(), (x.mean() - half, x.mean() + half), atol=1e-4)
+
+    # sigma free: memoized conditional fits
+    prof = cfit.profile(x, stats.norm.logpdf, (1., 1.), (True, False), (False, True))
+    lo, up = prof.cint()
+    assert lo < prof.mubest < up
+    assert prof.tmu(lo) == pytest.approx(stats.chi2(1).ppf(0.68), abs=1e-3)
+    nfits = len(prof.fits)
+    prof.tmu(up)
+    assert len(prof.fits) == nfits
+
+
+def test_r0_cint():
+    from c19 import cfitsir
+
+    t = np.arange(100.)
+    I = np.round(cfitsir.sir(1e5, 0.35, 1/8, (1e5 - 10, 10, 0), t).I)
+    r0, (lo, up), _ = cfitsir.r0_cint(t, I, 1e5, (0.3, 0.1))
+
+    assert r0 == pytest.approx(2.8, rel=1e-3)
+    assert lo < 2.8 < up
+
+
+def test_quantile_accumulator_streams_chunks():
+    from c19.bootstrap import QuantileAccumulator
+
+    X   = np.random.default_rng(0).normal(np.arange(5.) * 10, np.arange(1, 6.), size=(20000, 5))
+    acc = QuantileAccumulator(5)
+    for chunk in np.array_split(X, 40):
+        acc.update(chunk)
+
+    qs = (0.025, 0.5, 0.975)
+    np.testing.assert_allclose(acc.quantiles(qs), np.quantile(X, qs, axis=0), atol=0.03)
+    np.testing.assert_allclose(acc.mean(), X.mean(axis=0))
+
+
+def test_quantile_accumulator_grows_its_range():
+    from c19.bootstrap import QuantileAccumulator
+
+    rng = np.random.default_rng(1)
+    X   = rng.normal(0, 1, size=(20000, 3)) * np.array([1, 20, 300])
+    X[:4] = rng.normal(0, 1e-3, size=(4, 3))   # a first chunk much narrower than the rest
+    X[-1] = (-1e4, 1e4, np.nan)
+    acc = QuantileAccumulator(3)
+    for chunk in np.array_split(X, 5000):
+        acc.update(chunk)
+
+    qs   = (0.001, 0.025, 0.5, 0.975, 0.999)
+    np.testing.assert_allclose(acc.quantiles(qs), np.nanquantile(X, qs, axis=0),
+                               atol=np.max(acc.dx) * 2)
+    assert acc.n[-1] == len(X) - 1
+    assert acc.counts.sum() == 3 * len(X) - 1
+    np.testing.assert_allclose(acc.mean(), np.nanmean(X, axis=0))
+
+
+def test_bootstrap_fit_bands():
+    pytest.importorskip("invisible_cities")
+    from c19 import fit_functions_ic as ffi
+
+    x    = np.arange(30.)
+    y    = np.random.default_rng(2).poisson(ffi.expo(x, 10, 8)).astype(float)
+    fitf, boot = ffi.bootstrap_fit(ffi.expo, x, y, (10, 8), n_boot=200, rng_seed=3,
+                                   sigma=np.sqrt(np.maximum(y, 1)), chunk_size=7)
+
+    assert boot.pars.shape == (200, 2)
+    assert boot.bands.shape == (5, 30)
+    assert np.all(np.diff(boot.bands, axis=0) >= 0)
+    np.testing.assert_allclose(boot.bands[2], fitf.fn(x), rtol=0.05)
+    np.testing.assert_allclose(np.std(boot.pars, axis=0), fitf.errors, rtol=0.3)
+
+
+def test_bootstrap_series_in_process_pool():
+    from c19 import cfitsir
+
+    t = np.arange(100.)
+    I = np.round(cfitsir.sir(1e5, 0.35, 1/8, (1e5 - 10, 10, 0), t).I)
+    kwargs = dict(n_boot=12, seed=1, chunk_size=4)
+    boot = cfitsir.bootstrap_series(t, I, 1e5, (0.35, 0.125), **kwargs)
+
+    assert boot.pars.shape == (12, 2)
+    assert boot.bands.shape == (5, 100)
+    assert np.all(np.diff(boot.bands, axis=0) >= 0)
+    assert boot.bands[0, 40] < I[40] < boot.bands[-1, 40]
+
+    pool = cfitsir.bootstrap_series(t, I, 1e5, (0.35, 0.125), n_workers=2, **kwargs)
+    np.testing.assert_allclose(pool.bands, boot.bands)
+
+
+@pytest.mark.parametrize("std", (False, True))
+def test_binned_stats_match_groupby(std):
+    import pandas as pd
+    from c19.stats import binned_stats
+
+    rng  = np.random.default_rng(0)
+    bins = rng.integers(0, 50, 100000)
+    y    = rng.normal(1e4, 3, 100000)
+    bins[bins == 5] = 6              # empty bin
+    y[::7]          = np.nan         # NaN values
+    y[bins == 3]    = np.nan         # bin with only NaN
+    bins[bins == 49] = 48
+    bins[1]         = 49             # single value bin
+
+    gb  = pd.DataFrame(dict(bin=bins, y=y)).groupby("bin").y
+    dev = gb.std() if std else gb.std() / gb.size()**0.5
+    size, mean, deviation = binned_stats(bins, y, 50, std)
+
+    idx = dev.index.values
+    np.testing.assert_array_equal(np.nonzero(size)[0], idx)
+    np.testing.assert_allclose(mean[idx], gb.mean().values, rtol=1e-12)
+    np.testing.assert_allclose(deviation[idx], dev.values, rtol=1e-9)
+
+
+def test_accumulators_merge_chunks_exactly():
+    from c19.accumulators import BinnedAccumulator, ProfileAccumulator, HistogramAccumulator
+    from c19.stats        import binned_stats
+
+    rng = np.random.default_rng(1)
+    x   = rng.uniform(0, 10, 20000)
+    y   = rng.normal(x, 1) + 1e3
+    y[::11] = np.nan
+
+    profiles = [ProfileAccumulator(50, [(0, 9)]) for i in range(3)]
+    histos   = [HistogramAccumulator(40, [(1, 9)]) for i in range(3)]
+    for k, (xc, yc) in enumerate(zip(np.array_split(x, 7), np.array_split(y, 7))):
+        profiles[k % 3].update(xc, yc)
+        histos  [k % 3].update(xc)
+    centers, mean, dev = profiles[0].merge(profiles[1]).merge(profiles[2]).finalize(drop_nan=False)
+    counts, edges, mu, std = histos[0].merge(histos[1]).merge(histos[2]).finalize()
+
+    sel = (x >= 0) & (x < 9)
+    size, mean0, dev0 = binned_stats(np.digitize(x[sel], np.linspace(0, 9, 51)) - 1, y[sel], 50)
+    np.testing.assert_allclose(mean, mean0, rtol=1e-12)
+    np.testing.assert_allclose(dev , dev0 , rtol=1e-8)
+    np.testing.assert_allclose(centers, np.linspace(0.09, 8.91, 50))
+
+    counts0, edges0 = np.histogram(x, 40, (1, 9))
+    np.testing.assert_array_equal(counts, counts0)
+    np.testing.assert_allclose(edges, edges0)
+    inside = x[(x >= 1) & (x <= 9)]
+    assert mu  == pytest.approx(inside.mean())
+    assert std == pytest.approx(inside.std())
+
+    from c19.stats import mean_and_std
+    x[::13] = np.nan
+    h1 = HistogramAccumulator(40, [(1, 9)])
+    for xc in np.array_split(x, 5):
+        h1.update(xc)
+    assert h1.finalize()[2:] == pytest.approx(mean_and_std(x, (1, 9)))
+    with pytest.raises(TypeError):
+        BinnedAccumulator(10, [(0, 1)])
+
+    h2 = HistogramAccumulator((10, 12), [(0, 10), (990, 1010)])
+    for xc, yc in zip(np.array_split(x, 3), np.array_split(y, 3)):
+        h2.update(xc, yc)
+    counts2, *_ = h2.finalize()
+    np.testing.assert_array_equal(counts2, np.histogram2d(x, y, (10, 12), ((0, 10), (990, 1010)))[0])
+
+
+def test_batch_fits_match_curve_fit():
+    from scipy.optimize import curve_fit
+    from c19.batch_fit  import fit_mask, loglinear_batch, lm_batch
+
+    expo  = lambda x, const, mean: const * np.exp(x / mean)
+    rng   = np.random.default_rng(2)
+    x     = np.arange(40.)
+    const = rng.uniform(5, 50, 20)
+    mean  = rng.uniform(5, 20, 20)
+    ys    = expo(x, const[:, None], mean[:, None])
+    franges = np.stack([rng.integers(0, 10, 20), rng.integers(25, 41, 20)], -1)
+    mask  = fit_mask(x, ys, franges)
+    assert np.array_equal(mask.sum(1), franges[:, 1] - franges[:, 0])
+
+    pars, _ = loglinear_batch(x, ys, mask)
+    np.testing.assert_allclose(np.exp(pars[:, 0]), const, rtol=1e-10)
+    np.testing.assert_allclose(1 / pars[:, 1]    , mean , rtol=1e-10)
+
+    ys         = rng.poisson(ys).astype(float)
+    sigma      = np.sqrt(np.maximum(ys, 1))
+    vals, cov, ok = lm_batch(expo, x, ys, (10., 10.), mask, sigma)
+    assert ok.all()
+    for i in range(len(ys)):
+        sel = mask[i]
+        v, c = curve_fit(expo, x[sel], ys[i, sel], (10., 10.), sigma[i, sel], absolute_sigma=True)
+        np.testing.assert_allclose(vals[i], v, rtol=1e-5)
+        np.testing.assert_allclose(cov [i], c, rtol=1e-3)
+
+
+def test_fit_batch_matches_fit():
+    pytest.importorskip("invisible_cities")
+    from c19 import fit_functions_ic as ffi
+
+    rng    = np.random.default_rng(4)
+    x      = np.arange(40.)
+    ys     = rng.poisson(ffi.expo(x, rng.uniform(5, 50, (6, 1)), rng.uniform(5, 20, (6, 1))))
+    ys     = ys.astype(float)
+    sigma  = np.sqrt(np.maximum(ys, 1))
+    ranges = np.stack([np.arange(6), 30 + np.arange(6)], -1)
+
+    loglinear = ffi.fit_batch(ffi.expo, x, ys, fit_range=ranges, sigma=sigma)
+    lm        = ffi.fit_batch(ffi.expo, x, ys, (10., 10.), fit_range=ranges, sigma=sigma,
+                              linearize=False)
+    assert lm.fn(x).shape == ys.shape
+    for i in range(len(ys)):
+        one = ffi.fit(ffi.expo, x, ys[i], (10., 10.), fit_range=ranges[i], sigma=sigma[i])
+        np.testing.assert_allclose(lm.values[i], one.values, rtol=1e-5)
+        np.testing.assert_allclose(lm.errors[i], one.errors, rtol=1e-3)
+        assert lm.chi2[i] == pytest.approx(one.chi2, rel=1e-6)
+        np.testing.assert_allclose(loglinear.values[i], one.values, rtol=0.1)
+
+
+def test_gauss_and_polynom_scalar_parameters():
+    pytest.importorskip("invisible_cities")
+    from c19 import fit_functions_ic as ffi
+
+    x = np.linspace(-3, 3, 7)
+    assert ffi.gauss(x, 1, 0, 0) == np.inf
+    assert ffi.gauss(x, 1, 0, -1) == np.inf
+    np.testing.assert_allclose(ffi.gauss(x, 2, 0.5, 1.5),
+                               2 / (2 * np.pi)**.5 / 1.5 * np.exp(-0.5 * (x - 0.5)**2 / 1.5**2))
+    np.testing.assert_allclose(ffi.polynom(x, 1, 2, 3), 1 + 2 * x + 3 * x**2)
+    assert ffi.polynom(2., 1, 2, 3) == 17
+    assert ffi.polynom(x, 1, 2, 3).shape == x.shape
+
+    # batched parameters of shape (n_series, 1)
+    pars = np.array([[1., 2., 3.], [0., 1., 0.]])
+    np.testing.assert_allclose(ffi.polynom(x, *pars.T[..., np.newaxis]),
+                               [1 + 2 * x + 3 * x**2, x])
+    g = ffi.gauss(x, 1., 0., np.array([[1.], [-1.]]))
+    assert np.all(np.isfinite(g[0])) and np.all(np.isnan(g[1]))
+
+
+@pytest.mark.parametrize('poisson', (False, True))
+def test_rolling_growth_matches_window_fits(poisson):
+    import pandas as pd
+    from c19.growth import rolling_loglinear, growth_rates
+
+    rng    = np.random.default_rng(3)
+    t      = np.arange(60)
+    ys     = rng.poisson(20 * np.exp(np.array([[0.05], [0.1], [-0.03]]) * t)).astype(float)
+    ys[0, 10] = np.nan
+    ys[2, 30] = 0
+    window = 9
+    rate, error, n = rolling_loglinear(ys, window, poisson)
+
+    assert np.isnan(rate[:, :window - 1]).all()
+    for i in range(len(ys)):
+        for end in range(window - 1, len(t)):
+            tw, yw = t[end - window + 1:end + 1], ys[i, end - window + 1:end + 1]
+            ok     = yw > 0
+            assert n[i, end] == ok.sum()
+            w      = np.sqrt(yw[ok]) if poisson else None
+            (b, a), cov = np.polyfit(tw[ok], np.log(yw[ok]), 1, w=w,
+                                     cov='unscaled' if poisson else True)
+            assert rate [i, end] == pytest.approx(b, rel=1e-8)
+            assert error[i, end] == pytest.approx(np.sqrt(cov[0, 0]), rel=1e-6)
+
+    dates = pd.date_range('2020-03-01', periods=len(t))
+    df    = pd.DataFrame({'countriesAndTerritories': np.repeat(['A', 'B', 'C'], len(t)),
+                          'dateRep': np.tile(dates, 3), 'cases': ys.ravel()})
+    df    = df.drop(index=[5])   # a date missing for A
+    gr    = growth_rates(df, window=window, poisson=poisson)
+    assert gr.shape[0] == 3 * len(t)
+    np.testing.assert_allclose(gr.loc['B'].growth_rate.values, rate[1], equal_nan=True)
+    assert gr.loc['A'].days.values[5 + window - 1] == window - 2
+    gr    = gr.dropna()
+    np.testing.assert_allclose(gr.doubling_time * gr.growth_rate, np.log(2))
+
+
+def test_compartments_follow_the_initial_conditions():
+    N       = 1000
+    t_range = np.arange(0, 50.)
+    sir     = cbm.compute_sir(N, cbm.set_sir_initial_conditions(N, 1), 3., 1/7, t_range)
+    assert sir.absolute
+    assert sir.data.sum(axis=0) == pytest.approx(N)
+
+    S = sir.S.copy()
+    sir.to_normalized()
+    assert sir.data.sum(axis=0) == pytest.approx(1)
+    sir.to_absolute()
+    assert sir.S == pytest.approx(S)
+
+    seir = cbm.compute_seir(N, (N - 2, 1, 1), 3., 1/7, 1/5, t_range)
+    assert seir.absolute
+    assert seir.data.sum(axis=0) == pytest.approx(N)
+    assert seir.to_normalized().data.sum(axis=0) == pytest.approx(1)
+
+    seir = cbm.compute_seir(N, (1 - 2e-3, 1e-3, 1e-3), 3., 1/7, 1/5, t_range)
+    assert not seir.absolute
+    assert seir.to_absolute().data.sum(axis=0) == pytest.approx(N)